@@ -0,0 +1,325 @@
+#!/usr/bin/python3
+"""
+Builds many ivoatex documents on a process pool.
+
+Give this the directories of the documents (each with its Makefile and
+its ivoatex checkout or submodule).  For each document, it runs make
+for the PDF, the HTML, and the package, at most --jobs documents at a
+time, and then prints (or, with --format json, writes) a summary of
+what failed and how long the targets took.
+
+To avoid doing the same work many times over, the documents share
+a directory (--cache-dir, .ivoatex-cache/batch by default) containing
+
+* compiled TtH binaries, keyed by the sha256 of tth.c and the compiler
+  options, so TtH is compiled once per ivoatex version rather than once
+  per document (if that fails, make builds TtH for each document as
+  usual);
+* the figure cache of convert-figures.py (IVOATEX_FIGURE_CACHE); and
+* the indexes of the bib files (IVOATEX_BIBINDEX_DIR).
+
+make's output for each document goes to .ivoatex-cache/batch-build.log
+in the document directory; the summary shows its tail for failed
+builds.
+
+This is part of ivoatex, covered by the GPL.  See COPYING for details.
+"""
+
+from concurrent import futures
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import time
+
+
+DEFAULT_CACHE_DIR = ".ivoatex-cache/batch"
+LOG_NAME = ".ivoatex-cache/batch-build.log"
+TTH_SOURCE = "ivoatex/tth_C/tth.c"
+TTH_BINARY = "ivoatex/tth_C/tth"
+
+# the defaults of the ivoatex Makefile (where CC is make's built-in cc)
+DEFAULT_CC = "cc"
+DEFAULT_CFLAGS = "-std=gnu17"
+
+_DOCNAME_PATTERN = re.compile(r"^DOCNAME\s*[:?]?=\s*(\S+)", re.M)
+
+
+class BuildError(Exception):
+    """raised when a document cannot even be set up for building.
+    """
+
+
+def get_docname(doc_dir):
+    """returns the DOCNAME defined in doc_dir's Makefile.
+    """
+    try:
+        with open(os.path.join(doc_dir, "Makefile"), encoding="utf-8") as f:
+            mat = _DOCNAME_PATTERN.search(f.read())
+    except IOError as ex:
+        raise BuildError("Cannot read Makefile: %s"%ex)
+    if not mat:
+        raise BuildError("No DOCNAME in Makefile")
+    return mat.group(1)
+
+
+def hash_file(path):
+    """returns the hex sha256 of the file at path.
+    """
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def get_compiler():
+    """returns the C compiler command line, as a list, that make would
+    use to build TtH.
+
+    Like the Makefile, this takes CC and CFLAGS from the environment.
+    """
+    return (os.environ.get("CC") or DEFAULT_CC).split(
+        )+os.environ.get("CFLAGS", DEFAULT_CFLAGS).split()
+
+
+def get_shared_tth(tth_source, cache_dir):
+    """returns the path of a TtH binary compiled from tth_source.
+
+    The binary is kept in cache_dir under a hash of tth_source and the
+    compiler command and only compiled if it is not there yet.  The
+    compiler output goes to stderr; if compilation fails, a BuildError
+    is raised.
+    """
+    compiler = get_compiler()
+    hash = hashlib.sha256("\0".join(compiler).encode("utf-8")+b"\0")
+    hash.update(hash_file(tth_source).encode("ascii"))
+    dest_dir = os.path.join(cache_dir, "tth", hash.hexdigest())
+    dest_path = os.path.join(dest_dir, "tth")
+    if not os.path.exists(dest_path):
+        os.makedirs(dest_dir, exist_ok=True)
+        tmp_name = "%s.%d.tmp"%(dest_path, os.getpid())
+        try:
+            status = subprocess.call(compiler+["-o", tmp_name, tth_source],
+                stdout=sys.stderr)
+        except OSError as ex:
+            raise BuildError("Cannot run %s: %s"%(compiler[0], ex))
+        if status:
+            raise BuildError("Compiling %s failed; make will try again"
+                " for each document"%tth_source)
+        os.replace(tmp_name, dest_path)
+    return dest_path
+
+
+def install_tth(doc_dir, shared_tth):
+    """copies shared_tth into the ivoatex of doc_dir unless make would
+    consider the binary there up to date.
+    """
+    dest_path = os.path.join(doc_dir, TTH_BINARY)
+    source_path = os.path.join(doc_dir, TTH_SOURCE)
+    if (os.path.exists(dest_path)
+            and os.path.getmtime(dest_path)>=os.path.getmtime(source_path)):
+        return
+    # a fresh copy is newer than tth.c, so make will not compile again
+    shutil.copy(shared_tth, dest_path)
+
+
+def build_document(doc_dir, cache_dir, make="make"):
+    """builds the PDF, HTML and package for the document in doc_dir.
+
+    This returns a dictionary with the document directory and name, the
+    targets tried with their statuses and timings, and, for failures,
+    the end of the log.
+    """
+    result = {"dir": doc_dir, "docname": None, "targets": [], "ok": False}
+    start_time = time.time()
+    try:
+        docname = result["docname"] = get_docname(doc_dir)
+    except BuildError as ex:
+        result["error"] = str(ex)
+        return result
+
+    # without a shared TtH, make compiles one for the document
+    try:
+        install_tth(doc_dir, get_shared_tth(
+            os.path.join(doc_dir, TTH_SOURCE), cache_dir))
+    except (BuildError, OSError):
+        pass
+
+    env = dict(os.environ,
+        IVOATEX_FIGURE_CACHE=os.path.join(cache_dir, "figures"),
+        IVOATEX_BIBINDEX_DIR=os.path.join(cache_dir, "bibindex"))
+    log_path = os.path.join(doc_dir, LOG_NAME)
+    os.makedirs(os.path.dirname(log_path), exist_ok=True)
+
+    with open(log_path, "w") as log:
+        for target in [docname+".pdf", docname+".html", "package"]:
+            target_start = time.time()
+            log.write("===== make %s\n"%target)
+            log.flush()
+            status = subprocess.call([make, target], cwd=doc_dir, env=env,
+                stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT)
+            result["targets"].append({"target": target, "status": status,
+                "seconds": time.time()-target_start})
+            if status:
+                break
+
+    result["seconds"] = time.time()-start_time
+    result["ok"] = all(t["status"]==0 for t in result["targets"])
+    if not result["ok"]:
+        with open(log_path, encoding="utf-8", errors="replace") as f:
+            result["error"] = "".join(f.readlines()[-15:])
+    return result
+
+
+def build_collection(doc_dirs, cache_dir, n_workers=None, make="make"):
+    """returns build_document's results for doc_dirs, built on a process
+    pool of n_workers.
+
+    The TtH binaries are compiled before the documents are built so
+    workers never compile the same TtH concurrently.  Failures are only
+    reported here; make then builds TtH in each document.
+    """
+    for tth_source in set(os.path.join(d, TTH_SOURCE) for d in doc_dirs):
+        if os.path.exists(tth_source):
+            try:
+                get_shared_tth(tth_source, cache_dir)
+            except BuildError as ex:
+                sys.stderr.write("%s\n"%ex)
+
+    with futures.ProcessPoolExecutor(n_workers) as pool:
+        return list(pool.map(build_document, doc_dirs,
+            [cache_dir]*len(doc_dirs), [make]*len(doc_dirs)))
+
+
+def format_summary(results, elapsed):
+    """returns a plain-text summary of build_collection results.
+    """
+    lines = []
+    for res in results:
+        timings = " ".join("%s %.1f s"%(
+                t["target"].replace(res["docname"] or "", "")
+                    or t["target"], t["seconds"])
+            for t in res["targets"])
+        lines.append("%-4s %-30s %s"%("ok" if res["ok"] else "FAIL",
+            res["dir"], timings))
+        if not res["ok"]:
+            lines.extend("     | "+ln
+                for ln in res.get("error", "").rstrip().split("\n"))
+
+    n_failed = sum(1 for res in results if not res["ok"])
+    lines.append("%d document(s), %d failed, %.1f s total build time,"
+        " %.1f s elapsed"%(len(results), n_failed,
+            sum(res.get("seconds", 0) for res in results), elapsed))
+    return "\n".join(lines)
+
+
+def parse_command_line():
+    import argparse
+    parser = argparse.ArgumentParser(description="Build the PDF, HTML,"
+        " and package of many ivoatex documents in parallel.")
+    parser.add_argument("doc_dirs", nargs="+", metavar="DIR",
+        help="Directories of the documents to build.")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+        help="Number of documents to build in parallel (default: number"
+            " of CPUs).")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR,
+        help="Directory for TtH binaries and caches shared between the"
+            " documents (default: %(default)s).")
+    parser.add_argument("--make", default=os.environ.get("MAKE", "make"),
+        help="The make to use (default: %(default)s).")
+    parser.add_argument("--format", choices=["text", "json"],
+        default="text", help="Format of the summary (default: %(default)s).")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_command_line()
+    cache_dir = os.path.abspath(args.cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    start_time = time.time()
+    results = build_collection([os.path.abspath(d) for d in args.doc_dirs],
+        cache_dir, args.jobs, args.make)
+    elapsed = time.time()-start_time
+
+    if args.format=="json":
+        json.dump({"documents": results, "seconds": elapsed},
+            sys.stdout, indent=1)
+        sys.stdout.write("\n")
+    else:
+        print(format_summary(results, elapsed))
+
+    if not all(res["ok"] for res in results):
+        sys.exit(1)
+
+
+############## Tests (run with python3 -m pytest batch-build.py)
+
+def _make_document(path, docname, tth_source="int main(){return 0;}\n",
+        recipe="@echo built $@"):
+    (path/"ivoatex"/"tth_C").mkdir(parents=True)
+    (path/TTH_SOURCE).write_text(tth_source)
+    (path/"Makefile").write_text("DOCNAME = %s\n\n"
+        "%s.pdf %s.html package:\n\t%s\n"%(docname, docname, docname, recipe))
+
+
+def test_docname(tmp_path):
+    (tmp_path/"Makefile").write_text("# DOCNAME = x\nDOCNAME = RegTAP\n")
+    assert get_docname(str(tmp_path))=="RegTAP"
+
+
+def test_shared_tth(tmp_path):
+    import pytest
+    if not shutil.which("cc"):
+        pytest.skip("No C compiler")
+    cache_dir = str(tmp_path/"cache")
+    for name in ["a", "b"]:
+        _make_document(tmp_path/name, name.upper())
+    tth_a = get_shared_tth(str(tmp_path/"a"/TTH_SOURCE), cache_dir)
+    assert get_shared_tth(str(tmp_path/"b"/TTH_SOURCE), cache_dir)==tth_a
+
+    install_tth(str(tmp_path/"a"), tth_a)
+    assert (tmp_path/"a"/TTH_BINARY).exists()
+
+
+def test_failing_tth(tmp_path, monkeypatch):
+    import pytest
+    if not shutil.which("make"):
+        pytest.skip("No make")
+    monkeypatch.setenv("CC", "false")
+    _make_document(tmp_path/"doc", "Doc")
+    with pytest.raises(BuildError):
+        get_shared_tth(str(tmp_path/"doc"/TTH_SOURCE), str(tmp_path/"cache"))
+    # the document is still built (make would build TtH itself)
+    res = build_document(str(tmp_path/"doc"), str(tmp_path/"cache"))
+    assert res["ok"]
+    assert not (tmp_path/"doc"/TTH_BINARY).exists()
+
+
+def test_build(tmp_path):
+    import pytest
+    if not shutil.which("cc") or not shutil.which("make"):
+        pytest.skip("No C compiler or make")
+    _make_document(tmp_path/"good", "Good")
+    _make_document(tmp_path/"bad", "Bad", recipe="@echo broken; false")
+    (tmp_path/"none").mkdir()
+    doc_dirs = [str(tmp_path/name) for name in ["good", "bad", "none"]]
+
+    results = build_collection(doc_dirs, str(tmp_path/"cache"), 2)
+    assert [res["ok"] for res in results]==[True, False, False]
+    assert [t["target"] for t in results[0]["targets"]]==[
+        "Good.pdf", "Good.html", "package"]
+    assert len(results[1]["targets"])==1
+    assert "broken" in results[1]["error"]
+    assert "Makefile" in results[2]["error"]
+
+    summary = format_summary(results, 1)
+    assert summary.startswith("ok ")
+    assert "3 document(s), 2 failed" in summary
+
+
+if __name__=="__main__":
+    main()
+
+# vim:et:sw=4:sta
@@ -0,0 +1,790 @@
+"""
+Helpers for working with BibTeX files without running BibTeX.
+
+The main thing here is BibIndex, which gives random access to single
+entries in a BibTeX file through a persistent index mapping citation
+keys to byte ranges.  That index is kept next to the BibTeX file (in
+<file>.idx; set IVOATEX_BIBINDEX_DIR to put it elsewhere, e.g., when
+ivoatex is read-only) and rebuilt when the BibTeX file changes.
+
+The parser is a simple streaming one that only knows about entry
+boundaries; it does not interpret the entries beyond splitting them into
+fields on request (parse_fields).  It should accept anything BibTeX
+accepts and perhaps a bit more.
+
+This is part of ivoatex, covered by the GPL.  See COPYING for details.
+"""
+
+import hashlib
+import io
+import json
+import os
+import re
+
+
+INDEX_FORMAT_VERSION = 1
+
+# an @ starting an entry; BibTeX accepts these anywhere outside of entries.
+_ENTRY_HEAD = re.compile(rb"@\s*([A-Za-z]+)\s*([{(])\s*")
+_ENTRY_KEY = re.compile(rb"[^,\s=}\)]*")
+_DELIMITERS = re.compile(rb"[{}()]")
+_ENTRY_HEAD_TEXT = re.compile(_ENTRY_HEAD.pattern.decode("ascii"))
+
+# entry types that do not have citation keys
+NON_CITABLE = frozenset(["string", "preamble", "comment"])
+
+
+class BibError(ValueError):
+    """is raised for malformed BibTeX input.
+    """
+
+
+def iter_entry_spans(f):
+    """yields (kind, key, start, end) tuples for the entries in the
+    open binary file f.
+
+    start and end are byte offsets such that f.seek(start);
+    f.read(end-start) returns the entire entry, from the @ to the closing
+    delimiter.  kind is lowercased.  For @string, key is the name of the
+    macro defined; for @preamble and @comment, it is empty.
+
+    Text outside of entries is ignored, as BibTeX does.
+    """
+    offset = 0
+    # while in an entry, these are its kind, key, start, the closing
+    # delimiter and the current brace depth.
+    current = None
+
+    for ln in f:
+        pos = 0
+        while pos<len(ln):
+            if current is None:
+                mat = _ENTRY_HEAD.search(ln, pos)
+                if not mat:
+                    break
+                kind = mat.group(1).decode("ascii").lower()
+                key = _ENTRY_KEY.match(ln, mat.end()).group()
+                if kind in ("preamble", "comment"):
+                    key = b""
+                current = [kind, key.decode("utf-8"), offset+mat.start(),
+                    b"}" if mat.group(2)==b"{" else b")", 0]
+                pos = mat.end()+len(key)
+                if kind not in NON_CITABLE-{"string"} and not key:
+                    # the key is on a later line; we take the first word
+                    # we see.
+                    current[1] = None
+                continue
+
+            if current[1] is None:
+                mat = _ENTRY_KEY.match(ln, len(ln)-len(ln[pos:].lstrip()))
+                if mat.group():
+                    current[1] = mat.group().decode("utf-8")
+                    pos = mat.end()
+                    continue
+
+            mat = _DELIMITERS.search(ln, pos)
+            if not mat:
+                break
+            pos = mat.end()
+            char = mat.group()
+            if char==b"{":
+                current[4] += 1
+            elif char==b"}" and current[4]>0:
+                current[4] -= 1
+            elif char==current[3] and current[4]==0:
+                kind, key, start = current[:3]
+                yield kind, key or "", start, offset+pos
+                current = None
+
+        offset += len(ln)
+
+    if current is not None:
+        raise BibError("Unterminated @%s entry %s at byte %d"%(
+            current[0], current[1] or "", current[2]))
+
+
+def hash_file(path):
+    """returns the hex sha256 of the content of the file at path.
+    """
+    hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1<<16), b""):
+            hash.update(chunk)
+    return hash.hexdigest()
+
+
+def get_index_path(bib_path):
+    """returns the path of the index file for the BibTeX file at bib_path.
+    """
+    index_dir = os.environ.get("IVOATEX_BIBINDEX_DIR")
+    if index_dir:
+        return os.path.join(index_dir,
+            hashlib.sha256(os.path.abspath(bib_path).encode("utf-8")
+                ).hexdigest()[:16]+"-"+os.path.basename(bib_path)+".idx")
+    return bib_path+".idx"
+
+
+class BibIndex:
+    """a key-to-entry index for a BibTeX file.
+
+    Construct with the path to the BibTeX file.  The index is loaded from
+    get_index_path(bib_path) if that is still valid; otherwise, it is
+    rebuilt and (if possible) written.  An index is considered valid if
+    size and mtime of the BibTeX file are unchanged or if its content
+    still has the hash recorded in the index.  Pass verify=True to always
+    check the hash.
+
+    Citation keys are case-sensitive here; use find to look up keys
+    case-insensitively the way BibTeX matches them.
+
+    Use get_source(key) to retrieve the text of an entry and
+    get_fields(key) to have it parsed.  Macros defined with @string are
+    available through get_string_source(name).  The spans attributes
+    (spans, string_spans, preamble_spans) give byte ranges as (start, end)
+    pairs.
+    """
+    def __init__(self, bib_path, verify=False):
+        self.bib_path = bib_path
+        self.index_path = get_index_path(bib_path)
+        self._load_or_build(verify)
+        self.folded_keys = dict((key.lower(), key) for key in self.spans)
+
+    def __contains__(self, key):
+        return key in self.spans
+
+    def __iter__(self):
+        return iter(self.spans)
+
+    def __len__(self):
+        return len(self.spans)
+
+    def _load_or_build(self, verify):
+        stat = os.stat(self.bib_path)
+        try:
+            with open(self.index_path, encoding="utf-8") as f:
+                index = json.load(f)
+            if index["version"]!=INDEX_FORMAT_VERSION:
+                raise ValueError("Outdated index format")
+
+            if (not verify
+                    and index["size"]==stat.st_size
+                    and index["mtime_ns"]==stat.st_mtime_ns):
+                self._set_from(index)
+                return
+
+            if index["sha256"]==hash_file(self.bib_path):
+                # touched but unchanged; remember the new mtime.
+                index["size"], index["mtime_ns"] = (
+                    stat.st_size, stat.st_mtime_ns)
+                self._set_from(index)
+                self._write(index)
+                return
+        except (IOError, ValueError, KeyError):
+            pass
+
+        index = self.build_index(stat)
+        self._set_from(index)
+        self._write(index)
+
+    def build_index(self, stat):
+        """returns a dictionary ready for JSON serialisation with the
+        entry spans of our BibTeX file.
+        """
+        hash = hashlib.sha256()
+        with open(self.bib_path, "rb") as f:
+            entries = [list(t) for t in iter_entry_spans(f)]
+            f.seek(0)
+            for chunk in iter(lambda: f.read(1<<16), b""):
+                hash.update(chunk)
+        return {
+            "version": INDEX_FORMAT_VERSION,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha256": hash.hexdigest(),
+            "entries": entries}
+
+    def _set_from(self, index):
+        self.sha256 = index["sha256"]
+        self.spans, self.string_spans, self.preamble_spans = {}, {}, []
+        for kind, key, start, end in index["entries"]:
+            if kind=="preamble":
+                self.preamble_spans.append((start, end))
+            elif kind=="string":
+                self.string_spans[key.lower()] = (start, end)
+            elif kind not in NON_CITABLE:
+                # BibTeX uses the first of several entries with the same key.
+                self.spans.setdefault(key, (start, end))
+
+    def _write(self, index):
+        try:
+            tmp_name = self.index_path+".tmp%d"%os.getpid()
+            with open(tmp_name, "w", encoding="utf-8") as f:
+                json.dump(index, f)
+            os.replace(tmp_name, self.index_path)
+        except IOError:
+            # read-only location; we'll rebuild the index next time.
+            pass
+
+    def find(self, key):
+        """returns the key as spelled in the BibTeX file for key, matching
+        case-insensitively.
+
+        This returns None if there is no matching entry.
+        """
+        if key in self.spans:
+            return key
+        return self.folded_keys.get(key.lower())
+
+    def _read(self, span):
+        with open(self.bib_path, "rb") as f:
+            f.seek(span[0])
+            return f.read(span[1]-span[0]).decode("utf-8")
+
+    def get_source(self, key):
+        """returns the BibTeX source of the entry for key.
+
+        This raises a KeyError for unknown keys.
+        """
+        return self._read(self.spans[key])
+
+    def get_string_source(self, name):
+        """returns the BibTeX source of the @string definition of name.
+
+        As in BibTeX, macro names are case-insensitive.  This raises a
+        KeyError for unknown macros.
+        """
+        return self._read(self.string_spans[name.lower()])
+
+    def get_fields(self, key):
+        """returns parse_fields' result for the entry for key.
+        """
+        return parse_fields(self.get_source(key))
+
+
+_FIELD_NAME = re.compile(r"\s*([^\s=,{}()\"#]+)\s*=\s*")
+_VALUE_PART = re.compile(r'\s*(?:(\{)|(")|([^\s,#{}()"]+))')
+_SEPARATOR = re.compile(r"\s*(#|,|[})]\s*$|$)")
+
+
+def _skip_braced(source, pos, closer):
+    """returns the position behind closer (a closing brace or
+    double quote) in source, starting at pos and skipping balanced braces.
+    """
+    depth = 0
+    for pos in range(pos, len(source)):
+        char = source[pos]
+        if char=="{":
+            depth += 1
+        elif char=="}" and depth>0:
+            depth -= 1
+        elif char==closer and depth==0:
+            return pos+1
+    raise BibError("Unbalanced value in %s"%source[:40])
+
+
+def _parse_assignments(source, pos):
+    """returns a dictionary of the name = value pairs in source, starting
+    at pos.
+
+    This is parse_fields' and parse_string's backend.
+    """
+    fields = {}
+    while True:
+        mat = _FIELD_NAME.match(source, pos)
+        if not mat:
+            break
+        name, value_start = mat.group(1).lower(), mat.end()
+        pos = value_start
+
+        while True:
+            mat = _VALUE_PART.match(source, pos)
+            if not mat:
+                raise BibError("Missing value for %s in %s"%(
+                    name, source[:40]))
+            if mat.group(1):
+                pos = _skip_braced(source, mat.end(), "}")
+            elif mat.group(2):
+                pos = _skip_braced(source, mat.end(), '"')
+            else:
+                pos = mat.end()
+
+            sep = _SEPARATOR.match(source, pos)
+            if sep and sep.group(1)=="#":
+                pos = sep.end()
+                continue
+            break
+
+        fields[name] = source[value_start:pos].strip()
+        if sep and sep.group(1)==",":
+            pos = sep.end()
+        else:
+            break
+
+    return fields
+
+
+def parse_fields(source):
+    """returns a dictionary of the fields of the BibTeX entry in source.
+
+    Field names are lowercased.  Values are returned as written in the
+    file, i.e., with braces, quotes, macro names, and # concatenation,
+    except for surrounding whitespace.  Use get_macro_refs to find the
+    @string macros a value references.
+    """
+    mat = _ENTRY_HEAD_TEXT.match(source)
+    if not mat:
+        raise BibError("Not a BibTeX entry: %s"%source[:40])
+    pos = source.find(",", mat.end())
+    if pos==-1:
+        return {}
+    return _parse_assignments(source, pos+1)
+
+
+def parse_string(source):
+    """returns the macro name (lowercased) and the value for a BibTeX
+    @string definition.
+    """
+    mat = _ENTRY_HEAD_TEXT.match(source)
+    if not mat or mat.group(1).lower()!="string":
+        raise BibError("Not a BibTeX @string: %s"%source[:40])
+    defs = _parse_assignments(source, mat.end())
+    if len(defs)!=1:
+        raise BibError("Bad @string definition: %s"%source[:40])
+    return defs.popitem()
+
+
+_MACRO_REF = re.compile(r'\{|"|#|[^\s#{}"]+')
+
+
+def get_macro_refs(value):
+    """returns the names of the @string macros referenced in a field value
+    as returned by parse_fields.
+
+    Numbers are not macros and hence not returned.  Note that this does
+    not know about BibTeX's predefined month macros.
+    """
+    refs, pos = [], 0
+    while True:
+        mat = _MACRO_REF.search(value, pos)
+        if not mat:
+            break
+        token = mat.group()
+        if token=="{":
+            pos = _skip_braced(value, mat.end(), "}")
+        elif token=='"':
+            pos = _skip_braced(value, mat.end(), '"')
+        else:
+            pos = mat.end()
+            if token!="#" and not token.isdigit():
+                refs.append(token)
+    return refs
+
+
+_CONTENT_HASH = re.compile(r"^% content-sha256: ([0-9a-f]{64})$", re.M)
+# field names are right-aligned to this width, as in ADS exports
+FIELD_NAME_WIDTH = 13
+
+
+def _normalise_space(value):
+    return re.sub(r"\s+", " ", value).strip()
+
+
+def format_entry(kind, key, fields):
+    """returns canonical BibTeX source for an entry.
+
+    fields is a sequence of (name, value) pairs, the values as returned
+    by parse_fields.  Whitespace within values is collapsed, which does
+    not change what BibTeX makes of them.
+    """
+    lines = ["@%s{%s,"%(kind.upper(), key)]
+    for index, (name, value) in enumerate(fields):
+        lines.append("%*s = %s%s"%(FIELD_NAME_WIDTH, name,
+            _normalise_space(value), "," if index<len(fields)-1 else ""))
+    lines.append("}")
+    return "\n".join(lines)
+
+
+def canonicalise_bibtex(source, title="BibTeX"):
+    """returns source (a string) as canonical BibTeX.
+
+    In canonical BibTeX, entries are sorted by key, there is only one
+    entry per key (the first one in source), and the whitespace is
+    normalised (see format_entry).  @string-s and @preamble-s come first,
+    in their original order; @comment-s and anything outside of entries
+    are dropped.
+
+    The result starts with title and a content-sha256 comment giving a
+    hash of the rest of the file (see get_content_hash); this hash only
+    changes when the entries do.
+    """
+    encoded = source.encode("utf-8")
+    prologue, entries = [], {}
+    for kind, key, start, end in iter_entry_spans(io.BytesIO(encoded)):
+        entry_source = encoded[start:end].decode("utf-8")
+        if kind=="comment":
+            continue
+        elif kind in NON_CITABLE:
+            prologue.append(_normalise_space(entry_source))
+        elif key not in entries:
+            entries[key] = format_entry(kind, key,
+                list(parse_fields(entry_source).items()))
+
+    body = "\n\n".join(prologue+[entries[key] for key in sorted(entries)]
+        )+"\n"
+    content_hash = hashlib.sha256(body.encode("utf-8")).hexdigest()
+    return "%s\n%% content-sha256: %s\n\n%s"%(title, content_hash, body)
+
+
+def extract_content_hash(source):
+    """returns the content hash from the header canonicalise_bibtex
+    writes in the BibTeX source (a string), or None if there is none.
+    """
+    mat = _CONTENT_HASH.search(source, 0, 1000)
+    return mat and mat.group(1)
+
+
+def get_content_hash(bib_path):
+    """returns the content hash in the header written by
+    canonicalise_bibtex for the BibTeX file at bib_path.
+
+    This returns None if the file does not exist or does not have such a
+    header.
+    """
+    try:
+        with open(bib_path, encoding="utf-8") as f:
+            head = f.read(1000)
+    except IOError:
+        return None
+    return extract_content_hash(head)
+
+
+_AUX_INPUT = re.compile(r"\\@input\{([^}]*)}")
+_BIBDATA = re.compile(r"\\bibdata\{([^}]*)}")
+
+
+def iter_aux_lines(aux_path):
+    """yields the lines of the LaTeX aux file at aux_path and the aux
+    files it pulls in through \\@input (as for \\include-d files).
+
+    Missing included aux files are ignored, as LaTeX does.
+    """
+    with open(aux_path, encoding="utf-8", errors="replace") as f:
+        for ln in f:
+            yield ln
+            mat = _AUX_INPUT.search(ln)
+            if mat:
+                child = os.path.join(os.path.dirname(aux_path), mat.group(1))
+                if os.path.exists(child):
+                    yield from iter_aux_lines(child)
+
+
+def iter_ref_tags(f):
+    """yields all arguments of citation macro calls within the file f's
+    content.
+
+    We expect the citation calls to be all in one line and without
+    whitespace and all that.  I think that's how LaTeX produces them:
+    We're reading from an aux file here.
+    """
+    pat = re.compile(r"\\citation\{([^}]*)}")
+    for ln in f:
+        mat = pat.search(ln)
+        if mat:
+            yield mat.group(1)
+
+
+def get_cited_keys(f):
+    """returns the set of citation keys in the aux lines f.
+
+    Unlike iter_ref_tags, this splits multiple keys in one \\citation.
+    """
+    keys = set()
+    for tags in iter_ref_tags(f):
+        keys.update(t.strip() for t in tags.split(",") if t.strip())
+    return keys
+
+
+def get_bib_names(f):
+    """returns the names of the BibTeX files from the \\bibdata lines
+    in the aux lines f.
+
+    These are returned as given, i.e., usually without the .bib extension.
+    """
+    names = []
+    for ln in f:
+        mat = _BIBDATA.search(ln)
+        if mat:
+            names.extend(n.strip() for n in mat.group(1).split(","))
+    return names
+
+
+# natbib's citation commands, \nocite, \bibliography, and file inclusion
+_TEX_REF_MACROS = (r"(?:[Cc]ite(?:t|p|alt|alp|author|year|yearpar|num)?"
+    r"|nocite|bibliography|input|include)")
+_TEX_REF = re.compile(r"\\("+_TEX_REF_MACROS+r")\*?\s*"
+    r"(?:\[[^\]]*\]\s*){0,2}\{([^}]*)\}"
+    # plain TeX's \input file
+    r"|\\(input)\s+([^\s{}%\\]+)")
+_TEX_REF_START = re.compile(r"\\"+_TEX_REF_MACROS+r"(?![a-zA-Z])")
+_TEX_COMMENT = re.compile(r"(?<!\\)%.*")
+# how many lines a macro call may be spread over
+MAX_CONTINUATION_LINES = 5
+
+
+def iter_tex_refs(lines):
+    """yields (line_no, macro, argument) triples for the citation,
+    \\bibliography, \\input, and \\include macro calls in TeX source lines.
+
+    macro is without the backslash, argument is the mandatory argument
+    as written (i.e., citation keys still need to be split on commas).
+    Comments are skipped.  Calls may be spread over up to
+    MAX_CONTINUATION_LINES lines; line_no is where the macro name is.
+    """
+    pending, pending_line = "", None
+    for line_no, ln in enumerate(lines, 1):
+        ln = _TEX_COMMENT.sub("", ln.rstrip("\r\n"))
+        if pending:
+            text, start_line = pending+"\n"+ln, pending_line
+        else:
+            text, start_line = ln, line_no
+
+        pos = 0
+        for mat in _TEX_REF.finditer(text):
+            yield (start_line+text.count("\n", 0, mat.start()),
+                mat.group(1) or mat.group(3), mat.group(2) or mat.group(4))
+            pos = mat.end()
+
+        unclosed = _TEX_REF_START.search(text, pos)
+        if unclosed and text.count("\n")<MAX_CONTINUATION_LINES:
+            pending = text[unclosed.start():]
+            pending_line = start_line+text.count("\n", 0, unclosed.start())
+        else:
+            pending = ""
+
+
+def _find_tex_input(base_dir, name, macro):
+    """returns the path of the file LaTeX would \\input or \\include for
+    name, or None if there is no such file in base_dir.
+    """
+    candidates = [name+".tex"]
+    if macro=="input" and not name.endswith(".tex"):
+        candidates.append(name)
+    for candidate in candidates:
+        path = os.path.join(base_dir, candidate)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def iter_tex_tree_refs(tex_path, base_dir=None, seen=None):
+    """yields (tex_path, line_no, macro, argument) for the citation and
+    \\bibliography macro calls in the TeX file tex_path and the files it
+    \\input-s or \\include-s.
+
+    Included files are read when their inclusion is encountered.  As in
+    LaTeX, their names are relative to base_dir, which defaults to
+    tex_path's directory.  Files not found there (e.g., ivoatex's own
+    files from TEXINPUTS) are skipped, as are files already in the set
+    seen (which this updates).
+    """
+    if base_dir is None:
+        base_dir = os.path.dirname(tex_path)
+    if seen is None:
+        seen = set()
+    real_path = os.path.realpath(tex_path)
+    if real_path in seen:
+        return
+    seen.add(real_path)
+
+    with open(tex_path, encoding="utf-8", errors="replace") as f:
+        for line_no, macro, arg in iter_tex_refs(f):
+            if macro in ("input", "include"):
+                child = _find_tex_input(base_dir, arg.strip(), macro)
+                if child:
+                    yield from iter_tex_tree_refs(child, base_dir, seen)
+            else:
+                yield tex_path, line_no, macro, arg
+
+
+############## Tests (run with python3 -m pytest bibtools.py)
+
+_TEST_BIB = r"""Comments are anything outside of entries.
+@String{ aj = "Astronomical Journal" }
+@STRING(ivoa = {International {Virtual} Observatory Alliance})
+@preamble{ "\newcommand{\noop}[1]{}" }
+
+@Misc{std:RFC4122,
+  author =       {P. Leach and M. Mealling and R. Salz},
+  title =        {A {Universally Unique IDentifier (UUID)} {URN} Namespace},
+  month =        jul,
+  year =         2005
+}
+
+@ARTICLE{2001A&A...376..359H,
+    title = "{Definition of {"}FITS{"}}",
+  journal = aj # " and " # ivoa,
+     year = 2001,
+}
+@misc(
+  keyonnextline,
+  note = {contains ) and @misc{in, braces}})
+@misc{std:RFC4122, note = {shadowed duplicate}}
+"""
+
+
+def _make_test_bib(tmp_path, content=_TEST_BIB):
+    bib_path = tmp_path/"test.bib"
+    bib_path.write_bytes(content.encode("utf-8"))
+    return str(bib_path)
+
+
+def test_spans():
+    import io
+    f = io.BytesIO(_TEST_BIB.encode("utf-8"))
+    spans = list(iter_entry_spans(f))
+    assert [s[:2] for s in spans]==[
+        ("string", "aj"), ("string", "ivoa"), ("preamble", ""),
+        ("misc", "std:RFC4122"), ("article", "2001A&A...376..359H"),
+        ("misc", "keyonnextline"), ("misc", "std:RFC4122")]
+    source = _TEST_BIB.encode("utf-8")
+    assert source[spans[5][2]:spans[5][3]].endswith(b"braces}})")
+    assert source[spans[4][2]:spans[4][3]].startswith(b"@ARTICLE{")
+    assert source[spans[4][2]:spans[4][3]].endswith(b"2001,\n}")
+
+
+def test_unterminated():
+    import io, pytest
+    with pytest.raises(BibError, match="Unterminated @misc entry foo"):
+        list(iter_entry_spans(io.BytesIO(b"@misc{foo,\n title={x}\n")))
+
+
+def test_parse_fields():
+    assert parse_fields("@misc{x, title = {a, {b}},"
+        ' journal=aj # "x, y" # {z},'
+        " year = 2001 }")=={
+            "title": "{a, {b}}", "journal": 'aj # "x, y" # {z}',
+            "year": "2001"}
+    assert parse_fields("@misc(x)")=={}
+    assert get_macro_refs('aj # "x, y" # {z} # ivoa')==["aj", "ivoa"]
+    assert get_macro_refs("2001")==[]
+
+
+def test_tex_refs():
+    assert list(iter_tex_refs([
+        "We use \\citet{a,b} and \\citep[p.~3]{c}.  % \\cite{commented}\n",
+        "\\cite[see][]{d} 100\\% \\nocite{e} \\citestyle{no}\n",
+        "\\citep{f,\n",
+        "  g}\\cite\n",
+        "{h}\n",
+        "\\bibliography{ivoatex/ivoabib,local}\n",
+        "\\input gitmeta \\include{sect}\\includegraphics{x}\n"]))==[
+        (1, "citet", "a,b"), (1, "citep", "c"), (2, "cite", "d"),
+        (2, "nocite", "e"), (3, "citep", "f,\n  g"), (4, "cite", "h"),
+        (6, "bibliography", "ivoatex/ivoabib,local"),
+        (7, "input", "gitmeta"), (7, "include", "sect")]
+
+
+def test_tex_tree_refs(tmp_path):
+    (tmp_path/"main.tex").write_text("\\input tthdefs\n"
+        "\\cite{a}\n\\input{parts/one}\n"
+        "\\include{parts/one}\\cite{c}\n")
+    (tmp_path/"parts").mkdir()
+    (tmp_path/"parts"/"one.tex").write_text(
+        "\\citep{b}\n% \\input{main}\n\\input{main}\n")
+    assert [(os.path.basename(r[0]),)+r[1:] for r in iter_tex_tree_refs(
+        str(tmp_path/"main.tex"))]==[
+        ("main.tex", 2, "cite", "a"), ("one.tex", 1, "citep", "b"),
+        ("main.tex", 4, "cite", "c")]
+
+
+def test_canonicalise():
+    source = ("junk\n@misc{b,\n  Title = {Second\n   entry},\n"
+        "  year=2001}\n"
+        "@comment{dropped}\n"
+        "@MISC{a, title = {First}}\n"
+        "@string{ x  =  \"y\" }\n"
+        "@misc{b, title = {Duplicate}}\n")
+    canonical = canonicalise_bibtex(source, "Test")
+    assert canonical.split("\n", 3)[3]==(
+        '@string{ x = "y" }\n\n'
+        "@MISC{a,\n"
+        "        title = {First}\n"
+        "}\n\n"
+        "@MISC{b,\n"
+        "        title = {Second entry},\n"
+        "         year = 2001\n"
+        "}\n")
+    assert canonical.startswith("Test\n% content-sha256: ")
+    # canonicalisation is idempotent
+    assert canonicalise_bibtex(canonical, "Test")==canonical
+
+
+def test_content_hash(tmp_path):
+    bib_path = tmp_path/"x.bib"
+    bib_path.write_text(canonicalise_bibtex("@misc{a, title={A}}"))
+    content_hash = get_content_hash(str(bib_path))
+    assert len(content_hash)==64
+    bib_path.write_text(canonicalise_bibtex("@misc{a,\ntitle={A}\n}\n",
+        "Other title"))
+    assert get_content_hash(str(bib_path))==content_hash
+    assert get_content_hash(str(tmp_path/"y.bib")) is None
+
+
+class TestBibIndex:
+    def test_lookup(self, tmp_path):
+        index = BibIndex(_make_test_bib(tmp_path))
+        assert set(index)=={
+            "std:RFC4122", "2001A&A...376..359H", "keyonnextline"}
+        assert index.get_fields("std:RFC4122")["month"]=="jul"
+        assert index.get_fields("2001A&A...376..359H")["title"]==(
+            '"{Definition of {"}FITS{"}}"')
+        assert index.get_string_source("ivoa").startswith("@STRING(")
+        assert index.find("STD:rfc4122")=="std:RFC4122"
+        assert index.find("std:rfc4123") is None
+        assert "keyonnextline" in index
+        with __import__("pytest").raises(KeyError):
+            index.get_source("std:rfc4122")
+
+    def test_persistence(self, tmp_path):
+        bib_path = _make_test_bib(tmp_path)
+        BibIndex(bib_path)
+        assert os.path.exists(bib_path+".idx")
+
+        # a valid index is used without re-parsing
+        with open(bib_path+".idx", encoding="utf-8") as f:
+            index = json.load(f)
+        index["entries"][3][1] = "fromindex"
+        index["sha256"] = "0"*64
+        with open(bib_path+".idx", "w", encoding="utf-8") as f:
+            json.dump(index, f)
+        assert "fromindex" in BibIndex(bib_path)
+        # ...unless we ask to verify the hash
+        assert "fromindex" not in BibIndex(bib_path, verify=True)
+
+    def test_invalidation(self, tmp_path):
+        bib_path = _make_test_bib(tmp_path)
+        BibIndex(bib_path)
+        _make_test_bib(tmp_path, _TEST_BIB.replace(
+            "keyonnextline", "changedkey"))
+        assert "changedkey" in BibIndex(bib_path)
+
+    def test_index_dir(self, tmp_path, monkeypatch):
+        index_dir = tmp_path/"idx"
+        index_dir.mkdir()
+        monkeypatch.setenv("IVOATEX_BIBINDEX_DIR", str(index_dir))
+        bib_path = _make_test_bib(tmp_path)
+        assert len(BibIndex(bib_path))==3
+        assert not os.path.exists(bib_path+".idx")
+        assert len(os.listdir(index_dir))==1
+
+    def test_real_bibs(self, tmp_path, monkeypatch):
+        monkeypatch.setenv("IVOATEX_BIBINDEX_DIR", str(tmp_path))
+        src_dir = os.path.dirname(os.path.abspath(__file__))
+        for name in ["ivoabib.bib", "docrepo.bib"]:
+            index = BibIndex(os.path.join(src_dir, name))
+            for key in index:
+                assert index.get_source(key).lstrip("@").split(
+                    "{", 1)[1].lstrip().startswith(key)
+                index.get_fields(key)
+
+# vim:et:sw=4:sta
@@ -0,0 +1,279 @@
+#!/usr/bin/python3
+"""
+Profiles a build of an ivoatex document.
+
+This is what make profile runs.  It builds the standard targets
+(the PDF, the bibliography, the HTML, and the package) one after the
+other and times
+
+* each make target as a whole and
+* each call of an external tool (latexmk, pdflatex, bibtex, tth,
+  xsltproc, rsvg-convert, convert, zip, ...) made while building it.
+
+To time the tools, we put shims for them into a temporary directory at
+the front of PATH; TtH is called through make's TTH_CMD.  The shims run
+the real programs and append what happened to a log.  Since latexmk
+calls pdflatex and bibtex itself, its times include theirs.
+
+We also record the number of LaTeX passes (the pdflatex runs on the
+document) and whether the final LaTeX log still asks for a rerun.
+
+Unless --no-clean is given, we run make clean first so results are
+comparable between runs.  The report is printed and written as JSON
+(to .ivoatex-cache/profile.json by default) for comparing timings
+across ivoatex updates.
+
+This is part of ivoatex, covered by the GPL.  See COPYING for details.
+"""
+
+import json
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+DEFAULT_REPORT = ".ivoatex-cache/profile.json"
+
+# the tools we time, as they are called from the ivoatex Makefile
+PROFILED_TOOLS = ["latexmk", "pdflatex", "bibtex", "xsltproc",
+    "rsvg-convert", "inkscape", "pdf2svg", "convert", "zip", "pdftk",
+    "cc", "gcc"]
+
+# the final LaTeX log asks for another run if one of these is in it
+_RERUN_PATTERN = re.compile(r"Rerun to get|Label\(s\) may have changed")
+
+
+def write_shims(shim_dir, tools, log_path):
+    """writes shims for the tools to shim_dir.
+
+    tools maps tool names to the paths of the real programs.  The shims
+    call this script in --shim mode.
+    """
+    for name, real_path in tools.items():
+        shim_path = os.path.join(shim_dir, name)
+        with open(shim_path, "w") as f:
+            f.write("#!/bin/sh\nexec %s --shim %s -- \"$@\"\n"%(
+                " ".join(shlex.quote(arg) for arg in [
+                    sys.executable, os.path.abspath(__file__)]),
+                " ".join(shlex.quote(arg) for arg in [
+                    name, real_path, log_path])))
+        os.chmod(shim_path, 0o755)
+
+
+def run_shim(name, real_path, log_path, args):
+    """runs real_path with args and appends a record of the call to
+    log_path.
+
+    This returns the program's exit status.
+    """
+    start_time = time.time()
+    try:
+        status = subprocess.call([real_path]+args)
+    except OSError as ex:
+        sys.stderr.write("Cannot run %s: %s\n"%(real_path, ex))
+        status = 127
+    record = {
+        "tool": name,
+        "args": args,
+        "target": os.environ.get("IVOATEX_PROFILE_TARGET", ""),
+        "start": start_time,
+        "seconds": time.time()-start_time,
+        "status": status}
+
+    # a single write with O_APPEND keeps parallel shims from clobbering
+    # each other's records
+    fd = os.open(log_path, os.O_WRONLY|os.O_APPEND|os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (json.dumps(record)+"\n").encode("utf-8"))
+    finally:
+        os.close(fd)
+    return status
+
+
+def read_calls(log_path):
+    """returns the records written by the shims to log_path.
+    """
+    try:
+        with open(log_path, encoding="utf-8") as f:
+            return [json.loads(ln) for ln in f if ln.strip()]
+    except IOError:
+        return []
+
+
+def count_latex_passes(calls, docname):
+    """returns the number of pdflatex runs on docname among the shim
+    records calls.
+    """
+    return sum(1 for call in calls
+        if call["tool"]=="pdflatex"
+            and any(docname in arg for arg in call["args"]))
+
+
+def needs_rerun(log_path):
+    """returns True if the LaTeX log at log_path asks for another run.
+    """
+    try:
+        with open(log_path, encoding="utf-8", errors="replace") as f:
+            return bool(_RERUN_PATTERN.search(f.read()))
+    except IOError:
+        return False
+
+
+def summarise_tools(calls):
+    """returns a dictionary mapping tool names to dictionaries with the
+    number of calls and the total seconds spent in them.
+    """
+    tools = {}
+    for call in calls:
+        stats = tools.setdefault(call["tool"], {"calls": 0, "seconds": 0})
+        stats["calls"] += 1
+        stats["seconds"] += call["seconds"]
+    return tools
+
+
+def profile_build(docname, make_targets, make="make", make_args=()):
+    """builds make_targets with timing shims and returns the report
+    dictionary.
+    """
+    with tempfile.TemporaryDirectory("ivoatex-profile") as shim_dir:
+        log_path = os.path.join(shim_dir, "calls.jsonl")
+        tools = dict((name, shutil.which(name)) for name in PROFILED_TOOLS)
+        tools = dict((name, path) for name, path in tools.items() if path)
+        tools["tth"] = os.path.abspath("ivoatex/tth_C/tth")
+        write_shims(shim_dir, tools, log_path)
+
+        env = dict(os.environ,
+            PATH=shim_dir+os.pathsep+os.environ.get("PATH", ""))
+        targets = []
+        for target in make_targets:
+            env["IVOATEX_PROFILE_TARGET"] = target
+            start_time = time.time()
+            status = subprocess.call([make, target,
+                    "TTH_CMD="+os.path.join(shim_dir, "tth")]
+                +list(make_args), env=env)
+            targets.append({
+                "target": target,
+                "seconds": time.time()-start_time,
+                "status": status})
+            if status:
+                break
+
+        calls = read_calls(log_path)
+
+    for target in targets:
+        target_calls = [c for c in calls if c["target"]==target["target"]]
+        target["tools"] = summarise_tools(target_calls)
+        target["latex_passes"] = count_latex_passes(target_calls, docname)
+
+    return {
+        "docname": docname,
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "targets": targets,
+        "tools": summarise_tools(calls),
+        "latex_passes": count_latex_passes(calls, docname),
+        "needs_rerun": needs_rerun(docname+".log"),
+        "calls": calls}
+
+
+def format_report(report):
+    """returns a plain-text rendering of a profile_build report.
+    """
+    lines = []
+    for target in report["targets"]:
+        lines.append("%-24s %8.2f s%s"%(target["target"], target["seconds"],
+            "" if target["status"]==0 else "  FAILED (%d)"%target["status"]))
+        for name, stats in sorted(target["tools"].items(),
+                key=lambda item: -item[1]["seconds"]):
+            lines.append("    %-20s %8.2f s  (%d call%s)"%(name,
+                stats["seconds"], stats["calls"],
+                "" if stats["calls"]==1 else "s"))
+    lines.append("LaTeX passes: %d%s"%(report["latex_passes"],
+        " (log still asks for a rerun)" if report["needs_rerun"] else ""))
+    return "\n".join(lines)
+
+
+def parse_command_line():
+    import argparse
+    parser = argparse.ArgumentParser(description="Time the build of an"
+        " ivoatex document by make target and external tool.  This is"
+        " normally run through make profile.")
+    parser.add_argument("--docname", required=True,
+        help="The document's DOCNAME.")
+    parser.add_argument("-o", "--output", default=DEFAULT_REPORT,
+        metavar="FILE",
+        help="Where to write the JSON report (default: %(default)s).")
+    parser.add_argument("--targets", nargs="+", metavar="TARGET",
+        help="The make targets to build (default: the PDF, biblio, the"
+            " HTML, and package).")
+    parser.add_argument("--make", default=os.environ.get("MAKE", "make"),
+        help="The make to use (default: %(default)s).")
+    parser.add_argument("--no-clean", action="store_true",
+        help="Do not run make clean before building.")
+    return parser.parse_args()
+
+
+def main():
+    if len(sys.argv)>1 and sys.argv[1]=="--shim":
+        # this is a shim written by write_shims.  We don't go through
+        # argparse here, as the tools' arguments can be anything.
+        name, real_path, log_path = sys.argv[2:5]
+        sys.exit(run_shim(name, real_path, log_path, sys.argv[6:]))
+
+    args = parse_command_line()
+    docname = args.docname
+    make_targets = args.targets or [
+        docname+".pdf", "biblio", docname+".html", "package"]
+    if not args.no_clean:
+        subprocess.call([args.make, "clean"], stdout=subprocess.DEVNULL)
+
+    report = profile_build(docname, make_targets, args.make)
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=1)
+
+    print(format_report(report))
+    print("Report written to %s"%args.output)
+    if any(t["status"] for t in report["targets"]):
+        sys.exit(1)
+
+
+############## Tests (run with python3 -m pytest build-profile.py)
+
+def test_shims(tmp_path):
+    log_path = str(tmp_path/"calls.jsonl")
+    write_shims(str(tmp_path), {"false": shutil.which("false"),
+        "echo": shutil.which("echo")}, log_path)
+    assert subprocess.check_output([str(tmp_path/"echo"), "a b", "--x"]
+        )==b"a b --x\n"
+    assert subprocess.call([str(tmp_path/"false")])==1
+
+    calls = read_calls(log_path)
+    assert [(c["tool"], c["args"], c["status"]) for c in calls]==[
+        ("echo", ["a b", "--x"], 0), ("false", [], 1)]
+
+
+def test_summaries(tmp_path):
+    calls = [
+        {"tool": "latexmk", "args": ["-pdf", "Doc"], "seconds": 3},
+        {"tool": "pdflatex", "args": ["-recorder", "Doc.tex"], "seconds": 1},
+        {"tool": "pdflatex", "args": ["Doc.tex"], "seconds": 1},
+        {"tool": "pdflatex", "args": ["-jobname=fig.tikz", "x"], "seconds": 1},
+        {"tool": "bibtex", "args": ["Doc.aux"], "seconds": 0.5}]
+    assert count_latex_passes(calls, "Doc")==2
+    assert summarise_tools(calls)["pdflatex"]=={"calls": 3, "seconds": 3}
+
+    (tmp_path/"Doc.log").write_text("LaTeX Warning: Label(s) may have"
+        " changed. Rerun to get cross-references right.\n")
+    assert needs_rerun(str(tmp_path/"Doc.log"))
+    assert not needs_rerun(str(tmp_path/"missing.log"))
+
+
+if __name__=="__main__":
+    main()
+
+# vim:et:sw=4:sta
@@ -0,0 +1,459 @@
+#!/usr/bin/python3
+"""
+Converts vector figures on a process pool with a content-addressed cache.
+
+This does what the figure rules in the ivoatex Makefile used to do
+directly:
+
+* X.pdf from X.svg (rsvg-convert or inkscape),
+* X.tikz.pdf from X.tikz.tex (pdflatex with the standalone class),
+* X.tikz.svg from X.tikz.pdf (pdf2svg), and
+* X.png from X.pdf (ImageMagick at 300 dpi).
+
+You give it the files you want; it works out the chains of conversions
+leading to them (e.g., X.svg -> X.pdf -> X.png) and runs independent
+conversions in parallel.  make figures calls this once for all of a
+document's figures with --update, which, like make, skips files newer
+than their sources; the pattern rules convert single files.
+
+Each result is stored in a cache keyed by the sha256 of the source
+file, the files it references (see get_dependencies), and the converter
+command line.  A later conversion with the same key (in another
+checkout, or on a CI runner that restores the cache directory) just
+copies the cached file.  The cache is in .ivoatex-cache/figures unless
+the IVOATEX_FIGURE_CACHE environment variable says otherwise.  If a
+figure depends on files we do not see (e.g., through TeX macros), set
+CONVERT_FIGURES_FLAGS=--no-cache in the document's Makefile.
+
+When svg conversion fails, we use ivoatex/svg-fallback.pdf as before;
+such results are not cached.  The output of failed converters is shown
+on stderr.
+
+This is part of ivoatex, covered by the GPL.  See COPYING for details.
+"""
+
+from concurrent import futures
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import sys
+
+
+DEFAULT_CACHE_DIR = ".ivoatex-cache/figures"
+SVG_FALLBACK = "ivoatex/svg-fallback.pdf"
+
+# command templates; {src}, {dest}, and {stem} (dest without the
+# extension) are filled in.  Changing any of these changes the cache
+# keys.
+CONVERTERS = {
+    "rsvg": ["rsvg-convert", "--output={dest}", "--format=pdf", "{src}"],
+    "inkscape": ["inkscape", "--export-filename={dest}",
+        "--export-type=pdf", "{src}"],
+    "tikz": ["pdflatex", "-interaction", "batchmode", "-jobname={stem}",
+        "\\documentclass[crop,tikz,multi=false]{{standalone}}"
+        "\\begin{{document}}\\input {src}\\end{{document}}"],
+    "pdf2svg": ["pdf2svg", "{src}", "{dest}"],
+    "convert": ["convert", "-density", "300", "-scale", "25%",
+        "{src}", "{dest}"],
+}
+
+
+# references to other files in figure sources, by source extension
+_DEPENDENCY_PATTERNS = {
+    ".svg": re.compile(r"""\bhref\s*=\s*["']([^"'#:]+)["']"""),
+    ".tex": re.compile(r"\\(?:input|include|includegraphics)\s*"
+        r"(?:\[[^\]]*\])?\{([^}]+)\}"),
+}
+
+
+class ConversionError(Exception):
+    """raised when a file cannot be made.
+    """
+
+
+def get_source(target, svg_engine="rsvg"):
+    """returns a pair of the converter name and the source for making
+    target, or None if we do not know how to make target.
+
+    This mirrors the pattern rules in the ivoatex Makefile.
+    """
+    if target.endswith(".tikz.pdf"):
+        return "tikz", target[:-4]+".tex"
+    elif target.endswith(".tikz.svg"):
+        return "pdf2svg", target[:-4]+".pdf"
+    elif target.endswith(".pdf"):
+        return svg_engine, target[:-4]+".svg"
+    elif target.endswith(".png"):
+        return "convert", target[:-4]+".pdf"
+    return None
+
+
+def is_current(target, source):
+    """returns True if target is newer than source and the files source
+    references.
+    """
+    target_time = os.path.getmtime(target)
+    return all(os.path.getmtime(path)<=target_time
+        for path in [source]+get_dependencies(source))
+
+
+def plan_conversions(targets, svg_engine="rsvg", exists=os.path.exists,
+        is_current=None):
+    """returns a list of stages of conversions needed to make targets.
+
+    Each stage is a list of (converter, source, target) triples that can
+    run in parallel; they only depend on the results of earlier stages.
+    Sources that exist and are not among targets are used as they are.
+    For sources that do not, we look for a conversion producing them.
+    If that fails, a ConversionError is raised.
+
+    With an is_current function (see the function of that name), we
+    work like make: existing targets for which is_current(target,
+    source) is true are skipped unless their source is remade, and
+    existing sources we know how to make are checked in the same way.
+    """
+    requested, depths = set(targets), {}
+
+    def must_plan(source):
+        if not exists(source) or source in requested:
+            return True
+        if is_current is not None:
+            conversion = get_source(source, svg_engine)
+            return conversion is not None and exists(conversion[1])
+        return False
+
+    def plan(target, seen):
+        # returns the stage target is made in, or None if it is current
+        if target in depths:
+            return depths[target] and depths[target][0]
+        if target in seen:
+            raise ConversionError("Circular conversion for %s"%target)
+        conversion = get_source(target, svg_engine)
+        if conversion is None:
+            raise ConversionError("Don't know how to make %s"%target)
+        converter, source = conversion
+
+        source_depth = None
+        if must_plan(source):
+            if not exists(source) and get_source(source, svg_engine) is None:
+                raise ConversionError("Cannot make %s: %s is missing"%(
+                    target, source))
+            source_depth = plan(source, seen|{target})
+
+        if (source_depth is None and is_current is not None
+                and exists(target) and is_current(target, source)):
+            depths[target] = None
+            return None
+        depth = 0 if source_depth is None else source_depth+1
+        depths[target] = (depth, converter, source)
+        return depth
+
+    for target in targets:
+        plan(target, set())
+
+    depths = dict((t, d) for t, d in depths.items() if d is not None)
+    stages = [[] for _ in range(max([d[0] for d in depths.values()],
+        default=-1)+1)]
+    for target, (depth, converter, source) in sorted(depths.items()):
+        stages[depth].append((converter, source, target))
+    return stages
+
+
+def make_command(template, source, target):
+    """returns the argument list for running the command template
+    from CONVERTERS on source to produce target.
+    """
+    values = {"src": source, "dest": target,
+        "stem": os.path.splitext(target)[0]}
+    return [arg.format(**values) for arg in template]
+
+
+def get_dependencies(source):
+    """returns the paths of the existing local files that source
+    references.
+
+    These are images linked from svg files and files \\input,
+    \\include-d, or \\includegraphics-ed from TikZ sources.  We do not
+    look for references in the referenced files.
+    """
+    pattern = _DEPENDENCY_PATTERNS.get(os.path.splitext(source)[1])
+    if pattern is None:
+        return []
+    with open(source, encoding="utf-8", errors="replace") as f:
+        names = pattern.findall(f.read())
+
+    dependencies = []
+    for name in names:
+        for candidate in [name, name+".tex"]:
+            path = os.path.join(os.path.dirname(source), candidate.strip())
+            if os.path.isfile(path):
+                dependencies.append(path)
+                break
+    return sorted(set(dependencies))
+
+
+def get_cache_key(template, source):
+    """returns the cache key for converting source with the command
+    template.
+    """
+    hash = hashlib.sha256("\0".join(template).encode("utf-8")+b"\0")
+    # the names of dependencies matter, the name of the source does not
+    for name, path in [("", source)]+[
+            (os.path.basename(p), p) for p in get_dependencies(source)]:
+        hash.update(name.encode("utf-8")+b"\0")
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1<<16), b""):
+                hash.update(chunk)
+    return hash.hexdigest()
+
+
+def get_cache_path(cache_dir, key, target):
+    """returns the path of the cached result for key.
+    """
+    return os.path.join(cache_dir, key[:2],
+        key+os.path.splitext(target)[1])
+
+
+def convert(template, source, target, cache_dir=None):
+    """converts source to target using the command template.
+
+    With a cache_dir, results are taken from and stored in the cache.
+    This returns one of "cached", "converted", and "fallback" and raises
+    a ConversionError if target cannot be made.
+    """
+    cache_path = None
+    if cache_dir:
+        cache_path = get_cache_path(cache_dir,
+            get_cache_key(template, source), target)
+        if os.path.exists(cache_path):
+            shutil.copyfile(cache_path, target)
+            return "cached"
+
+    try:
+        proc = subprocess.run(make_command(template, source, target),
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        status, output = proc.returncode, proc.stdout
+    except OSError as ex:
+        status, output = 127, ("Cannot run %s: %s\n"%(
+            template[0], ex)).encode("utf-8")
+
+    if status or not os.path.exists(target):
+        sys.stderr.write("%s failed making %s:\n%s"%(template[0], target,
+            output.decode("utf-8", "replace")))
+        if template[0]=="pdflatex":
+            sys.stderr.write("See %s.log for details.\n"%(
+                os.path.splitext(target)[0]))
+        if target.endswith(".pdf") and source.endswith(".svg"
+                ) and os.path.exists(SVG_FALLBACK):
+            shutil.copyfile(SVG_FALLBACK, target)
+            return "fallback"
+        raise ConversionError("%s failed making %s"%(template[0], target))
+
+    if cache_path:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_name = "%s.%d.tmp"%(cache_path, os.getpid())
+        shutil.copyfile(target, tmp_name)
+        os.replace(tmp_name, cache_path)
+    return "converted"
+
+
+def run_stages(stages, converters, cache_dir, n_workers):
+    """runs the conversions planned by plan_conversions on a pool of
+    n_workers processes.
+
+    This returns a dictionary mapping targets to their convert results
+    (or exceptions).  After a failure, later stages are not run.  With a
+    single conversion or worker, everything runs in this process.
+    """
+    results = {}
+    if n_workers==1 or sum(len(stage) for stage in stages)<2:
+        for stage in stages:
+            for converter, source, target in stage:
+                try:
+                    results[target] = convert(converters[converter],
+                        source, target, cache_dir)
+                except ConversionError as ex:
+                    results[target] = ex
+            if any(isinstance(r, Exception) for r in results.values()):
+                break
+        return results
+
+    with futures.ProcessPoolExecutor(n_workers) as pool:
+        for stage in stages:
+            jobs = dict((pool.submit(convert, converters[converter],
+                    source, target, cache_dir), target)
+                for converter, source, target in stage)
+            for job in futures.as_completed(jobs):
+                try:
+                    results[jobs[job]] = job.result()
+                except ConversionError as ex:
+                    results[jobs[job]] = ex
+            if any(isinstance(r, Exception) for r in results.values()):
+                break
+    return results
+
+
+def parse_command_line():
+    import argparse
+    parser = argparse.ArgumentParser(description="Convert figures for"
+        " ivoatex documents in parallel, reusing earlier results.")
+    parser.add_argument("targets", nargs="+", metavar="FILE",
+        help="The files to make (e.g., arch.pdf arch.png).")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+        help="Number of conversions to run in parallel"
+            " (default: %(default)s).")
+    parser.add_argument("--svg-engine", choices=["rsvg", "inkscape"],
+        default="rsvg",
+        help="The program converting svg to pdf (default: %(default)s).")
+    parser.add_argument("--convert", default=None, metavar="PROGRAM",
+        help="ImageMagick's convert program (default: convert).")
+    parser.add_argument("--no-cache", action="store_true",
+        help="Neither use nor fill the figure cache.")
+    parser.add_argument("--update", action="store_true",
+        help="Like make, only convert files older than their sources"
+            " (make figures uses this).")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_command_line()
+    converters = dict(CONVERTERS)
+    if args.convert:
+        converters["convert"] = args.convert.split(
+            )+CONVERTERS["convert"][1:]
+    cache_dir = None if args.no_cache else os.environ.get(
+        "IVOATEX_FIGURE_CACHE", DEFAULT_CACHE_DIR)
+
+    try:
+        stages = plan_conversions(args.targets, args.svg_engine,
+            is_current=is_current if args.update else None)
+    except ConversionError as ex:
+        sys.exit(str(ex))
+
+    results = run_stages(stages, converters, cache_dir, args.jobs)
+    failed = False
+    for target, result in sorted(results.items()):
+        if isinstance(result, Exception):
+            sys.stderr.write("%s\n"%result)
+            failed = True
+        else:
+            print("%s: %s"%(target, result))
+    if failed:
+        sys.exit(1)
+
+
+############## Tests (run with python3 -m pytest convert-figures.py)
+
+def test_plan():
+    existing = {"a.svg", "b.tikz.tex", "c.pdf"}
+    assert plan_conversions(["a.png", "a.pdf", "b.tikz.svg", "c.png"],
+        exists=existing.__contains__)==[
+            [("rsvg", "a.svg", "a.pdf"),
+                ("tikz", "b.tikz.tex", "b.tikz.pdf"),
+                ("convert", "c.pdf", "c.png")],
+            [("convert", "a.pdf", "a.png"),
+                ("pdf2svg", "b.tikz.pdf", "b.tikz.svg")]]
+
+
+def test_plan_chains():
+    existing = {"a.svg", "a.pdf", "a.png", "b.svg", "b.pdf", "c.svg"}
+    assert plan_conversions(["a.pdf", "a.png"],
+        exists=existing.__contains__)==[
+            [("rsvg", "a.svg", "a.pdf")], [("convert", "a.pdf", "a.png")]]
+
+    # only b.pdf is older than its source
+    current = {("a.pdf", "a.svg"), ("a.png", "a.pdf"), ("b.png", "b.pdf")}
+    assert plan_conversions(["a.png", "b.png", "c.pdf"],
+        exists=existing.__contains__,
+        is_current=lambda t, s: (t, s) in current)==[
+            [("rsvg", "b.svg", "b.pdf"), ("rsvg", "c.svg", "c.pdf")],
+            [("convert", "b.pdf", "b.png")]]
+
+
+def test_plan_errors():
+    import pytest
+    with pytest.raises(ConversionError):
+        plan_conversions(["x.png"], exists=lambda p: False)
+    with pytest.raises(ConversionError):
+        plan_conversions(["x.gif"], exists=lambda p: True)
+
+
+def test_make_command():
+    assert make_command(CONVERTERS["tikz"], "b.tikz.tex", "b.tikz.pdf")[-2:]==[
+        "-jobname=b.tikz", "\\documentclass[crop,tikz,multi=false]{standalone}"
+        "\\begin{document}\\input b.tikz.tex\\end{document}"]
+
+
+def test_cache(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    cache_dir = str(tmp_path/"cache")
+    # a converter that records its runs
+    template = [sys.executable, "-c", "import sys;"
+        "open(sys.argv[2], 'w').write(open(sys.argv[1]).read().upper());"
+        "open('runs', 'a').write('x')", "{src}", "{dest}"]
+
+    with open("a.svg", "w") as f:
+        f.write("figure")
+    assert convert(template, "a.svg", "a.pdf", cache_dir)=="converted"
+    os.unlink("a.pdf")
+    assert convert(template, "a.svg", "a.pdf", cache_dir)=="cached"
+    with open("a.pdf") as f:
+        assert f.read()=="FIGURE"
+
+    # the same figure somewhere else is still cached...
+    shutil.copy("a.svg", "b.svg")
+    assert convert(template, "b.svg", "b.pdf", cache_dir)=="cached"
+    # ...but a changed one is not.
+    with open("a.svg", "w") as f:
+        f.write("changed")
+    assert convert(template, "a.svg", "a.pdf", cache_dir)=="converted"
+    with open("runs") as f:
+        assert f.read()=="xx"
+
+
+def test_dependencies(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with open("fig.tikz.tex", "w") as f:
+        f.write("\\input{styles}\\includegraphics[width=1cm]{logo.png}"
+            "\\input{missing}")
+    with open("fig.svg", "w") as f:
+        f.write('<svg><image xlink:href="logo.png"/><a href="#x"/>'
+            '<image href="http://x.org/y.png"/></svg>')
+    for name in ["styles.tex", "logo.png"]:
+        with open(name, "w") as f:
+            f.write("a")
+    assert get_dependencies("fig.tikz.tex")==["logo.png", "styles.tex"]
+    assert get_dependencies("fig.svg")==["logo.png"]
+
+    template = CONVERTERS["tikz"]
+    key = get_cache_key(template, "fig.tikz.tex")
+    with open("styles.tex", "w") as f:
+        f.write("b")
+    assert get_cache_key(template, "fig.tikz.tex")!=key
+
+
+def test_failure(tmp_path, monkeypatch, capsys):
+    import pytest
+    monkeypatch.chdir(tmp_path)
+    (tmp_path/"a.pdf").write_text("")
+    with pytest.raises(ConversionError):
+        convert([sys.executable, "-c", "print('bad figure'); raise SystemExit(1)"],
+            "a.pdf", "a.png", str(tmp_path/"cache"))
+    assert not (tmp_path/"cache").exists()
+    assert "bad figure" in capsys.readouterr().err
+
+
+def test_run_inline(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path/"a.pdf").write_text("a")
+    monkeypatch.setattr(futures, "ProcessPoolExecutor", None)
+    assert run_stages([[("copy", "a.pdf", "a.png")]], {"copy": ["cp", "{src}",
+        "{dest}"]}, None, 4)=={"a.png": "converted"}
+
+
+if __name__=="__main__":
+    main()
+
+# vim:et:sw=4:sta
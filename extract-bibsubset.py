@@ -0,0 +1,255 @@
+#!/usr/bin/python3
+"""
+Writes BibTeX files containing only the entries a document cites.
+
+This reads the \\citation and \\bibdata lines from an .aux file produced
+by a LaTeX run and, for each BibTeX file in \\bibdata, writes a file of
+the same (relative) name below a destination directory.  These contain
+the cited entries plus what they need: entries they crossref, the
+@string definitions they (or these) use, and all @preamble-s.
+
+Putting the destination directory in front of BIBINPUTS then has BibTeX
+read the subsets rather than the full ivoabib.bib and docrepo.bib.
+This is what make biblio does.
+
+Files are only written when their content changes, so make and latexmk
+do not see spurious updates.  With \\nocite{*}, the BibTeX files are
+copied unchanged.
+
+This is part of ivoatex, covered by the GPL.  See COPYING for details.
+"""
+
+import os
+import sys
+
+from bibtools import (BibError, BibIndex, get_bib_names, get_cited_keys,
+    get_macro_refs, iter_aux_lines, parse_string)
+
+
+DEFAULT_DEST_DIR = ".ivoatex-cache/bibsubset"
+
+
+def _strip_delimiters(value):
+    if value[:1] in '{"' and value[-1:] in '}"':
+        return value[1:-1].strip()
+    return value
+
+
+def select_spans(indexes, cited_keys):
+    """returns, for each BibIndex in indexes, a sorted list of the byte
+    spans to copy to the subset for cited_keys.
+
+    As with BibTeX, a key is taken from the first index containing it,
+    keys match case-insensitively, and @string-s are shared between
+    all files.
+    """
+    selected = [set(index.preamble_spans) for index in indexes]
+    pending_keys, seen_keys = list(cited_keys), set()
+    pending_macros, seen_macros = [], set()
+
+    while pending_keys:
+        key = pending_keys.pop()
+        if key.lower() in seen_keys:
+            continue
+        seen_keys.add(key.lower())
+
+        for index, spans in zip(indexes, selected):
+            real_key = index.find(key)
+            if real_key is not None:
+                spans.add(index.spans[real_key])
+                fields = index.get_fields(real_key)
+                if "crossref" in fields:
+                    pending_keys.append(_strip_delimiters(fields["crossref"]))
+                for value in fields.values():
+                    pending_macros.extend(get_macro_refs(value))
+                break
+
+    while pending_macros:
+        name = pending_macros.pop().lower()
+        if name in seen_macros:
+            continue
+        seen_macros.add(name)
+
+        for index, spans in zip(indexes, selected):
+            if name in index.string_spans:
+                spans.add(index.string_spans[name])
+                pending_macros.extend(get_macro_refs(
+                    parse_string(index.get_string_source(name))[1]))
+
+    return [sorted(spans) for spans in selected]
+
+
+def make_subset_source(index, spans):
+    """returns BibTeX source with the entries at spans in index's file.
+    """
+    with open(index.bib_path, "rb") as f:
+        source = f.read()
+    return ("Cited entries from %s, extracted by extract-bibsubset.py.\n"
+        "Do not edit.\n\n"%os.path.basename(index.bib_path)
+        ).encode("utf-8")+b"\n\n".join(
+            source[start:end] for start, end in spans)+b"\n"
+
+
+def write_if_changed(dest_path, content):
+    """writes the bytes content to dest_path unless the file already has
+    this content.
+
+    This returns True if the file was written.
+    """
+    try:
+        with open(dest_path, "rb") as f:
+            if f.read()==content:
+                return False
+    except IOError:
+        pass
+
+    os.makedirs(os.path.dirname(dest_path) or ".", exist_ok=True)
+    tmp_name = dest_path+".tmp"
+    with open(tmp_name, "wb") as f:
+        f.write(content)
+    os.replace(tmp_name, dest_path)
+    return True
+
+
+def extract_subsets(aux_path, dest_dir):
+    """writes BibTeX subsets for the document with the aux file aux_path
+    to dest_dir.
+
+    This returns a list of (bib_path, n_entries, n_selected) tuples for
+    the BibTeX files processed.
+    """
+    aux_lines = list(iter_aux_lines(aux_path))
+    cited_keys = get_cited_keys(aux_lines)
+    base_dir = os.path.dirname(aux_path)
+
+    bib_names, indexes = [], []
+    for bib_name in get_bib_names(aux_lines):
+        bib_path = os.path.join(base_dir, bib_name+".bib")
+        if not os.path.exists(bib_path):
+            # BibTeX will find this somewhere else; we cannot subset it.
+            sys.stderr.write("extract-bibsubset: %s not found, skipping\n"%
+                bib_path)
+            continue
+        bib_names.append(bib_name)
+        indexes.append(BibIndex(bib_path))
+
+    copy_all = "*" in cited_keys
+    if copy_all:
+        selections = [None]*len(indexes)
+    else:
+        selections = select_spans(indexes, cited_keys)
+
+    stats = []
+    for bib_name, index, spans in zip(bib_names, indexes, selections):
+        if copy_all:
+            with open(index.bib_path, "rb") as f:
+                content = f.read()
+            n_selected = len(index)
+        else:
+            content = make_subset_source(index, spans)
+            entry_spans = set(index.spans.values())
+            n_selected = sum(1 for span in spans if span in entry_spans)
+        write_if_changed(os.path.join(dest_dir, bib_name+".bib"), content)
+        stats.append((index.bib_path, len(index), n_selected))
+    return stats
+
+
+def parse_command_line():
+    import argparse
+    parser = argparse.ArgumentParser(description="Write BibTeX files"
+        " containing only the entries cited in a LaTeX document.  This is"
+        " normally run through make biblio.")
+    parser.add_argument("aux_file",
+        help="The .aux file of the document.")
+    parser.add_argument("--dest", dest="dest_dir", default=DEFAULT_DEST_DIR,
+        metavar="DIR",
+        help="Directory to write the subsets to (default: %(default)s).")
+    parser.add_argument("-v", "--verbose", action="store_true",
+        dest="verbose",
+        help="Report how many entries went into each subset.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_command_line()
+    try:
+        stats = extract_subsets(args.aux_file, args.dest_dir)
+    except (IOError, BibError) as ex:
+        sys.exit(f"extract-bibsubset: {ex}")
+
+    if args.verbose:
+        for bib_path, n_entries, n_selected in stats:
+            print(f"{bib_path}: {n_selected} of {n_entries} entries")
+
+
+############## Tests (run with python3 -m pytest extract-bibsubset.py)
+
+_TEST_BIB = r"""@preamble{"\def\x{x}"}
+@string{ivoa = "IVOA"}
+@string{ivoadoc = ivoa # " Document"}
+@string{unused = "Unused"}
+
+@misc{child,
+  title = {Child},
+  note = ivoadoc,
+  crossref = {parent}
+}
+
+@misc{uncited, title = {Uncited}}
+
+@misc{Parent, title = {Parent}, month = jul}
+"""
+
+
+def _make_document(tmp_path, citations):
+    (tmp_path/"ivoatex").mkdir()
+    (tmp_path/"ivoatex"/"test.bib").write_text(_TEST_BIB)
+    (tmp_path/"ivoatex"/"other.bib").write_text(
+        "@misc{fromother, title = ivoa}\n@misc{child, title={Shadowed}}\n")
+    (tmp_path/"doc.aux").write_text("\\relax\n"
+        + "".join("\\citation{%s}\n"%c for c in citations)
+        + "\\@input{chapter.aux}\n"
+        + "\\bibdata{ivoatex/test,ivoatex/other,ivoatex/missing}\n")
+    (tmp_path/"chapter.aux").write_text("\\citation{fromother}\n")
+    return str(tmp_path/"doc.aux")
+
+
+def test_subset(tmp_path, monkeypatch):
+    monkeypatch.setenv("IVOATEX_BIBINDEX_DIR", str(tmp_path))
+    aux_path = _make_document(tmp_path, ["child"])
+    dest_dir = tmp_path/"subset"
+    assert [s[1:] for s in extract_subsets(aux_path, str(dest_dir))]==[
+        (3, 2), (2, 1)]
+
+    subset = (dest_dir/"ivoatex"/"test.bib").read_text()
+    for expected in ["@preamble", "@string{ivoa =", "@string{ivoadoc",
+            "@misc{child", "@misc{Parent"]:
+        assert expected in subset
+    assert "uncited" not in subset and "unused" not in subset
+    assert subset.index("@misc{child")<subset.index("@misc{Parent")
+
+    other = (dest_dir/"ivoatex"/"other.bib").read_text()
+    assert "fromother" in other and "Shadowed" not in other
+
+
+def test_unchanged_not_written(tmp_path, monkeypatch):
+    monkeypatch.setenv("IVOATEX_BIBINDEX_DIR", str(tmp_path))
+    aux_path = _make_document(tmp_path, ["child", "uncited"])
+    subset_path = tmp_path/"subset"/"ivoatex"/"test.bib"
+    extract_subsets(aux_path, str(tmp_path/"subset"))
+    os.utime(subset_path, (0, 0))
+    extract_subsets(aux_path, str(tmp_path/"subset"))
+    assert os.path.getmtime(subset_path)==0
+
+
+def test_nocite_all(tmp_path, monkeypatch):
+    monkeypatch.setenv("IVOATEX_BIBINDEX_DIR", str(tmp_path))
+    aux_path = _make_document(tmp_path, ["*"])
+    extract_subsets(aux_path, str(tmp_path/"subset"))
+    assert (tmp_path/"subset"/"ivoatex"/"test.bib").read_text()==_TEST_BIB
+
+
+if __name__=="__main__":
+    main()
+
+# vim:et:sw=4:sta
@@ -7,21 +7,43 @@ environment variable ADS_TOKEN.
 
 If successful, it will write BibTeX to docrepo.bib (as needed by ivoatex).
 
+The search results are retrieved in pages of PAGE_SIZE records, and the
+BibTeX is exported in chunks of EXPORT_CHUNK_SIZE bibcodes; both happen
+in parallel.  With --incremental, only records with bibcodes not yet in
+docrepo.bib are exported and merged into the existing records.
+
+docrepo.bib is written in canonical form (see
+bibtools.canonicalise_bibtex): sorted by bibcode, without duplicates,
+with normalised whitespace, and with a content hash in the header.
+The file is only replaced if that hash changes.  To canonicalise an
+existing file without talking to ADS, use --canonicalise.
+
+To test against something else than the real ADS, set ADS_API_URL.
+
 Copyright 2020, the GAVO project
 
 This is part of ivoatex, covered by the GPL.  See COPYING for details.
 """
 
+from concurrent import futures
+import io
 import json
 import os
+import sys
 from urllib import parse, request
 
-API_URL = "https://api.adsabs.harvard.edu/v1/"
+from bibtools import (canonicalise_bibtex, extract_content_hash,
+    get_content_hash, iter_entry_spans)
 
-try:
-    ADS_TOKEN = os.environ["ADS_TOKEN"]
-except KeyError:
-    sys.exit("No ADS_TOKEN defined.  Get an ADS API key and put it there.")
+API_URL = os.environ.get("ADS_API_URL", "https://api.adsabs.harvard.edu/v1/")
+ADS_TOKEN = None
+
+QUERY = "bibstem:(ivoa.spec or ivoa.rept)"
+# a stable order is essential for paging
+SORT_ORDER = "date desc,bibcode desc"
+PAGE_SIZE = 200
+EXPORT_CHUNK_SIZE = 200
+DEFAULT_WORKERS = 4
 
 
 def do_api_request(_path, _payload=None, **arguments):
@@ -33,26 +55,308 @@ def do_api_request(_path, _payload=None, **arguments):
     # Yeah, I know, I could save this with requests; but it'd be an
     # extra dependency, and avoiding that is worth a few lines.
     auth_header = {"Authorization": "Bearer %s"%ADS_TOKEN}
+    if _payload is not None:
+        auth_header["Content-Type"] = "application/json"
     req = request.Request(
         API_URL+_path+"?"+parse.urlencode(arguments),
         _payload,
         auth_header)
-    f = request.urlopen(req)
-    return json.load(f)
+    with request.urlopen(req) as f:
+        return json.load(f)
+
+
+def fetch_bibcode_page(start, rows=PAGE_SIZE):
+    """returns the total number of matches and the bibcodes in the page of
+    rows search results starting at start.
+    """
+    res = do_api_request("search/query",
+        q=QUERY,
+        sort=SORT_ORDER,
+        start=str(start),
+        rows=str(rows),
+        fl="bibcode")["response"]
+    return res["numFound"], [r["bibcode"] for r in res["docs"]]
+
+
+def fetch_bibcodes(pool, page_size=PAGE_SIZE):
+    """returns the bibcodes of all IVOA documents known to ADS.
+
+    The first page tells us how many pages there are; these are then
+    retrieved in parallel on the executor pool.
+    """
+    num_found, bibcodes = fetch_bibcode_page(0, page_size)
+    for _, page in pool.map(
+            lambda start: fetch_bibcode_page(start, page_size),
+            range(page_size, num_found, page_size)):
+        bibcodes.extend(page)
+
+    if len(bibcodes)!=num_found:
+        raise IOError("ADS announced %d records but returned %d"%(
+            num_found, len(bibcodes)))
+    return bibcodes
+
+
+def export_bibtex(bibcodes):
+    """returns BibTeX for bibcodes as exported by ADS.
+    """
+    return do_api_request("export/bibtex",
+        _payload=json.dumps({"bibcode": bibcodes}).encode("ascii"))["export"]
+
+
+def fetch_bibtex(pool, bibcodes, chunk_size=EXPORT_CHUNK_SIZE):
+    """returns the BibTeX for bibcodes, in the order of bibcodes.
+
+    The export is done in chunks of at most chunk_size bibcodes, in
+    parallel on the executor pool.
+    """
+    chunks = [bibcodes[offset:offset+chunk_size]
+        for offset in range(0, len(bibcodes), chunk_size)]
+    return "".join(
+        source.rstrip()+"\n\n" for source in pool.map(export_bibtex, chunks))
+
+
+def get_bibcodes_in(source):
+    """returns the set of citation keys in the BibTeX source (a string).
+
+    For ADS BibTeX, these are the bibcodes.
+    """
+    return set(key
+        for kind, key, _, _ in iter_entry_spans(
+            io.BytesIO(source.encode("utf-8")))
+        if kind not in ("string", "preamble", "comment"))
+
+
+DOCREPO_TITLE = ("IVOA documents as known to ADS.  Generated by"
+    " fetch_from_ads.py; do not edit.")
+
+
+def write_canonical(dest_path, source):
+    """writes the BibTeX in source to dest_path in canonical form.
+
+    The file is only written if the content hash (see
+    bibtools.canonicalise_bibtex) changes, so things depending on
+    dest_path are not rebuilt needlessly.  This returns True if the
+    file was written.
+    """
+    canonical = canonicalise_bibtex(source, DOCREPO_TITLE)
+    if get_content_hash(dest_path)==extract_content_hash(canonical):
+        return False
+
+    tmp_name = dest_path+".tmp"
+    with open(tmp_name, "w", encoding="utf-8") as f:
+        f.write(canonical)
+    os.replace(tmp_name, dest_path)
+    return True
+
+
+def update_docrepo(dest_path, incremental=False, n_workers=DEFAULT_WORKERS):
+    """fetches the IVOA records from ADS and writes them to dest_path.
+
+    With incremental, only records not yet in dest_path are fetched and
+    merged in.  This returns the number of records exported from ADS.
+    """
+    existing = ""
+    if incremental and os.path.exists(dest_path):
+        with open(dest_path, encoding="utf-8") as f:
+            existing = f.read()
+
+    with futures.ThreadPoolExecutor(n_workers) as pool:
+        bibcodes = fetch_bibcodes(pool)
+        if incremental:
+            known = get_bibcodes_in(existing)
+            bibcodes = [b for b in bibcodes if b not in known]
+        new = fetch_bibtex(pool, bibcodes) if bibcodes else ""
+
+    write_canonical(dest_path, existing+"\n"+new)
+    return len(bibcodes)
+
+
+def parse_command_line():
+    import argparse
+    parser = argparse.ArgumentParser(description="Fetch the IVOA"
+        " records from ADS into docrepo.bib.  This needs an ADS API key"
+        " in the ADS_TOKEN environment variable.")
+    parser.add_argument("--incremental", action="store_true",
+        dest="incremental",
+        help="Only fetch records not yet in the destination file and"
+            " add them to it.")
+    parser.add_argument("-j", "--jobs", type=int, default=DEFAULT_WORKERS,
+        dest="n_workers", metavar="N",
+        help="Number of ADS requests to run in parallel"
+            " (default: %(default)s).")
+    parser.add_argument("-o", "--output", default="docrepo.bib",
+        dest="dest_path", metavar="FILE",
+        help="File to write to (default: %(default)s).")
+    parser.add_argument("--canonicalise", action="store_true",
+        dest="canonicalise",
+        help="Do not contact ADS; just rewrite the destination file in"
+            " canonical form.")
+    return parser.parse_args()
 
 
 def main():
-    bibcode_recs = do_api_request("search/query",
-        q="bibstem:(ivoa.spec or ivoa.rept)",
-        rows="500",
-        fl="bibcode")
-
-    bibtex_args = {
-        "bibcode": [r["bibcode"] for r in bibcode_recs["response"]["docs"]],}
-    bibtex_recs = do_api_request("export/bibtex",
-        _payload=json.dumps(bibtex_args).encode("ascii"))
-    with open("docrepo.bib", "w") as f:
-        f.write(bibtex_recs["export"])
+    global ADS_TOKEN
+    args = parse_command_line()
+    if args.canonicalise:
+        with open(args.dest_path, encoding="utf-8") as f:
+            if not write_canonical(args.dest_path, f.read()):
+                print("%s is already canonical"%args.dest_path)
+        return
+
+    try:
+        ADS_TOKEN = os.environ["ADS_TOKEN"]
+    except KeyError:
+        sys.exit("No ADS_TOKEN defined.  Get an ADS API key and put it there.")
+
+    try:
+        n_exported = update_docrepo(args.dest_path,
+            args.incremental, args.n_workers)
+    except IOError as ex:
+        sys.exit("Fetching from ADS failed: %s"%ex)
+    print("%d record(s) exported from ADS"%n_exported)
+
+
+############## Tests (run with python3 -m pytest fetch_from_ads.py)
+
+def _make_mock_record(bibcode):
+    return ("@MISC{%s,\n"
+        '        title = "{Record %s}",\n'
+        "         year = %s,\n"
+        "}\n"%(bibcode, bibcode, bibcode[:4]))
+
+
+class _MockADS:
+    """a context manager running a minimal imitation of the ADS search and
+    export APIs on a local port, with API_URL pointing there.
+
+    bibcodes are what the search returns.  The requests received are
+    collected in the requests attribute as (path, arguments) pairs.
+    """
+    def __init__(self, bibcodes):
+        self.bibcodes, self.requests = bibcodes, []
+
+    def __enter__(self):
+        import threading
+        from http import server
+        mock = self
+
+        class Handler(server.BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def send_json(self, payload):
+                if self.headers["Authorization"]!="Bearer test-token":
+                    self.send_error(401)
+                    return
+                payload = json.dumps(payload).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                url = parse.urlparse(self.path)
+                args = dict(parse.parse_qsl(url.query))
+                mock.requests.append((url.path, args))
+                start, rows = int(args["start"]), int(args["rows"])
+                self.send_json({"response": {
+                    "numFound": len(mock.bibcodes),
+                    "start": start,
+                    "docs": [{"bibcode": b}
+                        for b in mock.bibcodes[start:start+rows]]}})
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(
+                    int(self.headers["Content-Length"])))
+                mock.requests.append((parse.urlparse(self.path).path,
+                    payload))
+                self.send_json({"export": "\n".join(
+                    _make_mock_record(b) for b in payload["bibcode"])})
+
+        self.server = server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever,
+            kwargs={"poll_interval": 0.05}, daemon=True).start()
+        global API_URL, ADS_TOKEN
+        self.saved = API_URL, ADS_TOKEN
+        API_URL = "http://127.0.0.1:%d/"%self.server.server_address[1]
+        ADS_TOKEN = "test-token"
+        return self
+
+    def __exit__(self, *exc_info):
+        global API_URL, ADS_TOKEN
+        API_URL, ADS_TOKEN = self.saved
+        self.server.shutdown()
+        self.server.server_close()
+
+
+_MOCK_BIBCODES = ["20%02divoa.spec.%04dX"%(25-i//10, 1000+i)
+    for i in range(45)]
+
+
+def test_paginated():
+    with _MockADS(_MOCK_BIBCODES) as mock:
+        with futures.ThreadPoolExecutor(3) as pool:
+            assert fetch_bibcodes(pool, 10)==_MOCK_BIBCODES
+    assert sorted(int(args["start"]) for _, args in mock.requests)==[
+        0, 10, 20, 30, 40]
+    assert mock.requests[0][1]["sort"]==SORT_ORDER
+
+
+def test_chunked_export():
+    with _MockADS(_MOCK_BIBCODES) as mock:
+        with futures.ThreadPoolExecutor(3) as pool:
+            source = fetch_bibtex(pool, _MOCK_BIBCODES, chunk_size=20)
+    assert sorted(len(payload["bibcode"])
+        for path, payload in mock.requests)==[5, 20, 20]
+    assert [key for _, key, _, _ in iter_entry_spans(
+        io.BytesIO(source.encode("utf-8")))]==_MOCK_BIBCODES
+
+
+def test_full_and_incremental(tmp_path):
+    dest_path = str(tmp_path/"docrepo.bib")
+    with _MockADS(_MOCK_BIBCODES[10:]) as mock:
+        assert update_docrepo(dest_path)==35
+    with open(dest_path, encoding="utf-8") as f:
+        old_source = f.read()
+    assert get_bibcodes_in(old_source)==set(_MOCK_BIBCODES[10:])
+
+    with _MockADS(_MOCK_BIBCODES) as mock:
+        assert update_docrepo(dest_path, incremental=True)==10
+    exported = [b for path, payload in mock.requests
+        if path=="/export/bibtex" for b in payload["bibcode"]]
+    assert exported==_MOCK_BIBCODES[:10]
+
+    with open(dest_path, encoding="utf-8") as f:
+        new_source = f.read()
+    assert [key for _, key, _, _ in iter_entry_spans(
+        io.BytesIO(new_source.encode("utf-8")))]==sorted(_MOCK_BIBCODES)
+
+    # nothing new: nothing exported, file not touched
+    os.utime(dest_path, (0, 0))
+    with _MockADS(_MOCK_BIBCODES) as mock:
+        assert update_docrepo(dest_path, incremental=True)==0
+    assert os.path.getmtime(dest_path)==0
+
+
+def test_canonical_write(tmp_path):
+    dest_path = str(tmp_path/"docrepo.bib")
+    records = [_make_mock_record(b) for b in _MOCK_BIBCODES[:3]]
+    assert write_canonical(dest_path, "".join(records))
+    # order, duplicates and whitespace do not matter
+    assert not write_canonical(dest_path, "".join(reversed(records))
+        +records[1].replace(" = ", "  =  "))
+    assert write_canonical(dest_path, "".join(records[:2]))
+
+
+def test_truncated_search(monkeypatch):
+    import pytest
+    # pretend the record count changed while we were paging
+    monkeypatch.setattr(sys.modules[__name__], "fetch_bibcode_page",
+        lambda start, rows: (45, _MOCK_BIBCODES[:30][start:start+rows]))
+    with futures.ThreadPoolExecutor(1) as pool:
+        with pytest.raises(IOError, match="announced 45.*returned 30"):
+            fetch_bibcodes(pool, 10)
 
 
 if __name__=="__main__":
@@ -0,0 +1,251 @@
+#!/usr/bin/python3
+"""
+Runs a build command unless its inputs are unchanged by content.
+
+make decides what to rebuild by modification times, which is too
+coarse for expensive steps like the LaTeX runs: touching the Makefile or
+regenerating gitmeta.tex with the same content would trigger them.  So,
+make calls this with the inputs it knows about, and this keeps a
+manifest of the sha256 hashes of the inputs, the outputs, and the
+command.  If all of these are as recorded, the command is not run.
+Otherwise, it is run and, if it succeeds, a new manifest is written.
+
+Input files that do not exist are recorded as such (so, e.g., a .bbl
+appearing later leads to a rebuild).
+
+make does not know about files the document \\inputs without listing them
+in SOURCES.  To still notice changes to them, pass the LaTeX recorder
+file (the .fls written with -recorder) as --recorder.  After a
+successful run, the files LaTeX read from the document directory are
+then hashed into the manifest, too.
+
+Usage (see the ivoatex Makefile):
+
+hashbuild.py --manifest M --output O --inputs I1 I2... -- command args
+
+This is part of ivoatex, covered by the GPL.  See COPYING for details.
+"""
+
+import hashlib
+import json
+import os
+import subprocess
+import sys
+
+
+def hash_file(path):
+    """returns the hex sha256 of the file at path, or None if there is no
+    such file.
+    """
+    hash = hashlib.sha256()
+    try:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1<<16), b""):
+                hash.update(chunk)
+    except IOError:
+        return None
+    return hash.hexdigest()
+
+
+def read_recorded_inputs(fls_path):
+    """returns the relative paths of the files in the current directory
+    and below that a LaTeX recorder file says were read.
+
+    Files outside (e.g., from the TeX installation) are left out, as
+    are files LaTeX also wrote (the .aux and similar).  If there is no
+    recorder file, the result is empty.
+    """
+    here = os.getcwd()
+    inputs, outputs = set(), set()
+    try:
+        with open(fls_path, encoding="utf-8", errors="replace") as f:
+            for ln in f:
+                kind, _, path = ln.rstrip("\n").partition(" ")
+                if kind not in ("INPUT", "OUTPUT"):
+                    continue
+                if os.path.isabs(path):
+                    path = os.path.relpath(path, here)
+                path = os.path.normpath(path)
+                if path.startswith(os.pardir):
+                    continue
+                (inputs if kind=="INPUT" else outputs).add(path)
+    except IOError:
+        pass
+    return sorted(inputs-outputs)
+
+
+def make_manifest(command, inputs, outputs, recorded=()):
+    """returns a manifest dictionary for command with the files inputs and
+    outputs in their current states.
+
+    recorded are the input files found by read_recorded_inputs.
+    """
+    return {
+        "command": command,
+        "inputs": dict((path, hash_file(path)) for path in sorted(inputs)),
+        "outputs": dict((path, hash_file(path)) for path in sorted(outputs)),
+        "recorded": dict((path, hash_file(path))
+            for path in sorted(recorded))}
+
+
+def load_manifest(manifest_path):
+    """returns the manifest stored at manifest_path, or None if there is
+    none that can be read.
+    """
+    try:
+        with open(manifest_path, encoding="utf-8") as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def write_manifest(manifest_path, manifest):
+    """writes manifest to manifest_path atomically.
+    """
+    os.makedirs(os.path.dirname(manifest_path) or ".", exist_ok=True)
+    tmp_name = manifest_path+".tmp"
+    with open(tmp_name, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_name, manifest_path)
+
+
+def is_up_to_date(manifest_path, command, inputs, outputs):
+    """returns True if the manifest at manifest_path says command was
+    last run successfully on inputs as they are now and the outputs have
+    not changed since.
+    """
+    previous = load_manifest(manifest_path)
+    if previous is None:
+        return False
+    current = make_manifest(command, inputs, outputs,
+        previous.get("recorded", {}))
+    return (previous==current
+        and None not in current["outputs"].values())
+
+
+def build(manifest_path, command, inputs, outputs, recorder=None):
+    """runs command unless is_up_to_date says it does not need to.
+
+    recorder is the path of a LaTeX recorder file that command writes;
+    see read_recorded_inputs.
+
+    This returns the exit status of the command, or 0 if it was not run.
+    """
+    if is_up_to_date(manifest_path, command, inputs, outputs):
+        sys.stderr.write("hashbuild: %s unchanged, skipping %s\n"%(
+            ", ".join(outputs), command[0]))
+        return 0
+
+    try:
+        status = subprocess.call(command)
+    except OSError as ex:
+        sys.stderr.write("hashbuild: cannot run %s: %s\n"%(command[0], ex))
+        status = 127
+
+    if status==0:
+        write_manifest(manifest_path, make_manifest(command, inputs, outputs,
+            read_recorded_inputs(recorder) if recorder else ()))
+    else:
+        try:
+            os.unlink(manifest_path)
+        except OSError:
+            pass
+    return status
+
+
+def parse_command_line():
+    import argparse
+    parser = argparse.ArgumentParser(description="Run a build command"
+        " unless the content of its inputs and outputs is unchanged since"
+        " the last successful run.")
+    parser.add_argument("--manifest", required=True, metavar="FILE",
+        help="Where to keep the hashes.")
+    parser.add_argument("--output", action="append", dest="outputs",
+        default=[], metavar="FILE",
+        help="A file the command produces (may be given more than once).")
+    parser.add_argument("--inputs", nargs="*", default=[], metavar="FILE",
+        help="The files the command reads.")
+    parser.add_argument("--recorder", metavar="FILE",
+        help="A LaTeX .fls file the command writes; inputs recorded"
+            " there are checked, too.")
+    parser.add_argument("command", nargs="+",
+        help="The command to run (separate it from the inputs with --).")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_command_line()
+    sys.exit(build(args.manifest, args.command, args.inputs, args.outputs,
+        args.recorder))
+
+
+############## Tests (run with python3 -m pytest hashbuild.py)
+
+def test_build(tmp_path):
+    manifest_path = str(tmp_path/"m.json")
+    input_path, output_path = tmp_path/"in.tex", tmp_path/"out.pdf"
+    input_path.write_text("a")
+    command = [sys.executable, "-c",
+        "import sys; open(sys.argv[2], 'a').write(open(sys.argv[1]).read())",
+        str(input_path), str(output_path)]
+    args = (manifest_path, command, [str(input_path), str(tmp_path/"bbl")],
+        [str(output_path)])
+
+    assert build(*args)==0
+    assert output_path.read_text()=="a"
+
+    # touching does not matter, the command is not run
+    os.utime(input_path, (0, 0))
+    assert build(*args)==0
+    assert output_path.read_text()=="a"
+
+    # changed content does...
+    input_path.write_text("b")
+    build(*args)
+    assert output_path.read_text()=="ab"
+
+    # ...and so does a new input file...
+    (tmp_path/"bbl").write_text("")
+    build(*args)
+    assert output_path.read_text()=="abb"
+
+    # ...and a lost output.
+    output_path.unlink()
+    build(*args)
+    assert output_path.read_text()=="b"
+
+
+def test_recorded_inputs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path/"Doc.tex").write_text("\\input{section}")
+    (tmp_path/"section.tex").write_text("a")
+    # a fake LaTeX appending the section to the output and writing a
+    # recorder file
+    command = [sys.executable, "-c",
+        "import os; open('Doc.pdf', 'a').write(open('section.tex').read());"
+        "open('Doc.fls', 'w').write('PWD %s\\nINPUT /usr/tex/x.sty\\n"
+        "INPUT ./Doc.tex\\nINPUT %s\\nINPUT Doc.aux\\nOUTPUT Doc.aux\\n'"
+        "%(os.getcwd(), os.path.abspath('section.tex')))"]
+    args = ("m.json", command, ["Doc.tex"], ["Doc.pdf"], "Doc.fls")
+
+    build(*args)
+    assert read_recorded_inputs("Doc.fls")==["Doc.tex", "section.tex"]
+    build(*args)
+    assert (tmp_path/"Doc.pdf").read_text()=="a"
+
+    (tmp_path/"section.tex").write_text("b")
+    build(*args)
+    assert (tmp_path/"Doc.pdf").read_text()=="ab"
+
+
+def test_failure(tmp_path):
+    manifest_path = str(tmp_path/"m.json")
+    assert build(manifest_path, [sys.executable, "-c", "raise SystemExit(3)"],
+        [], [])==3
+    assert not os.path.exists(manifest_path)
+
+
+if __name__=="__main__":
+    main()
+
+# vim:et:sw=4:sta
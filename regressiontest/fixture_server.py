@@ -0,0 +1,191 @@
+#!/usr/bin/python3
+"""
+A local stand-in for the TAP service and the vocabulary repository
+update_generated.py talks to.
+
+This serves
+
+* <base>/tap/sync -- TAP_SCHEMA.columns queries as produced by
+  !taptable, answered from fixtures/tap/columns.csv
+* <base>/rdf/<vocabulary> -- desise JSON from fixtures/rdf/<vocabulary>.json,
+  with an ETag so the revalidation in update_generated's HTTPCache can
+  be exercised.
+
+Point TAPURL to <base>/tap and VOCURL to <base>/rdf/ to use it.  This
+is not a TAP service; it only understands queries of the form
+SELECT <columns> FROM TAP_SCHEMA.columns WHERE table_name IN|= <literals>.
+
+Run this as a script to get a server in the foreground; in code, use
+the serve context manager.
+
+Distributed under CC0 by the IVOA.
+"""
+
+import contextlib
+import csv
+import hashlib
+import io
+import os
+import re
+import threading
+from http import server
+from urllib import parse
+
+
+DEFAULT_FIXTURE_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+_SELECT_PATTERN = re.compile(r"(?is)SELECT\s+(.*?)\s+FROM\s+"
+    r"TAP_SCHEMA\.columns\s+WHERE\s+table_name\s*(?:=|IN)\s*(.*)")
+_LITERAL_PATTERN = re.compile(r"'((?:[^']|'')*)'")
+
+
+def load_columns(fixture_dir):
+    """returns a list of the rows in fixture_dir/tap/columns.csv as
+    dictionaries.
+    """
+    with open(os.path.join(fixture_dir, "tap", "columns.csv"),
+            encoding="utf-8", newline="") as f:
+        return list(csv.DictReader(f))
+
+
+def run_query(rows, query):
+    """returns CSV for the TAP_SCHEMA.columns query against rows.
+
+    A ValueError is raised for queries we do not understand.
+    """
+    mat = _SELECT_PATTERN.match(query.strip())
+    if not mat:
+        raise ValueError("Unsupported query: %s"%query)
+    columns = [c.strip().strip('"') for c in mat.group(1).split(",")]
+    table_names = set(lit.replace("''", "'")
+        for lit in _LITERAL_PATTERN.findall(mat.group(2)))
+
+    dest = io.StringIO()
+    writer = csv.writer(dest, lineterminator="\r\n")
+    writer.writerow(columns)
+    for row in rows:
+        if row["table_name"] in table_names:
+            writer.writerow([row[c] for c in columns])
+    return dest.getvalue()
+
+
+class FixtureHandler(server.BaseHTTPRequestHandler):
+    """a request handler for the stand-in services.
+
+    The fixture directory and the parsed columns come from the server
+    (see make_server).
+    """
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            server.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def send_payload(self, payload, content_type, etag=None):
+        if etag is not None and self.headers.get("If-None-Match")==etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        if etag is not None:
+            self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        url = parse.urlparse(self.path)
+        if url.path=="/tap/sync":
+            self.handle_tap(parse.parse_qs(url.query))
+        elif url.path.startswith("/rdf/"):
+            self.handle_rdf(url.path[len("/rdf/"):])
+        else:
+            self.send_error(404)
+
+    def handle_tap(self, params):
+        try:
+            payload = run_query(self.server.columns,
+                params.get("QUERY", [""])[0]).encode("utf-8")
+        except ValueError as ex:
+            self.send_error(400, str(ex))
+            return
+        self.send_payload(payload, "text/csv;header=present")
+
+    def handle_rdf(self, vocabulary_name):
+        if ".." in vocabulary_name.split("/"):
+            self.send_error(403)
+            return
+        try:
+            with open(os.path.join(self.server.fixture_dir, "rdf",
+                    vocabulary_name+".json"), "rb") as f:
+                payload = f.read()
+        except IOError:
+            self.send_error(404)
+            return
+        self.send_payload(payload, "application/x-desise+json",
+            '"%s"'%hashlib.sha256(payload).hexdigest()[:16])
+
+
+class FixtureServer(server.ThreadingHTTPServer):
+    # make generate -j may open quite a few connections at a time
+    request_queue_size = 64
+    daemon_threads = True
+
+
+def make_server(fixture_dir=DEFAULT_FIXTURE_DIR, port=0, verbose=False):
+    """returns an (unstarted) HTTP server for the fixtures in fixture_dir.
+
+    With the default port=0, the operating system picks a free port.
+    """
+    srv = FixtureServer(("127.0.0.1", port), FixtureHandler)
+    srv.fixture_dir, srv.verbose = fixture_dir, verbose
+    srv.columns = load_columns(fixture_dir)
+    return srv
+
+
+@contextlib.contextmanager
+def serve(fixture_dir=DEFAULT_FIXTURE_DIR):
+    """runs a fixture server in a background thread while the controlled
+    block executes.
+
+    This yields the server's base URL; TAPURL would be that plus /tap,
+    VOCURL that plus /rdf/.
+    """
+    srv = make_server(fixture_dir)
+    thread = threading.Thread(target=srv.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield "http://127.0.0.1:%d"%srv.server_address[1]
+    finally:
+        srv.shutdown()
+        srv.server_close()
+
+
+def parse_command_line():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Stand-in TAP and vocabulary services for testing"
+        " make generate")
+    parser.add_argument("--port", type=int, default=8080,
+        help="Port to listen on (default: %(default)s)")
+    parser.add_argument("--fixtures", dest="fixture_dir",
+        default=DEFAULT_FIXTURE_DIR, metavar="DIR",
+        help="Directory containing tap/columns.csv and rdf/.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_command_line()
+    srv = make_server(args.fixture_dir, args.port, verbose=True)
+    base_url = "http://127.0.0.1:%d"%srv.server_address[1]
+    print("export TAPURL=%s/tap"%base_url)
+    print("export VOCURL=%s/rdf/"%base_url)
+    srv.serve_forever()
+
+
+if __name__=="__main__":
+    main()
+
+# vim:et:sw=4:sta
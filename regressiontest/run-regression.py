@@ -29,9 +29,13 @@ import datetime
 import os
 import re
 import subprocess
+import sys
 import tempfile
 import traceback
 
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fixture_server
+
 
 ####################### Misc. utilities
 
@@ -362,9 +366,16 @@ def test_git_integration():
     # or perhaps obtain git commit hash and check for its presence?
 
 
-def test_generated_content():
+def test_generated_content(services_url=None):
     # It would certainly be great if we tested schemadoc here, too,
     # but for now I'm not desperate enough to include a full schema here.
+    # With services_url=None, we use the live services; otherwise,
+    # services_url is the base URL of a fixture_server.
+    if services_url is None:
+        tap_url, voc_url = "http://reg.g-vo.org/tap", None
+    else:
+        tap_url, voc_url = services_url+"/tap", services_url+"/rdf/"
+
     edit_file("Regress.tex", [
         (r"\appendix", "\n".join([
             r"\section{Generated Nonsense}",
@@ -381,14 +392,18 @@ def test_generated_content():
             r"\appendix"]))])
     edit_file("Makefile", [
         ("-include ivoa",
-            "export TAPURL=http://reg.g-vo.org/tap\n\n-include ivoa")])
+            f"export TAPURL={tap_url}\n\n-include ivoa")])
+    if voc_url is not None:
+        edit_file("Makefile", [
+            ("-include ivoa",
+                f"export VOCURL={voc_url}\n\n-include ivoa")])
 
     execute("make generate")
     subprocess.call("make", stdout=subprocess.PIPE)
     execute("pdftotext Regress.pdf")
 
     assert_in_file("Regress.txt",
-        "I am building from http://reg.g-vo.org/tap", # shell execution
+        f"I am building from {tap_url}", # shell execution
         "related_id", # from taptable
         "auxiliary, bias," # from vocterms
         )
@@ -492,7 +507,7 @@ def test_recupdate():
         '<endorsedVersion status="rec">1.2</endorsedVersion>')
 
 
-def run_tests(repo_url, branch_name):
+def run_tests(repo_url, branch_name, services_url=None):
         os.environ["DOCNAME"] = "Regress"
         execute("mkdir $DOCNAME")
         os.chdir(os.environ["DOCNAME"])
@@ -531,7 +546,7 @@ def run_tests(repo_url, branch_name):
 
             test_git_integration()
 
-            test_generated_content()
+            test_generated_content(services_url)
 
             test_new_release()
 
@@ -564,6 +579,19 @@ def parse_command_line():
         help="use URL as submodule.  Defaults to the parent of the current"
             " directory.  Use https://github.com/ivoa-std/ivoatex for the"
             " ivoatexDoc behaviour.")
+    parser.add_argument("--live-services",
+        dest="live_services", action="store_true",
+        help="Run the test of generated content against reg.g-vo.org and"
+            " www.ivoa.net rather than against a local fixture_server.")
+    parser.add_argument("--http-cache",
+        dest="http_cache", default=None, metavar="DIR",
+        help="Have make generate record the responses of the TAP and"
+            " vocabulary services to DIR and replay them from there.")
+    parser.add_argument("--http-mode",
+        dest="http_mode", default="revalidate", metavar="MODE",
+        help="Use the HTTP cache in MODE (record, replay, revalidate;"
+            " see update_generated.py).  Use replay to run"
+            " test_generated_content without network access.")
 
     return parser.parse_args()
 
@@ -574,12 +602,19 @@ def main():
 
     if args.repo_url is None:
         args.repo_url = os.path.realpath("..")
+    if args.http_cache is not None:
+        os.environ["IVOATEX_HTTP_CACHE"] = os.path.realpath(args.http_cache)
+        os.environ["IVOATEX_HTTP_MODE"] = args.http_mode
 
     with tempfile.TemporaryDirectory("ivoatex") as dir:
         try:
             print(f"Testing in {dir}")
             os.chdir(dir)
-            run_tests(args.repo_url, args.branch_name)
+            with contextlib.ExitStack() as stack:
+                services_url = None
+                if not args.live_services:
+                    services_url = stack.enter_context(fixture_server.serve())
+                run_tests(args.repo_url, args.branch_name, services_url)
             print("All tests passed.")
         except Exception as ex:
             traceback.print_exc()
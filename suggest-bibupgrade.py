@@ -3,8 +3,10 @@
 A script somewhat naively looking for outdated references an suggesting
 updates.
 
-This expects the name of an .aux file as produced by a LaTeX run.  I'd
-expect this to be run through
+This expects the name of an .aux file as produced by a LaTeX run or the
+name of the document's .tex file; with the latter, citations are read
+directly from the TeX source, following \\input and \\include, so no
+LaTeX run is necessary.  I'd expect this to be run through
 
 make bib-suggestions
 
@@ -13,13 +15,31 @@ exclusively.
 If this actually gets use, we might think about flagging false positives
 (i.e., cases where document references are really version-sharp.
 
-Maintenance: Occasionally look at the diffs on docrepo.bib; anything that's
-not version 1 very likely belongs here.
+With --check, this reads the document's .tex files instead and also
+reports citation keys not in any bibliography (make check-citations).
+With --batch, it scans the .aux files of many documents in parallel and
+reports on all of them, including the outdated references cited most
+across the collection.
+
+Most replacements are derived from docrepo.bib, where entries with the
+same title up to the version number are considered versions of the same
+document (see derive_docmap).  The result is cached next to docrepo.bib
+and only recomputed when docrepo.bib changes.
+
+Maintenance: Replacements that cannot be derived in this way (e.g.,
+because the title changed between versions, or for legacy ivoabib
+tags) go into _DOCMAP, which takes precedence over the derived map.
 """
 
+import hashlib
+import json
+import os
 import re
 import sys
 
+from bibtools import (BibError, BibIndex, get_cited_keys, iter_aux_lines,
+    iter_ref_tags, iter_tex_tree_refs)
+
 # Maintain docmap as (new) (old) with any whitespace and one pair per line
 # Yes, that's the NEW reference tag first.  It's what you see first when
 # inspecting things.
@@ -32,7 +52,7 @@ _DOCMAP ="""
 2019ivoa.spec.1011D 2014ivoa.spec.1208D
 2019ivoa.spec.1007G 2006ivoa.spec.0528P
 2019ivoa.spec.1007F 2014ivoa.spec.0602F
-2019ivoa.spec.0927D 2011ivoa.spec.1028T
+2019ivoa.spec.0927D 2010ivoa.spec.0327D
 2018ivoa.spec.0723D 2009ivoa.spec.1104B
 2018ivoa.spec.0625P 2008ivoa.spec.0222P
 2018ivoa.spec.0621G 2013ivoa.spec.0329G
@@ -57,7 +77,6 @@ _DOCMAP ="""
 2009ivoa.spec.1130O 2004ivoa.spec.0811O
 2009ivoa.specQ1007G 2008ivoa.spec.0124G
 2008ivoa.spec.0325L 2007ivoa.spec.1108L
-2008ivoa.spec.0201D 2007ivoa.spec.1220D
 2007ivoa.spec.0402P 2005ivoa.spec.1231D
 2007ivoa.spec.0302H 2004ivoa.spec.0426H
 2007ivoa.spec.0302H std:RM
@@ -112,13 +131,226 @@ _DOCMAP ="""
 2023ivoa.spec.0125C 2021ivoa.spec.0616C
 2022ivoa.spec.1101S 2013ivoa.spec.1005S
 2022ivoa.spec.0727F 2019ivoa.spec.1007F
-2022ivoa.spec.0222D 2013ivoa.spec.1125P
+2022ivoa.spec.0222D 2017ivoa.spec.0530P
 """
 
 
-OLD2NEW = dict((p[1], p[0])
-    for p in (ln.split()
-        for ln in _DOCMAP.split("\n") if ln.strip()))
+class DocmapError(ValueError):
+    """is raised when a document map is malformed (e.g., has cycles).
+    """
+
+
+def parse_docmap(source):
+    """returns a list of (origin, new, old) tuples from a document
+    map in the format of _DOCMAP.
+
+    origin is a string like "line 3" for use in diagnostics.
+    """
+    pairs = []
+    for line_no, ln in enumerate(source.split("\n"), 1):
+        parts = ln.split()
+        if not parts:
+            continue
+        if len(parts)!=2:
+            raise DocmapError(f"line {line_no}: expected 'new old',"
+                f" found {ln!r}")
+        pairs.append((f"line {line_no}", parts[0], parts[1]))
+    return pairs
+
+
+def build_old2new(pairs):
+    """returns a dictionary mapping old to new reference tags from the
+    (origin, new, old) tuples in pairs.
+
+    An old tag mapped to two different new tags is a DocmapError.
+    """
+    old2new, defined_at = {}, {}
+    for origin, new, old in pairs:
+        if old2new.get(old, new)!=new:
+            raise DocmapError(f"{origin}: {old} is mapped to {new},"
+                f" but {defined_at[old]} maps it to {old2new[old]}")
+        old2new[old], defined_at[old] = new, origin
+    return old2new
+
+
+def build_closure(old2new):
+    """returns a dictionary mapping each old tag in old2new to the last tag
+    in its chain of replacements.
+
+    A DocmapError is raised if the replacements form a cycle.
+    """
+    closure = {}
+    for start in old2new:
+        path, seen, tag = [], set(), start
+        while tag in old2new and tag not in closure:
+            if tag in seen:
+                cycle = path[path.index(tag):]+[tag]
+                raise DocmapError("replacement cycle: "+" -> ".join(cycle))
+            path.append(tag)
+            seen.add(tag)
+            tag = old2new[tag]
+
+        final = closure.get(tag, tag)
+        for tag in path:
+            closure[tag] = final
+    return closure
+
+
+def load_index(f):
+    """returns a closure as written by write_index from the open file f.
+
+    This makes sure the closure actually is one, i.e., no replacement is
+    replaced itself.
+    """
+    closure = json.load(f)["closure"]
+    for old, new in closure.items():
+        if new in closure:
+            raise DocmapError(f"index maps {old} to {new}, which is"
+                " itself outdated.  Rebuild the index.")
+    return closure
+
+
+def write_index(closure, f):
+    """writes closure to the open file f for later use with load_index.
+    """
+    json.dump({"closure": closure}, f, indent=1, sort_keys=True)
+
+
+DOCREPO_BIB = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "docrepo.bib")
+DERIVED_CACHE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "docrepo-supersessions.json")
+
+_ENTRY_START = re.compile(r"@(\w+)\s*\{\s*([^,\s]+)\s*,")
+_FIELD = re.compile(r"^\s*(\w+)\s*=\s*(.*?),?\s*$")
+_VERSION = re.compile(r"(?i)\s+version\s+([\d.]+)\s*$")
+
+
+def iter_bib_records(f):
+    """yields dictionaries of the fields of the BibTeX entries in the
+    open file f, with the citation key in "key".
+
+    This assumes one field per line, which is what ADS gives us in
+    docrepo.bib.  Field names are lowercased, values are not processed.
+    """
+    rec = None
+    for ln in f:
+        mat = _ENTRY_START.match(ln)
+        if mat:
+            if rec:
+                yield rec
+            rec = {"key": mat.group(2)}
+            continue
+        mat = _FIELD.match(ln)
+        if rec is not None and mat:
+            rec[mat.group(1).lower()] = mat.group(2)
+    if rec:
+        yield rec
+
+
+def get_title_stem(title):
+    """returns a pair of a normalised title without the version and the
+    version for a docrepo.bib title.
+
+    The version is None if title does not end with a version.
+    """
+    title = title.strip('"').strip("{}")
+    version = None
+    # Some titles end with Version x Version x; so, strip all of them.
+    while True:
+        mat = _VERSION.search(title)
+        if not mat:
+            break
+        version = version or mat.group(1)
+        title = title[:mat.start()]
+    return " ".join(re.sub(r"\\\w+|[^\w\\]+", " ", title).lower().split()
+        ), version
+
+
+def derive_docmap(records):
+    """returns (origin, new, old) tuples for the versioned documents in
+    the BibTeX records.
+
+    Records are grouped by their title stems; within a group, every entry
+    is replaced by the one published next.  We order by publication date
+    (as given in the bibcode) rather than version because IVOA versions
+    were not always decimals (1.04 came before 1.1).
+    """
+    groups = {}
+    for rec in records:
+        if "title" not in rec:
+            continue
+        stem, version = get_title_stem(rec["title"])
+        if version is not None:
+            groups.setdefault(stem, []).append(rec["key"])
+
+    pairs = []
+    for stem, keys in groups.items():
+        keys.sort(key=lambda key: (key[:4], key[-5:-1]))
+        for old, new in zip(keys, keys[1:]):
+            pairs.append((f"docrepo.bib ({stem})", new, old))
+    return pairs
+
+
+def get_derived_docmap(bib_path=DOCREPO_BIB, cache_path=DERIVED_CACHE):
+    """returns derive_docmap's result for the BibTeX file at bib_path.
+
+    The result is cached in cache_path and only recomputed when the
+    content of the file at bib_path has changed.  If bib_path does not
+    exist, an empty list is returned.
+    """
+    try:
+        with open(bib_path, "rb") as f:
+            bib_source = f.read()
+    except IOError:
+        return []
+    bib_hash = hashlib.sha256(bib_source).hexdigest()
+
+    try:
+        with open(cache_path, encoding="utf-8") as f:
+            cached = json.load(f)
+        if cached["sha256"]==bib_hash:
+            return [tuple(p) for p in cached["pairs"]]
+    except (IOError, ValueError, KeyError):
+        pass
+
+    pairs = derive_docmap(iter_bib_records(
+        bib_source.decode("utf-8").split("\n")))
+    try:
+        with open(cache_path, "w", encoding="utf-8") as f:
+            json.dump({"sha256": bib_hash, "pairs": pairs}, f, indent=1)
+    except IOError:
+        # read-only ivoatex; we'll just have to re-derive next time.
+        pass
+    return pairs
+
+
+def get_docmap_pairs():
+    """returns the (origin, new, old) tuples for both _DOCMAP and
+    docrepo.bib.
+
+    Derived replacements for tags that _DOCMAP mentions as outdated
+    are discarded.
+    """
+    manual = parse_docmap(_DOCMAP)
+    overridden = set(old for _, _, old in manual)
+    return manual+[p for p in get_derived_docmap() if p[2] not in overridden]
+
+
+# the replacement closure; use get_closure to access it
+_CLOSURE = None
+
+
+def get_closure():
+    """returns the closure mapping outdated tags to their replacements.
+
+    It is built from _DOCMAP and docrepo.bib on first use unless main
+    has loaded a precompiled index.
+    """
+    global _CLOSURE
+    if _CLOSURE is None:
+        _CLOSURE = build_closure(build_old2new(get_docmap_pairs()))
+    return _CLOSURE
 
 
 def get_suggestion(ref_tag):
@@ -126,36 +358,293 @@ def get_suggestion(ref_tag):
 
     If ref_tag seems up to date, it is returned unchanged.
     """
-    while ref_tag in OLD2NEW:
-        ref_tag = OLD2NEW[ref_tag]
-    return ref_tag
+    return get_closure().get(ref_tag, ref_tag)
+
 
+# what documents use when they do not say otherwise
+DEFAULT_BIB_NAMES = ["ivoatex/ivoabib", "ivoatex/docrepo"]
 
-def iter_ref_tags(f):
-    """yields all arguments of citation macro calls within the file f's
-    content.
 
-    We expect the citation calls to be all in one line and without
-    whitespace and all that.  I think that's how LaTeX produces them:
-    We're reading from an aux file here.
+def collect_citations(tex_paths):
+    """returns the citations and the bibliographies in the TeX files
+    tex_paths and the files they include.
+
+    The citations are (tex_path, line_no, key) triples, the bibliographies
+    are names as given in \\bibliography (or DEFAULT_BIB_NAMES if there
+    is no \\bibliography in the files).  Included files are resolved
+    relative to the directory of the first TeX file.
     """
-    pat = re.compile(r"\\citation\{([^}]*)}")
-    for ln in f:
-        mat = pat.search(ln)
-        if mat:
-            yield mat.group(1)
+    citations, bib_names, seen = [], [], set()
+    base_dir = os.path.dirname(tex_paths[0]) if tex_paths else ""
+    for tex_path in tex_paths:
+        for path, line_no, macro, arg in iter_tex_tree_refs(
+                tex_path, base_dir, seen):
+            names = [n.strip() for n in arg.split(",") if n.strip()]
+            if macro=="bibliography":
+                bib_names.extend(names)
+            else:
+                citations.extend((path, line_no, key)
+                    for key in names if key!="*")
+    return citations, bib_names or DEFAULT_BIB_NAMES
+
+
+def check_citations(tex_paths):
+    """returns the problems with the citations in the TeX files tex_paths.
+
+    The problems are triples of (kind, location, message), where kind is
+    one of "unknown" (citation key not in any bibliography), "outdated"
+    (there is a replacement for the key), or "nobib" (a bibliography
+    could not be read).  Bibliographies are looked for relative to the
+    directory of the first TeX file.
+    """
+    citations, bib_names = collect_citations(tex_paths)
+    base_dir = os.path.dirname(tex_paths[0]) if tex_paths else ""
+    problems, indexes = [], []
+    for bib_name in bib_names:
+        bib_path = os.path.join(base_dir, bib_name)
+        if not bib_path.endswith(".bib"):
+            bib_path += ".bib"
+        try:
+            indexes.append(BibIndex(bib_path))
+        except (IOError, BibError) as ex:
+            problems.append(("nobib", bib_path,
+                f"cannot read bibliography: {ex}"))
+
+    for tex_path, line_no, key in citations:
+        location = f"{tex_path}:{line_no}"
+        if not any(index.find(key) for index in indexes):
+            problems.append(("unknown", location,
+                f"unknown citation key {key}"))
+        replacement = get_suggestion(key)
+        if replacement!=key:
+            problems.append(("outdated", location,
+                f"{key} is outdated; consider {replacement}"))
+    return problems
+
+
+def iter_aux_files(paths):
+    """yields the .aux files in paths.
+
+    Directories are searched recursively, except for ivoatex submodules
+    and hidden directories.
+    """
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+
+        for dir_path, dir_names, file_names in os.walk(path):
+            dir_names[:] = sorted(d for d in dir_names
+                if d!="ivoatex" and not d.startswith("."))
+            for name in sorted(file_names):
+                if name.endswith(".aux"):
+                    yield os.path.join(dir_path, name)
+
+
+def _init_batch_worker(closure):
+    global _CLOSURE
+    _CLOSURE = closure
+
+
+def scan_document(aux_path):
+    """returns a dictionary describing the outdated references in the
+    document with the aux file aux_path.
+
+    This is what batch workers run.
+    """
+    try:
+        keys = get_cited_keys(iter_aux_lines(aux_path))
+    except IOError as ex:
+        return {"aux": aux_path, "error": str(ex)}
+    outdated = dict((key, get_suggestion(key))
+        for key in sorted(keys) if get_suggestion(key)!=key)
+    return {"aux": aux_path, "n_references": len(keys),
+        "outdated": outdated}
+
+
+def scan_collection(aux_paths, n_workers=None):
+    """returns scan_document's results for aux_paths, computed on a
+    process pool of n_workers.
+
+    The workers get the current closure rather than building their own.
+    """
+    from concurrent import futures
+    with futures.ProcessPoolExecutor(n_workers,
+            initializer=_init_batch_worker, initargs=(get_closure(),)) as pool:
+        return list(pool.map(scan_document, aux_paths, chunksize=4))
+
+
+def summarise_collection(results, n_top):
+    """returns a report dictionary for scan_document results.
+
+    Apart from the documents, this has the n_top outdated references
+    cited by the most documents.
+    """
+    counts = {}
+    for res in results:
+        for old in res.get("outdated", {}):
+            counts[old] = counts.get(old, 0)+1
+    top = sorted(counts.items(), key=lambda p: (-p[1], p[0]))[:n_top]
+    return {
+        "documents": results,
+        "most_cited_outdated": [
+            {"reference": old, "replacement": get_suggestion(old),
+                "documents": count}
+            for old, count in top]}
+
+
+def format_report_text(report):
+    """returns report (as from summarise_collection) as plain text.
+    """
+    lines = []
+    for res in report["documents"]:
+        if "error" in res:
+            lines.append(f"*** {res['aux']}: {res['error']}")
+            continue
+        lines.append(f"*** {res['aux']}: {len(res['outdated'])} of"
+            f" {res['n_references']} references outdated")
+        for old, new in res["outdated"].items():
+            lines.append(f"  {old} -> {new}")
+
+    n_docs = len(report["documents"])
+    lines.append(f"\n*** Most cited outdated references"
+        f" ({n_docs} documents):")
+    for item in report["most_cited_outdated"]:
+        lines.append(f"{item['documents']:5d}  {item['reference']}"
+            f" -> {item['replacement']}")
+    if not report["most_cited_outdated"]:
+        lines.append("  (none)")
+    return "\n".join(lines)
+
+
+def run_batch(paths, n_workers, format, n_top):
+    """prints a report on the outdated references in the documents
+    in paths.
+    """
+    report = summarise_collection(
+        scan_collection(list(iter_aux_files(paths)), n_workers), n_top)
+    if format=="json":
+        print(json.dumps(report, indent=1))
+    else:
+        print(format_report_text(report))
+
+
+def parse_command_line():
+    import argparse
+    parser = argparse.ArgumentParser(description="Suggest updates for"
+        " outdated references.  This is normally run through"
+        " make bib-suggestions.")
+    parser.add_argument("files", nargs="*", metavar="FILE",
+        help="The .aux file or the .tex file(s) of the document to check."
+            "  Files \\input or \\include-d by .tex files are read, too.")
+    parser.add_argument("--check", action="store_true", dest="check",
+        help="Check citations in TeX sources for unknown and outdated"
+            " keys without needing a LaTeX run; exit with status 1 if"
+            " there are unknown keys.")
+    parser.add_argument("--strict", action="store_true", dest="strict",
+        help="With --check, also fail for outdated keys.")
+    parser.add_argument("--batch", action="store_true", dest="batch",
+        help="Scan many documents: the files are .aux files or"
+            " directories containing them, and a report on all of them"
+            " is printed.")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+        dest="n_workers", metavar="N",
+        help="With --batch, use N worker processes (default: one per"
+            " CPU).")
+    parser.add_argument("--format", choices=["text", "json"],
+        default="text", dest="format",
+        help="With --batch, the report format (default: %(default)s).")
+    parser.add_argument("--top", type=int, default=10, dest="n_top",
+        metavar="N",
+        help="With --batch, list the N outdated references cited by the"
+            " most documents (default: %(default)s).")
+    parser.add_argument("--index", dest="index", default=None,
+        metavar="FILE",
+        help="Use the precompiled replacement index in FILE rather than"
+            " the built-in map.")
+    parser.add_argument("--write-index", dest="write_index", default=None,
+        metavar="FILE",
+        help="Write the replacement index to FILE.")
+    args = parser.parse_args()
+    if not args.files and args.write_index is None:
+        parser.error("Nothing to do (give an aux file or --write-index)")
+    if args.check and args.batch:
+        parser.error("--check and --batch are mutually exclusive")
+    if (not (args.check or args.batch)
+            and len(args.files)>1
+            and not all(n.endswith(".tex") for n in args.files)):
+        parser.error("Give just one aux file (or use --batch)")
+    return args
+
+
+def run_check(tex_paths, strict):
+    """prints the problems check_citations finds in tex_paths and returns
+    an exit status for them.
+    """
+    problems = check_citations(tex_paths)
+    for kind, location, message in problems:
+        print(f"{location}: {message}")
+
+    failing = {"unknown", "nobib"}
+    if strict:
+        failing.add("outdated")
+    return 1 if any(p[0] in failing for p in problems) else 0
+
+
+def get_document_citations(paths):
+    """returns the citation keys of a document given either as .tex files
+    or as (the first of) its .aux file(s).
+
+    Each key is returned once; from .tex files in the order of first
+    citation, from .aux files sorted.  For .aux files, \\@input-ed aux files
+    are followed and multiple keys in one \\citation are split, as in
+    --check and --batch.
+    """
+    if paths[0].endswith(".tex"):
+        return list(dict.fromkeys(
+            key for _, _, key in collect_citations(paths)[0]))
+    return sorted(get_cited_keys(iter_aux_lines(paths[0])))
 
 
 def main():
-    if len(sys.argv)!=2:
-        sys.exit("Do not call this script directly.")
+    global _CLOSURE
+    args = parse_command_line()
+
+    # with an index, docrepo.bib is not even looked at
+    try:
+        if args.index:
+            with open(args.index, encoding="utf-8") as f:
+                _CLOSURE = load_index(f)
+    except (IOError, ValueError) as ex:
+        sys.exit(f"Cannot load replacement index {args.index}: {ex}")
+    try:
+        get_closure()
+    except DocmapError as ex:
+        sys.exit(f"Cannot build the replacement map: {ex}")
+
+    if args.write_index:
+        with open(args.write_index, "w", encoding="utf-8") as f:
+            write_index(get_closure(), f)
+
+    if not args.files:
+        return
+
+    if args.check:
+        try:
+            sys.exit(run_check(args.files, args.strict))
+        except IOError as ex:
+            sys.exit(f"Cannot check citations: {ex}")
+
+    if args.batch:
+        run_batch(args.files, args.n_workers, args.format, args.n_top)
+        return
 
     suggestions = {}
-    with open(sys.argv[1], encoding="utf-8") as f:
-        for ref_tag in iter_ref_tags(f):
-            replacement = get_suggestion(ref_tag)
-            if replacement!=ref_tag:
-                suggestions[ref_tag] = replacement
+    ref_tags = get_document_citations(args.files)
+    for ref_tag in ref_tags:
+        replacement = get_suggestion(ref_tag)
+        if replacement!=ref_tag:
+            suggestions[ref_tag] = replacement
 
     if suggestions:
         # There may be a bit of mess from the LaTeX run(s) above us, so feed
@@ -173,7 +662,193 @@ class TestSuggestions:
         assert get_suggestion("whatever")=="whatever"
 
     def test_recursive(self):
-        assert get_suggestion("2004ivoa.spec.0811O")=="2019ivoa.spec.1021O"
+        assert get_suggestion("2004ivoa.spec.0811O")=="2025ivoa.spec.0116O"
+
+    def test_closure_is_flat(self):
+        closure = get_closure()
+        assert not set(closure.values())&set(closure)
+
+    def test_derived(self):
+        # VOTable 1.5 is not in _DOCMAP
+        assert get_suggestion("2004ivoa.spec.0811O")==get_suggestion(
+            "2019ivoa.spec.1021O")
+        assert get_suggestion("2019ivoa.spec.1021O")!="2019ivoa.spec.1021O"
+
+
+class TestDerivation:
+    def test_title_stem(self):
+        assert get_title_stem(
+            '"{Maintenance of the list of UCD words Version 2.0 Version 2.0}"'
+            )==("maintenance of the list of ucd words", "2.0")
+        assert get_title_stem(
+            '"{SAMP {\\textemdash} Simple Application Messaging Protocol'
+            ' Version 1.11}"')==(
+            "samp simple application messaging protocol", "1.11")
+        assert get_title_stem('"{Unversioned}"')==("unversioned", None)
+
+    def test_derive(self):
+        import io
+        records = list(iter_bib_records(io.StringIO(
+            "@MISC{2008ivoa.spec.0201T,\n"
+            '  title = "{Simple Spectral Access Protocol Version 1.04}",\n'
+            "}\n"
+            "@MISC{2012ivoa.spec.0210T,\n"
+            '  title = "{Simple Spectral Access Protocol Version 1.1}",\n'
+            "}\n"
+            "@MISC{2007ivoa.spec.1220T,\n"
+            '  title = "{Simple Spectral Access Protocol Version 1.03}",\n'
+            "}\n")))
+        assert [p[1:] for p in derive_docmap(records)]==[
+            ("2008ivoa.spec.0201T", "2007ivoa.spec.1220T"),
+            ("2012ivoa.spec.0210T", "2008ivoa.spec.0201T")]
+
+    def test_cache(self, tmp_path):
+        bib_path, cache_path = tmp_path/"x.bib", tmp_path/"x.json"
+        bib_path.write_text("@MISC{2001ivoa.spec.0101A,\n"
+            ' title = "{A Version 1.0}",\n}\n'
+            "@MISC{2002ivoa.spec.0101A,\n"
+            ' title = "{A Version 1.1}",\n}\n')
+        pairs = get_derived_docmap(bib_path, cache_path)
+        assert cache_path.exists()
+        # make sure a valid cache is used
+        cache_path.write_text(cache_path.read_text().replace(
+            "2002ivoa", "2003ivoa"))
+        assert get_derived_docmap(bib_path, cache_path)[0][1]==(
+            "2003ivoa.spec.0101A")
+        # ...but not after the bib has changed
+        bib_path.write_text(bib_path.read_text()+"\n")
+        assert get_derived_docmap(bib_path, cache_path)==pairs
+
+
+class TestCheck:
+    def test_check(self, tmp_path, monkeypatch):
+        monkeypatch.setenv("IVOATEX_BIBINDEX_DIR", str(tmp_path))
+        (tmp_path/"local.bib").write_text(
+            "@misc{Known, title={Known}}\n"
+            "@misc{2004ivoa.spec.0811O, title={Old VOTable}}\n")
+        (tmp_path/"doc.tex").write_text(
+            "\\citep{known,typo}\n"
+            "% \\cite{commented}\n"
+            "\\nocite{*}\\citet{2004ivoa.spec.0811O}\n"
+            "\\bibliography{local}\n")
+        assert [p[:2] for p in check_citations([str(tmp_path/"doc.tex")])
+            ]==[
+                ("unknown", f"{tmp_path}/doc.tex:1"),
+                ("outdated", f"{tmp_path}/doc.tex:3")]
+
+    def test_missing_bib(self, tmp_path, monkeypatch):
+        monkeypatch.setenv("IVOATEX_BIBINDEX_DIR", str(tmp_path))
+        (tmp_path/"doc.tex").write_text("\\cite{a}\n")
+        assert [p[0] for p in check_citations([str(tmp_path/"doc.tex")])]==[
+            "nobib", "nobib", "unknown"]
+
+    def test_real_bibs(self, monkeypatch, tmp_path):
+        monkeypatch.setenv("IVOATEX_BIBINDEX_DIR", str(tmp_path))
+        src_dir = os.path.dirname(os.path.abspath(__file__))
+        (tmp_path/"doc.tex").write_text("\\citep{std:RFC4122}"
+            "\\bibliography{%s/ivoabib,%s/docrepo}"%(src_dir, src_dir))
+        assert check_citations([str(tmp_path/"doc.tex")])==[]
+
+
+def test_tex_input(tmp_path):
+    (tmp_path/"doc.tex").write_text("\\input gitmeta\n"
+        "\\input{sect}\n\\citet{2004ivoa.spec.0811O}\n")
+    (tmp_path/"sect.tex").write_text("\\citep{std:RFC4122,\n"
+        " 2010ivoa.spec.0327D}\n")
+    citations, bib_names = collect_citations([str(tmp_path/"doc.tex")])
+    assert [(os.path.basename(c[0]), c[1], c[2]) for c in citations]==[
+        ("sect.tex", 1, "std:RFC4122"), ("sect.tex", 1, "2010ivoa.spec.0327D"),
+        ("doc.tex", 3, "2004ivoa.spec.0811O")]
+    assert bib_names==DEFAULT_BIB_NAMES
+
+
+def test_document_citations(tmp_path):
+    (tmp_path/"doc.tex").write_text("\\citep{2004ivoa.spec.0811O,"
+        " std:RFC4122}\n\\citet{2004ivoa.spec.0811O}\n")
+    (tmp_path/"doc.aux").write_text("\\citation{2004ivoa.spec.0811O,"
+        "std:RFC4122}\n\\@input{sect.aux}\n")
+    (tmp_path/"sect.aux").write_text("\\citation{2004ivoa.spec.0811O}\n")
+    from_tex = get_document_citations([str(tmp_path/"doc.tex")])
+    assert from_tex==["2004ivoa.spec.0811O", "std:RFC4122"]
+    assert get_document_citations([str(tmp_path/"doc.aux")]
+        )==sorted(from_tex)
+
+
+class TestBatch:
+    def _make_collection(self, root):
+        for doc, citations in [
+                ("DocA", ["2004ivoa.spec.0811O,std:RFC4122"]),
+                ("DocB", ["2004ivoa.spec.0811O", "2010ivoa.spec.0327D"]),
+                ("DocC", ["std:RFC4122"])]:
+            (root/doc/"ivoatex").mkdir(parents=True)
+            (root/doc/"ivoatex"/"ignored.aux").write_text(
+                "\\citation{2004ivoa.spec.0811O}\n")
+            (root/doc/f"{doc}.aux").write_text("".join(
+                f"\\citation{{{c}}}\n" for c in citations))
+
+    def test_collection(self, tmp_path):
+        self._make_collection(tmp_path)
+        aux_paths = list(iter_aux_files([str(tmp_path),
+            str(tmp_path/"missing.aux")]))
+        assert [os.path.basename(p) for p in aux_paths]==[
+            "DocA.aux", "DocB.aux", "DocC.aux", "missing.aux"]
+
+        report = summarise_collection(scan_collection(aux_paths, 2), 1)
+        docs = report["documents"]
+        assert [d.get("n_references") for d in docs]==[2, 2, 1, None]
+        assert docs[1]["outdated"]=={
+            "2004ivoa.spec.0811O": get_suggestion("2004ivoa.spec.0811O"),
+            "2010ivoa.spec.0327D": get_suggestion("2010ivoa.spec.0327D")}
+        assert "error" in docs[3]
+        assert report["most_cited_outdated"]==[{
+            "reference": "2004ivoa.spec.0811O",
+            "replacement": get_suggestion("2004ivoa.spec.0811O"),
+            "documents": 2}]
+
+        text = format_report_text(report)
+        assert "DocC.aux: 0 of 1 references outdated" in text
+        assert "    2  2004ivoa.spec.0811O -> " in text
+
+
+class TestDocmapChecks:
+    def test_conflict(self):
+        import pytest
+        with pytest.raises(DocmapError, match="line 3: b is mapped to c,"
+                " but line 2 maps it to a"):
+            build_old2new(parse_docmap("\na b\nc b\n"))
+
+    def test_duplicate_ok(self):
+        assert build_old2new(parse_docmap("a b\na b"))=={"b": "a"}
+
+    def test_cycle(self):
+        import pytest
+        with pytest.raises(DocmapError, match="cycle: (.) -> (.) -> (.) -> \\1"):
+            build_closure(build_old2new(parse_docmap("a b\nb c\nc a\n")))
+
+    def test_index_roundtrip(self):
+        import io
+        f = io.StringIO()
+        write_index(get_closure(), f)
+        f.seek(0)
+        assert load_index(f)==get_closure()
+
+    def test_bad_index(self):
+        import io, pytest
+        with pytest.raises(DocmapError, match="Rebuild"):
+            load_index(io.StringIO('{"closure": {"a": "b", "b": "c"}}'))
+
+    def test_index_skips_docmap(self, tmp_path, monkeypatch, capsys):
+        def fail():
+            raise DocmapError("broken map")
+        module = sys.modules[__name__]
+        monkeypatch.setattr(module, "get_docmap_pairs", fail)
+        monkeypatch.setattr(module, "_CLOSURE", None)
+        (tmp_path/"index.json").write_text('{"closure": {"old": "new"}}')
+        (tmp_path/"doc.aux").write_text("\\citation{old}\n")
+        monkeypatch.setattr(sys, "argv", ["suggest-bibupgrade.py",
+            "--index", str(tmp_path/"index.json"), str(tmp_path/"doc.aux")])
+        main()
+        assert "old -> new" in capsys.readouterr().out
 
 
 def test_get_suggestion():
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+A benchmark of the bibliography step of make biblio with and without
+extract-bibsubset.py.
+
+This times, in a scratch directory,
+
+* bibtex on the full ivoabib.bib and docrepo.bib (what make biblio did
+  before) and
+* extract-bibsubset.py followed by bibtex on the subsets (what it does
+  now).
+
+By default, the .aux cites --n-cites random keys from the two bib files;
+pass an .aux file from a real document to time that instead.  Run it
+from this directory as
+
+python3 bench-bibsubset.py [--n-cites N] [--runs N] [aux-file]
+
+This needs bibtex.  This is part of ivoatex.  See COPYING for the
+license.
+"""
+
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+IVOATEX_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, IVOATEX_DIR)
+import bibtools
+
+BIB_NAMES = ["ivoabib", "docrepo"]
+
+
+def make_aux(n_cites, seed=0):
+    """returns the text of an .aux file citing n_cites random entries
+    from BIB_NAMES.
+    """
+    keys = []
+    for name in BIB_NAMES:
+        keys.extend(bibtools.BibIndex(
+            os.path.join(IVOATEX_DIR, name+".bib")))
+    keys = random.Random(seed).sample(sorted(keys), min(n_cites, len(keys)))
+    return "".join("\\citation{%s}\n"%key for key in keys
+        )+"\\bibdata{%s}\n\\bibstyle{ivoa}\n"%",".join(BIB_NAMES)
+
+
+def time_command(commands, work_dir, env, n_runs):
+    """returns the best wall clock time of running the commands (a list
+    of argument lists) one after the other in work_dir.
+    """
+    times = []
+    for _ in range(n_runs):
+        start_time = time.time()
+        for command in commands:
+            subprocess.run(command, cwd=work_dir, env=env,
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.time()-start_time)
+    return min(times)
+
+
+def run_benchmark(aux_source, n_runs):
+    """returns a pair of the best times for the full and the subset
+    bibliography steps on the .aux text aux_source.
+    """
+    with tempfile.TemporaryDirectory("ivoatex-bench") as work_dir:
+        os.makedirs(os.path.join(work_dir, "ivoatex"))
+        for name in BIB_NAMES:
+            shutil.copy(os.path.join(IVOATEX_DIR, name+".bib"),
+                os.path.join(work_dir, "ivoatex"))
+        with open(os.path.join(work_dir, "bench.aux"), "w") as f:
+            f.write(aux_source)
+
+        search_path = os.path.join(work_dir, "ivoatex")+":"
+        env = dict(os.environ, BIBINPUTS=search_path,
+            BSTINPUTS=os.path.abspath(IVOATEX_DIR)+":")
+        full = time_command([["bibtex", "bench"]], work_dir, env, n_runs)
+
+        subset_dir = os.path.join(work_dir, "subset")
+        env["BIBINPUTS"] = subset_dir+":"+search_path
+        subset = time_command([
+            [sys.executable, os.path.join(IVOATEX_DIR, "extract-bibsubset.py"),
+                "--dest", subset_dir, "bench.aux"],
+            ["bibtex", "bench"]], work_dir, env, n_runs)
+    return full, subset
+
+
+def parse_command_line():
+    import argparse
+    parser = argparse.ArgumentParser(description="Time BibTeX on the full"
+        " bib files and on the subsets written by extract-bibsubset.py.")
+    parser.add_argument("aux_file", nargs="?", default=None,
+        help="An .aux file to use (default: a synthetic one).")
+    parser.add_argument("--n-cites", type=int, default=20,
+        help="Number of keys cited in the synthetic .aux"
+            " (default: %(default)s).")
+    parser.add_argument("--runs", type=int, default=5,
+        help="Number of runs to time; the best counts"
+            " (default: %(default)s).")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_command_line()
+    if not shutil.which("bibtex"):
+        sys.exit("This benchmark needs bibtex.")
+
+    if args.aux_file:
+        with open(args.aux_file, encoding="utf-8") as f:
+            aux_source = f.read()
+    else:
+        aux_source = make_aux(args.n_cites)
+
+    full, subset = run_benchmark(aux_source, args.runs)
+    print("%-34s %8.3f s"%("bibtex on full bib files", full))
+    print("%-34s %8.3f s"%("extract-bibsubset.py + bibtex", subset))
+
+
+if __name__=="__main__":
+    main()
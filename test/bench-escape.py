@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""
+A benchmark of update_generated.escape_for_TeX, which runs over every
+TAP column description and every schema annotation in make generate.
+
+This compares the current implementation with the one from ivoatex 1.3
+on a mix of plain text, TeX-magic characters, and URLs.  Run it from
+this directory as
+
+python3 bench-escape.py
+
+This is part of ivoatex.  See COPYING for the license.
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    ".."))
+import update_generated
+
+
+SAMPLES = [
+    "The identifier of the resource the capability belongs to.",
+    "Flux in the 2MASS K_s band; see http://www.ipac.caltech.edu/2mass/ for"
+        " details.",
+    r"A pattern like ^[a-z]+\d*$ matching 100% of {valid} \"names\" & more",
+    "UCD (e.g., phot.flux;em.opt.V) of the column; this is # not a comment.",
+    " ".join(["Some rather long description without any magic"]*10),
+]
+
+
+def main():
+    number = 20000
+    for func in [update_generated._escape_for_TeX_reference,
+            update_generated.escape_for_TeX]:
+        elapsed = min(timeit.repeat(
+            lambda: [func(s) for s in SAMPLES],
+            number=number, repeat=5))
+        print("%-28s %8.2f us/string"%(
+            func.__name__, elapsed/number/len(SAMPLES)*1e6))
+
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+A throughput benchmark for update_generated.py (i.e., make generate).
+
+This writes a document with many !taptable, !vocterms and shell blocks,
+starts the stand-in services from regressiontest/fixture_server.py on
+synthetic fixtures, and times update_generated.py on the document in
+a few configurations.  Run it from this directory as
+
+python3 bench-generate.py [--blocks N]
+
+The python running this needs the requests module.
+
+This is part of ivoatex.  See COPYING for the license.
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+IVOATEX_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(IVOATEX_DIR, "regressiontest"))
+import fixture_server
+
+
+def write_fixtures(fixture_dir, n_blocks):
+    """writes n_blocks synthetic tables and vocabularies to fixture_dir.
+    """
+    os.makedirs(os.path.join(fixture_dir, "tap"))
+    os.makedirs(os.path.join(fixture_dir, "rdf", "bench"))
+
+    with open(os.path.join(fixture_dir, "tap", "columns.csv"), "w",
+            encoding="utf-8") as f:
+        f.write("table_name,column_name,datatype,size,description\n")
+        for table_index in range(n_blocks):
+            for col_index in range(20):
+                f.write('bench.t%d,col_%d,DOUBLE,1,"Column %d of table %d'
+                    ' with $pecial & magic_characters; see'
+                    ' http://example.org/doc_%d."\n'%(
+                        table_index, col_index, col_index, table_index,
+                        col_index))
+
+    for voc_index in range(n_blocks):
+        with open(os.path.join(fixture_dir, "rdf", "bench",
+                "voc%d.json"%voc_index), "w", encoding="utf-8") as f:
+            json.dump({"terms": dict(("term_%d"%i, {"label": "Term %d"%i})
+                for i in range(50))}, f)
+
+
+def write_document(doc_name, n_blocks):
+    with open(doc_name, "w", encoding="utf-8") as f:
+        for index in range(n_blocks):
+            f.write("%% GENERATED: !taptable bench.t%d\n%% /GENERATED\n\n"
+                "%% GENERATED: !vocterms bench/voc%d\n%% /GENERATED\n\n"
+                "%% GENERATED: echo block %d\n%% /GENERATED\n\n"%(
+                    index, index, index))
+
+
+def time_run(doc_name, *args):
+    start_time = time.time()
+    subprocess.check_call([sys.executable,
+        os.path.join(IVOATEX_DIR, "update_generated.py")]+list(args)
+        +[doc_name], stdout=subprocess.DEVNULL)
+    return time.time()-start_time
+
+
+def parse_command_line():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Benchmark update_generated.py")
+    parser.add_argument("--blocks", type=int, default=30,
+        help="Number of blocks of each kind (default: %(default)s).")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_command_line()
+    with tempfile.TemporaryDirectory("ivoatex-bench") as work_dir:
+        fixture_dir = os.path.join(work_dir, "fixtures")
+        write_fixtures(fixture_dir, args.blocks)
+        doc_name = os.path.join(work_dir, "bench.tex")
+        write_document(doc_name, args.blocks)
+        n_blocks = 3*args.blocks
+
+        with fixture_server.serve(fixture_dir) as base_url:
+            os.environ["TAPURL"] = base_url+"/tap"
+            os.environ["VOCURL"] = base_url+"/rdf/"
+            os.chdir(work_dir)
+
+            for label, flags in [
+                    ("serial, no cache", ["--no-cache"]),
+                    ("-j 4, no cache", ["--no-cache", "-j", "4"]),
+                    ("-j 16, no cache", ["--no-cache", "-j", "16"]),
+                    ("serial, filling cache", ["--refresh"]),
+                    ("serial, from cache", [])]:
+                elapsed = time_run(doc_name, *flags)
+                print("%-24s %7.3f s %8.1f blocks/s"%(
+                    label, elapsed, n_blocks/elapsed))
+
+
+if __name__=="__main__":
+    main()
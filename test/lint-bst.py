@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+"""
+A lint and benchmark harness for ivoa.bst.
+
+This renders every entry in ivoabib.bib and docrepo.bib through ivoa.bst
+(using \\nocite{*}) and
+
+* collects BibTeX's warnings per entry (e.g., "isn't style-file defined"
+  or empty fields),
+* compares the rendering of each entry with a golden output, and
+* times the BibTeX run and compares that with the golden timing.
+
+Run it from this directory as
+
+python3 lint-bst.py [--update]
+
+It exits with a non-zero status if entry renderings changed, warnings
+appeared that are not in the golden output, or BibTeX became more than
+--max-slowdown times slower.  New and removed entries (which happen
+when the bib files are updated) are only reported.
+
+After reviewing a change, run with --update to make the current
+results the new golden output (in bst-golden.json).  Timings depend on
+the machine, so --update on the machine you compare on.
+
+This is part of ivoatex.  See COPYING for the license.
+"""
+
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+IVOATEX_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, IVOATEX_DIR)
+import bibtools
+
+BIB_NAMES = ["ivoabib", "docrepo"]
+GOLDEN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "bst-golden.json")
+
+_BBL_ITEM = re.compile(r"^\\harvarditem.*\{([^{}]*)\}\s*$", re.M)
+_BBL_END = re.compile(r"^\\end\{thebibliography\}", re.M)
+_BLG_MESSAGE = re.compile(r"^(Warning--.*|.*---line \d+ of file .*)$", re.M)
+_BLG_LOCATION = re.compile(r"-+line (\d+) of file (.*)$")
+_BLG_KEY = re.compile(r"(?: in |for \")([^\s\"]+)\"?$")
+
+
+def split_bbl(bbl_source):
+    """returns a dictionary mapping citation keys to their renderings
+    in a .bbl file produced by ivoa.bst.
+    """
+    items = list(_BBL_ITEM.finditer(bbl_source))
+    end = _BBL_END.search(bbl_source)
+    ends = [m.start() for m in items[1:]]+[
+        end.start() if end else len(bbl_source)]
+    return dict((mat.group(1), bbl_source[mat.start():item_end].strip())
+        for mat, item_end in zip(items, ends))
+
+
+def get_line_map(bib_path):
+    """returns a list of (first_line, last_line, key) for the entries
+    in the BibTeX file at bib_path.
+    """
+    with open(bib_path, "rb") as f:
+        source = f.read()
+        f.seek(0)
+        spans = list(bibtools.iter_entry_spans(f))
+    return [(source.count(b"\n", 0, start)+1, source.count(b"\n", 0, end)+1,
+            key)
+        for kind, key, start, end in spans]
+
+
+def parse_blg(blg_source, line_maps):
+    """returns a dictionary mapping entry keys to lists of BibTeX messages
+    about them.
+
+    line_maps maps bib file names (as they appear in the blg) to
+    get_line_map results; these are used for messages that only give a
+    line number.  Messages that cannot be attributed to an entry are
+    collected under the empty key.
+    """
+    lines = blg_source.split("\n")
+    messages = {}
+    for index, ln in enumerate(lines):
+        mat = _BLG_MESSAGE.match(ln)
+        if not mat:
+            continue
+        message, key = ln.strip(), ""
+
+        location = _BLG_LOCATION.search(ln)
+        if not location and index+1<len(lines):
+            location = _BLG_LOCATION.match(lines[index+1])
+        if location:
+            line_no, file_name = int(location.group(1)), location.group(2)
+            for first, last, entry_key in line_maps.get(
+                    os.path.basename(file_name.strip()), []):
+                if first<=line_no<=last:
+                    key = entry_key
+                    break
+        else:
+            mat = _BLG_KEY.search(ln)
+            if mat:
+                key = mat.group(1)
+
+        messages.setdefault(key, []).append(message)
+    return messages
+
+
+def run_bibtex(work_dir, n_runs):
+    """runs BibTeX on all entries of BIB_NAMES in work_dir n_runs times.
+
+    This returns the .bbl, the .blg, and the best wall clock time.
+    """
+    for name in BIB_NAMES:
+        shutil.copy(os.path.join(IVOATEX_DIR, name+".bib"), work_dir)
+    with open(os.path.join(work_dir, "lint.aux"), "w") as f:
+        f.write("\\citation{*}\n\\bibdata{%s}\n\\bibstyle{ivoa}\n"%
+            ",".join(BIB_NAMES))
+
+    env = dict(os.environ, BSTINPUTS=os.path.abspath(IVOATEX_DIR)+":")
+    times = []
+    for _ in range(n_runs):
+        start_time = time.time()
+        proc = subprocess.run(["bibtex", "lint"], cwd=work_dir, env=env,
+            stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+        times.append(time.time()-start_time)
+    # BibTeX exits with 1 on warnings and 2 on errors.
+    if proc.returncode>2:
+        raise IOError("bibtex failed with status %d"%proc.returncode)
+
+    with open(os.path.join(work_dir, "lint.bbl"), encoding="utf-8",
+            errors="replace") as f:
+        bbl = f.read()
+    with open(os.path.join(work_dir, "lint.blg"), encoding="utf-8",
+            errors="replace") as f:
+        blg = f.read()
+    return bbl, blg, min(times)
+
+
+def collect_results(n_runs):
+    """returns a dictionary of current renderings, messages, and timing.
+
+    This has the format of the golden file.
+    """
+    with tempfile.TemporaryDirectory("ivoatex-bst") as work_dir:
+        bbl, blg, seconds = run_bibtex(work_dir, n_runs)
+        line_maps = dict((name+".bib",
+                get_line_map(os.path.join(work_dir, name+".bib")))
+            for name in BIB_NAMES)
+
+    return {
+        "seconds": seconds,
+        "entries": split_bbl(bbl),
+        "messages": parse_blg(blg, line_maps)}
+
+
+def compare(golden, current, max_slowdown):
+    """returns a list of (is_failure, message) comparing current to golden
+    results.
+    """
+    findings = []
+    for key in sorted(set(golden["entries"])-set(current["entries"])):
+        findings.append((False, "removed: %s"%key))
+    for key in sorted(set(current["entries"])-set(golden["entries"])):
+        findings.append((False, "new: %s"%key))
+    for key in sorted(set(current["entries"])&set(golden["entries"])):
+        if current["entries"][key]!=golden["entries"][key]:
+            findings.append((True, "changed: %s\n  was: %s\n  now: %s"%(
+                key, golden["entries"][key], current["entries"][key])))
+
+    for key, messages in sorted(current["messages"].items()):
+        known = set(golden["messages"].get(key, []))
+        for message in messages:
+            if message not in known:
+                findings.append((True,
+                    "new message for %s: %s"%(key or "(no entry)", message)))
+
+    ratio = current["seconds"]/max(golden["seconds"], 1e-6)
+    findings.append((ratio>max_slowdown,
+        "bibtex time: %.3f s (golden: %.3f s, ratio %.2f)"%(
+            current["seconds"], golden["seconds"], ratio)))
+    return findings
+
+
+def parse_command_line():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Lint and benchmark ivoa.bst on all entries of"
+            " ivoabib.bib and docrepo.bib.")
+    parser.add_argument("--update", action="store_true",
+        help="Write the current results to the golden file.")
+    parser.add_argument("--runs", type=int, default=5,
+        help="Number of BibTeX runs to time; the best counts"
+            " (default: %(default)s).")
+    parser.add_argument("--max-slowdown", type=float, default=1.5,
+        help="Fail if BibTeX is more than this factor slower than in the"
+            " golden run (default: %(default)s).")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_command_line()
+    try:
+        current = collect_results(args.runs)
+    except (IOError, OSError) as ex:
+        sys.exit("Cannot run bibtex: %s"%ex)
+
+    n_messages = sum(len(m) for m in current["messages"].values())
+    print("ivoa.bst: %d entries, %d BibTeX message(s), %.3f s"%(
+        len(current["entries"]), n_messages, current["seconds"]))
+
+    if args.update:
+        with open(GOLDEN_PATH, "w", encoding="utf-8") as f:
+            json.dump(current, f, indent=1, sort_keys=True)
+        print("Golden output updated.")
+        return
+
+    try:
+        with open(GOLDEN_PATH, encoding="utf-8") as f:
+            golden = json.load(f)
+    except IOError:
+        for key, messages in sorted(current["messages"].items()):
+            for message in messages:
+                print("%s: %s"%(key or "(no entry)", message))
+        sys.exit("No golden output; review the above and run with --update.")
+
+    findings = compare(golden, current, args.max_slowdown)
+    for is_failure, message in findings:
+        print(("FAIL " if is_failure else "     ")+message)
+    if any(is_failure for is_failure, _ in findings):
+        sys.exit(1)
+
+
+############## Tests of the parsing (run with python3 -m pytest lint-bst.py)
+
+def test_split_bbl():
+    assert split_bbl("\\begin{thebibliography}{xx}\n\n"
+        "\\harvarditem[A et~al.]{{IVOA} Alpha}{2001}{t1}\n"
+        "Alpha, A.\n\n"
+        "\\harvarditem{Bravo}{2002}{std:t2}\nBravo, B.\n\n"
+        "\\end{thebibliography}\n")=={
+            "t1": "\\harvarditem[A et~al.]{{IVOA} Alpha}{2001}{t1}\n"
+                "Alpha, A.",
+            "std:t2": "\\harvarditem{Bravo}{2002}{std:t2}\nBravo, B."}
+
+
+def test_parse_blg():
+    line_maps = {"x.bib": [(1, 4, "first"), (6, 9, "second")]}
+    assert parse_blg(
+        "Database file #1: x.bib\n"
+        "Warning--entry type for \"second\" isn't style-file defined\n"
+        "--line 6 of file x.bib\n"
+        "Warning--empty journal in first\n"
+        "I was expecting a `,' or a `}'---line 8 of file x.bib\n"
+        "Warning--I didn't find a database entry for \"missing\"\n"
+        "Warning--something else\n"
+        "(There were 4 warnings)\n", line_maps)=={
+            "second": [
+                "Warning--entry type for \"second\" isn't style-file defined",
+                "I was expecting a `,' or a `}'---line 8 of file x.bib"],
+            "first": ["Warning--empty journal in first"],
+            "missing": [
+                "Warning--I didn't find a database entry for \"missing\""],
+            "": ["Warning--something else"]}
+
+
+def test_compare():
+    golden = {"seconds": 1, "entries": {"a": "A", "b": "B"},
+        "messages": {"a": ["Warning--old"]}}
+    current = {"seconds": 2, "entries": {"a": "A", "c": "C"},
+        "messages": {"a": ["Warning--old", "Warning--new"]}}
+    findings = compare(golden, current, 1.5)
+    assert [f[0] for f in findings]==[False, False, True, True]
+    assert findings[2][1]=="new message for a: Warning--new"
+
+
+if __name__=="__main__":
+    main()
@@ -6,25 +6,48 @@
 # Generarated sections are between % GENERATED: <command>
 # and % /GENERATED.  They are supposed to contain the output of
 # <command>.  <command> get shell-expanded, but since it gets executed
-# anyway, it's not even worth doing shell injection.
+# anyway, it's not even worth doing shell injection.  Commands starting
+# with a bang call builtins registered with register_builtin instead.
 #
 # When this script finishes, it either has updated all sections or
 # stopped with an error message of a failed command, in which case the
 # original file is unchanged.
+#
+# The results of builtins are cached in .ivoatex-cache/generated (see
+# ResultCache); pass --no-cache or --refresh to bypass that cache.
+# Results of !taptable and !vocterms are re-computed once they are older
+# than --http-max-age hours, so upstream changes are eventually picked up.
+#
+# The HTTP responses !taptable and !vocterms work from can be recorded to
+# and replayed from a directory (see HTTPCache and --http-cache).
 
+from concurrent import futures
 from io import StringIO
 import csv
+import functools
+import hashlib
+import json
+import multiprocessing
 import os
 import re
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 
 try:
     import requests
 except ImportError:
     # silently fail for now; !taptable and !vocterms will not work without
-    # requests, though
-    pass
+    # requests (except when replaying from an HTTPCache), though
+    requests = None
+
+try:
+    from lxml import etree
+except ImportError:
+    # !schemadoc then runs xsltproc for each type
+    etree = None
 
 class ExecError(Exception):
     def __init__(self, command, stderr):
@@ -34,17 +57,108 @@ class ExecError(Exception):
         self.command, self.stderr = command, stderr
 
 
+class Builtin(object):
+    """a function callable from GENERATED blocks as !name.
+
+    See register_builtin for what the attributes mean.
+    """
+    def __init__(self, name, func, kind, get_inputs, env_vars, uses_http):
+        self.name, self.func, self.kind = name, func, kind
+        self.get_inputs, self.env_vars = get_inputs, env_vars
+        self.uses_http = uses_http
+
+
+# maps names of builtins to Builtin instances; fill this through the
+# register_builtin decorator.
+BUILTINS = {}
+
+
+def register_builtin(name, kind="io", get_inputs=None, env_vars=(),
+        uses_http=False):
+    """returns a decorator registering a function as the builtin name.
+
+    kind is "io" for builtins that mostly wait for the network or
+    subprocesses, or "cpu" for those computing in this process.  When
+    running in parallel, io builtins run in threads, cpu builtins in
+    separate processes.
+
+    get_inputs, if given, is a function that, called with the builtin's
+    arguments, returns the names of the files the result depends on, and
+    env_vars is a sequence of the names of environment variables it depends
+    on.  Builtins without get_inputs are not cached.
+
+    uses_http must be true for builtins retrieving data through http_get;
+    their results are not cached while recording or replaying HTTP
+    responses (see HTTPCache).
+
+    The decorated function must return the new content of the block as
+    a string.
+    """
+    def register(func):
+        BUILTINS[name] = Builtin(name, func, kind, get_inputs, env_vars,
+            uses_http)
+        return func
+    return register
+
+
+# serialises report's writes from the threads in compute_blocks
+_OUTPUT_LOCK = threading.Lock()
+
+
+def report(message):
+    """writes message as a line to stdout.
+
+    Use this rather than print in code that may run in compute_blocks'
+    threads; print writes the text and the line end separately, so lines
+    from different threads could run together.
+    """
+    with _OUTPUT_LOCK:
+        sys.stdout.write(message+"\n")
+        sys.stdout.flush()
+
+
+def run_builtin(name, args):
+    """returns the output of the builtin name called with args as a string.
+
+    This is a top-level function so it can be used with a process pool.
+    """
+    return BUILTINS[name].func(*args)
+
+
+# long URLs in documentation strings are a pain because TeX
+# will not break them.  Let's see if things break badly if we
+# guess URLs and mark them up.  URL detection REs are of course
+# black art.  If we want to get fancy here, try
+# docutils.parsers.rst.states, look for uri=.
+_URL_PATTERN = re.compile(r"(https?://[^/]*/[^\s]*?)([.,)]*(\s|$))")
+
+_TEX_ESCAPE_PATTERN = re.compile(r"\\(.)")
+
+
+def _replace_url(mat):
+    # we need to undo LaTeX escapes; LaTeX url could cope with them
+    # but tth doesn't.
+    return ("\\url{"
+        +_TEX_ESCAPE_PATTERN.sub(r"\1", mat.group(1))
+        +"}"+mat.group(2))
+
+
 def escape_for_TeX(tx):
     """returns tx with TeX's standard active (and other magic) characters
     escaped.
+
+    URLs are marked up with \\url.
     """
     # the $ is tricky because blindly replacing it with \$ will clash
-    # with my backslash replacement.  Let's hope nobody ever has a
-    # sterling sign in their schemas...
-    escaped = tx.replace("$", "£",
-        ).replace("\\", "$\\backslash$"
-        ).replace("£", "\\$"
-        ).replace("&", "\\&"
+    # with the backslash replacement; so, we replace the dollars between
+    # the backslashes.
+    if "\\" in tx:
+        escaped = "$\\backslash$".join(part.replace("$", "\\$")
+            for part in tx.split("\\"))
+    else:
+        escaped = tx.replace("$", "\\$")
+
+    escaped = escaped.replace("&", "\\&"
         ).replace("#", "\\#"
         ).replace("%", "\\%"
         ).replace("_", "\\_"
@@ -52,40 +166,199 @@ def escape_for_TeX(tx):
         ).replace("{", "\\{"
         ).replace('"', '{"}').strip()
 
-    # long URLs in documentation strings are a pain because TeX
-    # will not break them.  Let's see if things break badly if we
-    # guess URLs and mark them up.  URL detection REs are of course
-    # black art.  If we want to get fancy here, try
-    # docutils.parsers.rst.states, look for uri=.
+    if "://" not in escaped:
+        return escaped
+    return _URL_PATTERN.sub(_replace_url, escaped)
 
-    def replace_url(mat):
-      # we need to undo LaTeX escapes; LaTeX url could cope with them
-      # but tth doesn't.
-      return ("\\url{"
-        +re.sub(r"\\(.)", r"\1", mat.group(1))
-        +"}"+mat.group(2))
 
-    return re.sub(
-      r"(https?://[^/]*/[^\s]*?)([.,)]*(\s|$))",
-      replace_url,
-      escaped)
+HTTP_TIMEOUT = 60
+HTTP_RETRIES = 3
 
 
-def cmd_taptable(table_name):
-    """returns an ivoatex-formatted table describing table_name in the
-    TAP sevice at $TAPURL.
+class HTTPCache(object):
+    """a persistent store of HTTP responses for the builtins that
+    retrieve data from the network.
 
-    This needs the requests module installed, and TAPURL must be defined
-    in the makefile.
+    Each response is kept in cache_dir as <key>.body (the raw response
+    body, e.g., TAP CSV or desise JSON) and <key>.meta (a JSON document
+    with the request and the validators of the response).  The key is
+    a hash over the URL, the parameters and the request headers.
+
+    mode is one of
+
+    * record -- always ask the server (conditionally, if there is a
+      stored response) and store what comes back.
+    * replay -- never touch the network; fail if there is no stored
+      response.
+    * revalidate -- serve stored responses after revalidating them
+      with ETag/Last-Modified; if the network is unavailable, serve them
+      anyway.  Responses not stored yet are retrieved and stored.
+    """
+    modes = ["record", "replay", "revalidate"]
+
+    def __init__(self, cache_dir, mode="revalidate"):
+        if mode not in self.modes:
+            raise ValueError("Invalid HTTP cache mode: %s"%mode)
+        self.cache_dir, self.mode = cache_dir, mode
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get_key(self, url, params, headers):
+        return hashlib.sha256(json.dumps([url,
+                sorted((params or {}).items()),
+                sorted((headers or {}).items())]
+            ).encode("utf-8")).hexdigest()
+
+    def load(self, key):
+        """returns a pair of metadata dict and body for key, or
+        (None, None) if nothing is stored for key.
+        """
+        path = os.path.join(self.cache_dir, key)
+        try:
+            with open(path+".meta", encoding="utf-8") as f:
+                meta = json.load(f)
+            with open(path+".body", "rb") as f:
+                return meta, f.read().decode("utf-8")
+        except IOError:
+            return None, None
+
+    def store(self, key, meta, body):
+        """saves body and its metadata under key.
+        """
+        path = os.path.join(self.cache_dir, key)
+        for ext, payload in [
+                (".body", body.encode("utf-8")),
+                (".meta", json.dumps(meta, indent=2).encode("utf-8"))]:
+            with open(path+ext+".tmp", "wb") as f:
+                f.write(payload)
+            os.replace(path+ext+".tmp", path+ext)
+
+    def get(self, url, params=None, headers=None):
+        """returns the body of the response to a GET of url with params
+        and headers, going to the network as mode says.
+        """
+        key = self.get_key(url, params, headers)
+        meta, body = self.load(key)
+
+        if self.mode=="replay":
+            if meta is None:
+                raise IOError("No recorded response for %s %s"%(
+                    url, params or ""))
+            return body
+
+        validators = {}
+        if meta is not None:
+            if meta.get("etag"):
+                validators["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                validators["If-Modified-Since"] = meta["last_modified"]
+
+        try:
+            reply = fetch_from_network(url, params,
+                dict(headers or {}, **validators))
+        except IOError:
+            if meta is None or self.mode=="record":
+                raise
+            sys.stderr.write("Network failure, using stored response for"
+                " %s\n"%url)
+            return body
+
+        if reply.status_code==304 and meta is not None:
+            return body
+
+        body = reply.text
+        self.store(key, {
+                "url": url,
+                "params": params,
+                "headers": headers,
+                "etag": reply.headers.get("ETag"),
+                "last_modified": reply.headers.get("Last-Modified"),
+                "retrieved": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())},
+            body)
+        return body
+
+
+# The HTTPCache to use in http_get; main sets this from the command line.
+HTTP_CACHE = None
+
+
+def fetch_from_network(url, params, headers):
+    """returns a requests response for a GET of url with params and
+    headers.
+
+    Failing requests are retried a few times; if all attempts fail,
+    an IOError is raised.  HTTP error codes are turned into IOErrors, too.
+    """
+    if requests is None:
+        raise IOError("Retrieving %s needs the python requests module"%url)
+
+    for attempt in range(HTTP_RETRIES):
+        try:
+            reply = requests.get(url, params=params, headers=headers,
+                timeout=HTTP_TIMEOUT)
+            reply.raise_for_status()
+            return reply
+        except requests.RequestException as ex:
+            last_exception = ex
+            if attempt<HTTP_RETRIES-1:
+                time.sleep(2**attempt)
+
+    raise IOError("Failed to retrieve %s: %s"%(url, last_exception))
+
+
+def http_get(url, params=None, headers=None):
+    """returns the (decoded) body of the response to a GET of url.
+
+    This goes through HTTP_CACHE if there is one.
+    """
+    if HTTP_CACHE is not None:
+        return HTTP_CACHE.get(url, params, headers)
+    return fetch_from_network(url, params, headers).text
+
+
+# Rows from TAP_SCHEMA.columns for the tables in !taptable blocks, as
+# retrieved by prefetch_taptables; this is so we only need a single
+# TAP query per document.
+_TAPTABLE_ROWS = {}
+
+
+def fetch_taptable_rows(table_names):
+    """returns a dictionary mapping each name in table_names to the
+    list of its rows in TAP_SCHEMA.columns at the TAP service at $TAPURL.
+
+    The rows are dictionaries with (at least) the keys column_name,
+    datatype, size, and description.  All tables are retrieved in a single
+    TAP query.
     """
     tap_url = os.environ["TAPURL"]
-    reply = requests.get(tap_url+"/sync", params={
+    reply_text = http_get(tap_url+"/sync", params={
         "LANG": "ADQL",
         "REQUEST": "doQuery",
-        "QUERY": 'SELECT column_name, datatype, "size", description'
-            ' FROM TAP_SCHEMA.columns WHERE table_name=\'%s\''%table_name,
+        "QUERY": 'SELECT table_name, column_name, datatype, "size",'
+            ' description FROM TAP_SCHEMA.columns WHERE table_name IN (%s)'%(
+                ", ".join("'%s'"%name.replace("'", "''")
+                    for name in table_names)),
         "FORMAT": "csv"})
 
+    rows_by_table = dict((name, []) for name in table_names)
+    for row in csv.DictReader(StringIO(reply_text)):
+        rows_by_table.setdefault(row.pop("table_name"), []).append(row)
+    return rows_by_table
+
+
+def prefetch_taptables(table_names):
+    """retrieves the TAP_SCHEMA.columns rows for all table_names
+    for later use by cmd_taptable.
+    """
+    table_names = sorted(set(table_names)-set(_TAPTABLE_ROWS))
+    if table_names:
+        report("Fetching columns for %s"%(", ".join(table_names)))
+        _TAPTABLE_ROWS.update(fetch_taptable_rows(table_names))
+
+
+def format_taptable(table_name, rows):
+    """returns an ivoatex-formatted table describing table_name with the
+    TAP_SCHEMA.columns rows as returned by fetch_taptable_rows.
+    """
     res = ["\\begin{inlinetable}\n\\small"
         r"\begin{tabular}{p{0.28\textwidth}p{0.2\textwidth}p{0.66\textwidth}}"
         r"\sptablerule"
@@ -93,7 +366,7 @@ def cmd_taptable(table_name):
         r"and descriptions for the \texttt{%s} table}}\\"%table_name,
         r"\sptablerule"]
 
-    for row in csv.DictReader(StringIO(reply.text)):
+    for row in rows:
         row = dict((key, escape_for_TeX(value))
             for key, value in row.items())
         if row["size"]=="":
@@ -114,6 +387,60 @@ def cmd_taptable(table_name):
     return "\n".join(res)
 
 
+@register_builtin("taptable", "io",
+    get_inputs=lambda table_name: [], env_vars=["TAPURL"], uses_http=True)
+def cmd_taptable(table_name):
+    """returns an ivoatex-formatted table describing table_name in the
+    TAP sevice at $TAPURL.
+
+    This needs the requests module installed, and TAPURL must be defined
+    in the makefile.
+
+    process_all arranges for all tables in a document to be fetched
+    at once (see prefetch_taptables); if table_name has not been fetched
+    before, this will do its own query.
+    """
+    if table_name not in _TAPTABLE_ROWS:
+        prefetch_taptables([table_name])
+    return format_taptable(table_name, _TAPTABLE_ROWS[table_name])
+
+
+SCHEMADOC_XSLT = "ivoatex/schemadoc.xslt"
+
+ESCAPE_FOR_TEX_PATTERN = re.compile("(?s)escape-for-TeX{{{(.*?)}}}")
+
+# Per-thread compiled schemadoc stylesheet and parsed schemas for
+# run_schemadoc_xslt (lxml trees and stylesheets should not be shared
+# between threads).
+_XSLT_STATE = threading.local()
+
+
+def run_schemadoc_xslt(schema_name, dest_type):
+    """returns the output of schemadoc.xslt for dest_type within schema_name.
+
+    If lxml is available, the stylesheet and the schema are only parsed
+    once per thread, and all types are documented from these.  Otherwise,
+    we run xsltproc.
+    """
+    if etree is None:
+        return subprocess.check_output(["xsltproc",
+            "--stringparam", "destType", dest_type,
+            SCHEMADOC_XSLT, schema_name]).decode("utf-8")
+
+    if not hasattr(_XSLT_STATE, "transform"):
+        _XSLT_STATE.transform = etree.XSLT(etree.parse(SCHEMADOC_XSLT))
+        _XSLT_STATE.schemas = {}
+    if schema_name not in _XSLT_STATE.schemas:
+        _XSLT_STATE.schemas[schema_name] = etree.parse(schema_name)
+
+    result = _XSLT_STATE.transform(_XSLT_STATE.schemas[schema_name],
+        destType=etree.XSLT.strparam(dest_type))
+    return bytes(result).decode("utf-8")
+
+
+# With lxml, schemadoc is CPU-bound; without, it just waits for xsltproc.
+@register_builtin("schemadoc", "io" if etree is None else "cpu",
+    get_inputs=lambda schema_name, dest_type: [schema_name, SCHEMADOC_XSLT])
 def cmd_schemadoc(schema_name, dest_type):
     """returns TeX source for the generated documentation of dest_type within
     schema_name.
@@ -121,48 +448,201 @@ def cmd_schemadoc(schema_name, dest_type):
     We cannot just use the output of the stylesheet, as TeX escapes in
     XSLT1 are an inefficient nightmare.
     """
-    output = subprocess.check_output(["xsltproc",
-        "--stringparam", "destType", dest_type,
-        "ivoatex/schemadoc.xslt", schema_name]).decode("utf-8")
+    output = run_schemadoc_xslt(schema_name, dest_type)
     # for the TeX escaping, we simply assume there's no nesting
     # of escaped sections, and no annotation uses our magic strings.
     return "\\begin{generated}\n%s\n\\end{generated}\n"%(
-        re.sub("(?s)escape-for-TeX{{{(.*?)}}}",
+        ESCAPE_FOR_TEX_PATTERN.sub(
             lambda mat: escape_for_TeX(mat.group(1)), output))
 
 
+@register_builtin("vocterms", "io",
+    get_inputs=lambda vocabulary_name: [], env_vars=["VOCURL"],
+    uses_http=True)
 def cmd_vocterms(vocabulary_name):
     """returns TeX source for the terms (identifiers) in an IVOA vocabulary.
 
-    vocabulary_name is whatever is after http://www.ivoa.net/rdf.
+    vocabulary_name is whatever is after http://www.ivoa.net/rdf.  To
+    use a different vocabulary repository, set VOCURL in the makefile
+    (with a trailing slash).
     """
-    terms = requests.get("http://www.ivoa.net/rdf/"+vocabulary_name,
-            headers={"accept": "application/x-desise+json"}
-        ).json()["terms"]
+    voc_url = os.environ.get("VOCURL", "http://www.ivoa.net/rdf/")
+    terms = json.loads(http_get(voc_url+vocabulary_name,
+            headers={"accept": "application/x-desise+json"}))["terms"]
     identifiers = [key for key, props in terms.items()
         if "deprecated" not in props]
     return ",\n".join(r"\textsl{{{}}}".format(escape_for_TeX(id))
         for id in sorted(identifiers, key=lambda t: t.lower()))
 
 
-def process_one_builtin(command):
+DEFAULT_CACHE_DIR = ".ivoatex-cache/generated"
+DEFAULT_CACHE_SIZE = 20*1024*1024
+# results of builtins retrieving data from the network are re-computed
+# after this many seconds
+DEFAULT_HTTP_MAX_AGE = 24*3600
+
+
+def hash_file(path):
+    """returns a hex sha256 of the content of the file at path.
+
+    For non-existing files, a constant is returned, as the builtin will
+    presumably fail anyway.
+    """
+    hash = hashlib.sha256()
+    try:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1<<16), b""):
+                hash.update(chunk)
+    except IOError:
+        return "missing"
+    return hash.hexdigest()
+
+
+class ResultCache(object):
+    """an on-disk cache for the results of GENERATED builtins.
+
+    The cache keys are hashes over the builtin command, the hashes of
+    the files and the values of the environment variables declared when
+    registering the builtin, and the source of this script (so updating
+    ivoatex invalidates everything).  Shell commands are not cached,
+    because we cannot know their inputs.
+
+    Entries are files named after the key in cache_dir.  When the cache
+    grows beyond max_size bytes, the least recently used entries (by
+    access time) are removed in prune.
+
+    Our keys cannot know when remote data changes.  Hence, results of
+    builtins registered with uses_http are only used for http_max_age
+    seconds after they were computed (by modification time); see
+    get_max_age.
+
+    With refresh, existing entries are ignored (but new results are still
+    stored).
+
+    With skip_http, builtins registered with uses_http are not cached.
+    This is for recording and replaying HTTP responses, where these
+    builtins must actually make their requests, and make them in the same
+    way every time.
+    """
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR,
+            max_size=DEFAULT_CACHE_SIZE, refresh=False, skip_http=False,
+            http_max_age=DEFAULT_HTTP_MAX_AGE):
+        self.cache_dir, self.max_size = cache_dir, max_size
+        self.refresh, self.skip_http = refresh, skip_http
+        self.http_max_age = http_max_age
+        self.own_hash = hash_file(__file__)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get_key(self, command):
+        """returns the cache key for the GENERATED command, or None if
+        command cannot be cached.
+        """
+        if not command.startswith("!"):
+            return None
+        parts = command[1:].split()
+        builtin = BUILTINS.get(parts[0]) if parts else None
+        if builtin is None or builtin.get_inputs is None:
+            return None
+        if self.skip_http and builtin.uses_http:
+            return None
+
+        try:
+            files = builtin.get_inputs(*parts[1:])
+        except TypeError:
+            # wrong number of arguments; let the builtin complain.
+            return None
+
+        hash = hashlib.sha256()
+        for item in [self.own_hash, " ".join(parts)
+                ]+["%s=%s"%(f, hash_file(f)) for f in files
+                ]+["%s=%s"%(v, os.environ.get(v, ""))
+                    for v in builtin.env_vars]:
+            hash.update(item.encode("utf-8")+b"\0")
+        return hash.hexdigest()
+
+    def get_max_age(self, command):
+        """returns the number of seconds a cached result for the GENERATED
+        command may be used, or None if it does not expire.
+        """
+        parts = command[1:].split()
+        builtin = BUILTINS.get(parts[0]) if parts else None
+        if builtin is not None and builtin.uses_http:
+            return self.http_max_age
+        return None
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, key, max_age=None):
+        """returns the cached result for key, or None if there is none
+        or it is older than max_age seconds.
+        """
+        if self.refresh:
+            return None
+        path = self.get_path(key)
+        try:
+            mtime = os.stat(path).st_mtime
+            if max_age is not None and time.time()-mtime>max_age:
+                return None
+            with open(path, "rb") as f:
+                result = f.read().decode("utf-8")
+        except IOError:
+            return None
+        # Mark as recently used for prune, keeping the mtime for max_age
+        os.utime(path, (time.time(), mtime))
+        return result
+
+    def put(self, key, result):
+        """stores result under key.
+        """
+        path = self.get_path(key)
+        with open(path+".tmp%d"%threading.get_ident(), "wb") as f:
+            f.write(result.encode("utf-8"))
+        os.replace(f.name, path)
+
+    def prune(self):
+        """removes least recently used entries until the cache is smaller
+        than max_size.
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = self.get_path(name)
+            stat = os.stat(path)
+            entries.append((stat.st_atime, stat.st_size, path))
+
+        total_size = sum(e[1] for e in entries)
+        for _, size, path in sorted(entries):
+            if total_size<=self.max_size:
+                break
+            os.unlink(path)
+            total_size -= size
+
+
+def process_one_builtin(command, cpu_pool=None):
     """processes a GENERATED block containing a call to a builtin function.
 
     In the GENERATED opening line, an internal call is signified with a
     leading bang (which process_one already removes).
 
     What's left is a command spec and blank-separated arguments.  The command
-    spec is prepended with cmd_ and then used as a function name to call.
-    The remaining material is split and passed to the function as positional
-    arguments.
+    spec is looked up in BUILTINS, and the remaining material is split and
+    passed to the builtin's function as positional arguments.
+
+    If cpu_pool is given, builtins of kind cpu are run there; it must be
+    a futures executor.
 
-    The function returns the return value of function, which must be a
-    string for this to work.
+    The builtin's output is returned as a string.
     """
     try:
         parts = command.split()
-        print("Calling %s(%s)"%("cmd_"+parts[0], ", ".join(parts[1:])))
-        return globals()["cmd_"+parts[0]](*parts[1:])
+        if not parts or parts[0] not in BUILTINS:
+            raise ExecError(command, "No builtin %s"%(parts or [""])[0])
+        report("Calling %s(%s)"%(
+            BUILTINS[parts[0]].func.__name__, ", ".join(parts[1:])))
+
+        if cpu_pool is not None and BUILTINS[parts[0]].kind=="cpu":
+            return cpu_pool.submit(run_builtin, parts[0], parts[1:]).result()
+        return run_builtin(parts[0], parts[1:])
     except Exception as ex:
         ex.command = command
         raise
@@ -177,7 +657,7 @@ def process_one_exec(command):
     The output of the command is returned; in case of failures, an ExecError
     is raised.
     """
-    print("Executing %s"%command)
+    report("Executing %s"%command)
     f = subprocess.Popen(command, shell=True,
         stdout=subprocess.PIPE, stderr=subprocess.PIPE,
         close_fds=True, bufsize=-1)
@@ -188,34 +668,225 @@ def process_one_exec(command):
     return stdout.decode("utf-8")
 
 
-def process_one(match_obj):
+def process_one(match_obj, cache=None, profile=None, cpu_pool=None):
     """processes one GENERATED block, executing the specified command and
     returning its output.
 
+    If a ResultCache is passed in cache, results are taken from there if
+    possible.
+
+    cpu_pool is passed on to process_one_builtin.
+
+    If a list is passed in profile, a dictionary with the command, the
+    wall time spent, the length of the output and whether the result came
+    from the cache ("hit", "miss", or "" for uncacheable blocks) is
+    appended to it.
+
     This is intended to be used as a callback within re.sub as executed
     by process_all.
     """
+    start_time = time.time()
     command = match_obj.group("command")
-    if command.startswith("!"):
-        result = process_one_builtin(command[1:])
+    key = cache.get_key(command) if cache else None
+    result = cache.get(key, cache.get_max_age(command)) if key else None
+    cache_status = "" if key is None else "miss"
+
+    if result is not None:
+        report("Using cached result for %s"%command)
+        cache_status = "hit"
     else:
-        result = process_one_exec(command)
+        if command.startswith("!"):
+            result = process_one_builtin(command[1:], cpu_pool)
+        else:
+            result = process_one_exec(command)
+        if key:
+            cache.put(key, result)
+
+    if profile is not None:
+        profile.append({
+            "line": match_obj.string.count("\n", 0, match_obj.start())+1,
+            "command": command.strip(),
+            "seconds": time.time()-start_time,
+            "bytes": len(result.encode("utf-8")),
+            "cache": cache_status})
 
     return ("%% GENERATED: %s\n"%(command.strip())
         +result
         +"\n% /GENERATED")
 
 
-def process_all(content):
+GENERATED_PATTERN = re.compile(r"(?sm)^%\s+GENERATED:\s+(?P<command>.*?)$"
+    ".*?"
+    r"%\s+/GENERATED")
+
+
+def splice_results(content, matches, results):
+    """returns content with the material matched in matches replaced by
+    the corresponding items in results.
+
+    matches must be in source order and must not overlap, which is what
+    finditer gives us.
+    """
+    parts, last_end = [], 0
+    for mat, result in zip(matches, results):
+        parts.append(content[last_end:mat.start()])
+        parts.append(result)
+        last_end = mat.end()
+    parts.append(content[last_end:])
+    return "".join(parts)
+
+
+def prefetch_builtins(matches, cache=None):
+    """does bulk retrievals for the GENERATED blocks matched in matches.
+
+    Right now, this means one TAP query for all !taptable blocks
+    not already in cache.
+    """
+    table_names = []
+    for mat in matches:
+        command = mat.group("command")
+        parts = command.split()
+        if len(parts)!=2 or parts[0]!="!taptable":
+            continue
+        if cache:
+            key = cache.get_key(command)
+            if key and cache.get(key, cache.get_max_age(command)
+                    ) is not None:
+                continue
+        table_names.append(parts[1])
+
+    if table_names:
+        try:
+            prefetch_taptables(table_names)
+        except Exception as ex:
+            ex.command = "!taptable %s (prefetch)"%" ".join(table_names)
+            raise
+    return table_names
+
+
+def is_cpu_bound(command):
+    """returns true if the GENERATED command calls a builtin of kind cpu.
+    """
+    parts = command.split()
+    return bool(parts and parts[0].startswith("!")
+        and parts[0][1:] in BUILTINS
+        and BUILTINS[parts[0][1:]].kind=="cpu")
+
+
+def compute_blocks(content, jobs=1, cache=None, profile=None):
+    """returns a pair of a list of GENERATED block matches within content
+    and a list of the new texts for each block.
+
+    cache, if given, is a ResultCache used to avoid re-computing builtins.
+
+    profile, if given, is a list that receives timing information as
+    described in process_one.  The bulk retrievals of prefetch_builtins
+    are recorded as a pseudo-block with line 0.
+
+    With jobs>1, the blocks are handled on a pool of that many threads
+    (which is fine because most of them spend their time waiting for
+    subprocesses and the network).  Builtins of kind cpu are passed on
+    to a pool of up to jobs processes, so they can run while other blocks
+    wait for the network.  The results are still returned in source order.
+
+    Exceptions from within one of the recipes are propagated out; blocks
+    not yet started by then are not run at all.
+    """
+    matches = list(GENERATED_PATTERN.finditer(content))
+    start_time = time.time()
+    prefetched = prefetch_builtins(matches, cache)
+    if profile is not None and prefetched:
+        profile.append({
+            "line": 0,
+            "command": "(prefetch taptable %s)"%(" ".join(prefetched)),
+            "seconds": time.time()-start_time,
+            "bytes": 0,
+            "cache": ""})
+
+    if jobs<2:
+        process = functools.partial(process_one, cache=cache, profile=profile)
+        return matches, list(map(process, matches))
+
+    cpu_pool = None
+    if any(is_cpu_bound(mat.group("command")) for mat in matches):
+        # spawn rather than fork, as we may have threads running.
+        cpu_pool = futures.ProcessPoolExecutor(
+            min(jobs, os.cpu_count() or 1),
+            mp_context=multiprocessing.get_context("spawn"))
+    process = functools.partial(process_one,
+        cache=cache, profile=profile, cpu_pool=cpu_pool)
+
+    pool = futures.ThreadPoolExecutor(jobs)
+    try:
+        results = list(pool.map(process, matches))
+    finally:
+        pool.shutdown(cancel_futures=True)
+        if cpu_pool is not None:
+            cpu_pool.shutdown(cancel_futures=True)
+
+    return matches, results
+
+
+def process_all(content, jobs=1, cache=None):
     """replaces all GENERATED blocks within content.
 
-    Exceptions from within one of the recipes are propagated out.
+    See compute_blocks for the arguments.
+    """
+    return splice_results(content, *compute_blocks(content, jobs, cache))
+
+
+PROFILE_FIELDS = ["line", "command", "seconds", "bytes", "cache"]
+
+
+def write_profile(profile, dest_name):
+    """writes the block profile (see process_one) to dest_name.
+
+    If dest_name ends with .csv, the output is CSV, else JSON.
+    """
+    profile = sorted(profile, key=lambda rec: rec["line"])
+    with open(dest_name, "w", encoding="utf-8", newline="") as f:
+        if dest_name.endswith(".csv"):
+            writer = csv.DictWriter(f, PROFILE_FIELDS)
+            writer.writeheader()
+            writer.writerows(profile)
+        else:
+            json.dump(profile, f, indent=2)
+
+
+def print_profile_summary(profile, total_seconds):
+    """prints a table of the blocks in profile, most expensive first.
     """
-    return re.sub(r"(?sm)^%\s+GENERATED:\s+(?P<command>.*?)$"
-        ".*?"
-        r"%\s+/GENERATED",
-        process_one,
-        content)
+    print("\n%8s %10s %5s %6s  %s"%(
+        "seconds", "bytes", "cache", "line", "command"))
+    for rec in sorted(profile, key=lambda rec: -rec["seconds"]):
+        print("%8.3f %10d %5s %6d  %s"%(
+            rec["seconds"], rec["bytes"], rec["cache"] or "-",
+            rec["line"], rec["command"]))
+    print("%8.3f seconds total for %d blocks; %d cache hits."%(
+        total_seconds,
+        len([rec for rec in profile if rec["line"]]),
+        len([rec for rec in profile if rec["cache"]=="hit"])))
+
+
+def write_atomically(filename, content):
+    """replaces the file filename with the bytes content.
+
+    The data is first written to a temporary file in filename's directory
+    that is then renamed to filename, so filename is always complete.
+    The file mode of filename is preserved.
+    """
+    dir_name = os.path.dirname(os.path.abspath(filename))
+    with tempfile.NamedTemporaryFile(dir=dir_name, delete=False,
+            prefix=".generating-") as f:
+        try:
+            f.write(content)
+            f.flush()
+            if os.path.exists(filename):
+                os.chmod(f.name, os.stat(filename).st_mode & 0o7777)
+        except:
+            os.unlink(f.name)
+            raise
+    os.replace(f.name, filename)
 
 
 def parse_command_line():
@@ -224,25 +895,373 @@ def parse_command_line():
         " in a text file")
     parser.add_argument("filename", action="store", type=str,
         help="File to process (will be overwritten).")
+    parser.add_argument("-j", "--jobs", action="store", type=int,
+        default=1, metavar="N", dest="jobs",
+        help="Compute up to N GENERATED blocks in parallel (default: 1).")
+    parser.add_argument("--no-cache", action="store_false",
+        dest="use_cache",
+        help="Do not use or update the cache of builtin results.")
+    parser.add_argument("--refresh", action="store_true",
+        dest="refresh",
+        help="Re-compute all builtins, updating the cache.")
+    parser.add_argument("--cache-dir", action="store", type=str,
+        default=DEFAULT_CACHE_DIR, metavar="DIR", dest="cache_dir",
+        help="Keep cached builtin results in DIR (default: %(default)s).")
+    parser.add_argument("--http-max-age", action="store", type=float,
+        default=DEFAULT_HTTP_MAX_AGE/3600, metavar="HOURS",
+        dest="http_max_age",
+        help="Re-compute cached results of !taptable and !vocterms older"
+        " than HOURS (default: %(default)s).")
+    parser.add_argument("--cache-size", action="store", type=int,
+        default=DEFAULT_CACHE_SIZE//1024//1024, metavar="MB",
+        dest="cache_size",
+        help="Limit the cache to about MB megabytes (default: %(default)s).")
+    parser.add_argument("--http-cache", action="store", type=str,
+        default=os.environ.get("IVOATEX_HTTP_CACHE"), metavar="DIR",
+        dest="http_cache",
+        help="Record HTTP responses for !taptable and !vocterms in DIR"
+        " and replay them from there (default: $IVOATEX_HTTP_CACHE)."
+        "  You probably want to commit DIR to your document repository.")
+    parser.add_argument("--http-mode", action="store", type=str,
+        default=os.environ.get("IVOATEX_HTTP_MODE", "revalidate"),
+        choices=HTTPCache.modes, dest="http_mode",
+        help="How to use the HTTP cache: record always asks the server,"
+        " replay never does, revalidate (the default) uses stored responses"
+        " if the server says they are still valid or cannot be reached.")
+    parser.add_argument("--changed-only", action="store_true",
+        dest="changed_only",
+        help="Only write the file (and thus change its modification date)"
+        " if at least one block has changed; report the blocks changed.")
+    parser.add_argument("--profile", action="store", type=str,
+        default=None, metavar="FILE", dest="profile",
+        help="Write wall time, output size and cache status for each block"
+        " to FILE (CSV if FILE ends with .csv, JSON otherwise) and print"
+        " a summary.")
     return parser.parse_args()
 
 
 def main():
+    global HTTP_CACHE
     args = parse_command_line()
+    if args.http_cache:
+        HTTP_CACHE = HTTPCache(args.http_cache, args.http_mode)
     with open(args.filename, "rb") as f:
         content = f.read().decode("utf-8")
 
+    cache = None
+    if args.use_cache:
+        cache = ResultCache(args.cache_dir,
+            args.cache_size*1024*1024, args.refresh,
+            skip_http=HTTP_CACHE is not None
+                and HTTP_CACHE.mode in ["record", "replay"],
+            http_max_age=args.http_max_age*3600)
+
+    profile = [] if args.profile else None
+    start_time = time.time()
     try:
-        content = process_all(content)
+        matches, results = compute_blocks(content, args.jobs, cache, profile)
     except ExecError as ex:
         sys.stderr.write("Command %s failed.  Message below.  Aborting.\n"%
             ex.command)
         sys.stderr.write(ex.stderr+"\n")
         sys.exit(1)
+    except IOError as ex:
+        sys.stderr.write("Command %s failed: %s.  Aborting.\n"%(
+            getattr(ex, "command", "(unknown)"), ex))
+        sys.exit(1)
+
+    if cache:
+        cache.prune()
+
+    if profile is not None:
+        write_profile(profile, args.profile)
+        print_profile_summary(profile, time.time()-start_time)
+
+    if args.changed_only:
+        changed = [mat.group("command").strip()
+            for mat, result in zip(matches, results)
+            if mat.group()!=result]
+        for command in changed:
+            print("Changed: %s"%command)
+        if not changed:
+            print("No generated content changed; leaving %s alone."%
+                args.filename)
+            return
+
+    write_atomically(args.filename,
+        splice_results(content, matches, results).encode("utf-8"))
+
+
+################ Tests (run with python -m pytest update_generated.py)
+
+def _escape_for_TeX_reference(tx):
+    """is the escape_for_TeX of ivoatex 1.3, as an oracle for the tests
+    and test/bench-escape.py.
+    """
+    escaped = tx.replace("$", "£",
+        ).replace("\\", "$\\backslash$"
+        ).replace("£", "\\$"
+        ).replace("&", "\\&"
+        ).replace("#", "\\#"
+        ).replace("%", "\\%"
+        ).replace("_", "\\_"
+        ).replace("}", "\\}"
+        ).replace("{", "\\{"
+        ).replace('"', '{"}').strip()
+
+    def replace_url(mat):
+      return ("\\url{"
+        +re.sub(r"\\(.)", r"\1", mat.group(1))
+        +"}"+mat.group(2))
+
+    return re.sub(
+      r"(https?://[^/]*/[^\s]*?)([.,)]*(\s|$))",
+      replace_url,
+      escaped)
+
+
+def _register_test_builtin(monkeypatch, calls):
+    """registers a builtin !echo_file depending on its file argument and
+    $TESTVAR, which records its calls in the list calls.
+    """
+    def echo_file(path):
+        calls.append(path)
+        with open(path) as f:
+            return f.read()
+    monkeypatch.setitem(BUILTINS, "echo_file", Builtin("echo_file",
+        echo_file, "io", lambda path: [path], ["TESTVAR"], False))
+
+
+def test_report_lines(monkeypatch):
+    # many threads reporting at once must still produce whole lines
+    out = StringIO()
+    monkeypatch.setattr(sys, "stdout", out)
+    with futures.ThreadPoolExecutor(8) as pool:
+        list(pool.map(lambda i: report("Calling f(%d)"%i), range(200)))
+    lines = out.getvalue().split("\n")
+    assert lines.pop()==""
+    assert sorted(lines)==sorted("Calling f(%d)"%i for i in range(200))
+
+
+def test_cache_keys(tmp_path, monkeypatch):
+    _register_test_builtin(monkeypatch, [])
+    input_path = tmp_path/"in.txt"
+    input_path.write_text("a")
+    cache = ResultCache(str(tmp_path/"cache"))
+    command = "!echo_file %s"%input_path
+
+    key = cache.get_key(command)
+    assert key==cache.get_key(command+"  ")
+    input_path.write_text("b")
+    assert cache.get_key(command)!=key
+    key = cache.get_key(command)
+    monkeypatch.setenv("TESTVAR", "x")
+    assert cache.get_key(command)!=key
+
+    assert cache.get_key("ls -l") is None
+    assert cache.get_key("!nonexisting x") is None
+    assert cache.get_key("!echo_file a b") is None
+
+
+def test_cache_hits(tmp_path, monkeypatch):
+    calls = []
+    _register_test_builtin(monkeypatch, calls)
+    input_path = tmp_path/"in.txt"
+    input_path.write_text("a")
+    content = "% GENERATED: !echo_file {}\n% /GENERATED\n".format(input_path)
+    cache = ResultCache(str(tmp_path/"cache"))
+
+    profile = []
+    compute_blocks(content, cache=cache, profile=profile)
+    compute_blocks(content, cache=cache, profile=profile)
+    assert [rec["cache"] for rec in profile]==["miss", "hit"]
+    assert len(calls)==1
+
+    input_path.write_text("b")
+    assert process_all(content, cache=cache).count("b")==1
+    assert len(calls)==2
+
+    # refresh re-computes, but still fills the cache
+    refreshing = ResultCache(str(tmp_path/"cache"), refresh=True)
+    process_all(content, cache=refreshing)
+    assert len(calls)==3
+    assert refreshing.get(refreshing.get_key(
+        "!echo_file %s"%input_path)) is None
+    assert cache.get(cache.get_key("!echo_file %s"%input_path))=="b"
+
+
+def test_cache_prune(tmp_path):
+    cache = ResultCache(str(tmp_path), max_size=25)
+    for index, key in enumerate(["k1", "k2", "k3"]):
+        cache.put(key, "x"*10)
+        os.utime(cache.get_path(key), (index, index))
+    # using k1 makes k2 the least recently used entry
+    assert cache.get("k1")=="x"*10
+    cache.prune()
+    assert sorted(os.listdir(str(tmp_path)))==["k1", "k3"]
+
+
+def test_http_max_age(tmp_path, monkeypatch):
+    calls = []
+    _register_test_builtin(monkeypatch, calls)
+    monkeypatch.setattr(BUILTINS["echo_file"], "uses_http", True)
+    input_path = tmp_path/"in.txt"
+    input_path.write_text("a")
+    content = "% GENERATED: !echo_file {}\n% /GENERATED\n".format(input_path)
+    cache = ResultCache(str(tmp_path/"cache"), http_max_age=3600)
+    assert cache.get_max_age("!echo_file x")==3600
+    assert cache.get_max_age("!nonexisting x") is None
+
+    process_all(content, cache=cache)
+    process_all(content, cache=cache)
+    assert len(calls)==1
+
+    # an old result is re-computed even though the key is the same
+    key = cache.get_key("!echo_file %s"%input_path)
+    os.utime(cache.get_path(key), (time.time(), time.time()-7200))
+    process_all(content, cache=cache)
+    assert len(calls)==2
+
+
+def test_batched_taptable_output(monkeypatch):
+    # a fake TAP service answering the TAP_SCHEMA.columns queries
+    rows = [
+        ("ivoa.obscore", "dataproduct_type", "char", "", "Data product type"),
+        ("rr.resource", "ivoid", "char", "", "Identifier, see ivo://x/y."),
+        ("ivoa.obscore", "s_ra", "double", "1", "RA (ICRS) in $deg$"),
+        ("rr.resource", "res_title", "unicodeChar", "50", "Title_of {it}")]
+    queries = []
+
+    def fake_http_get(url, params=None, headers=None):
+        queries.append(params["QUERY"])
+        names = re.findall(r"'([^']*)'", params["QUERY"])
+        out = StringIO()
+        writer = csv.writer(out)
+        writer.writerow(["table_name", "column_name", "datatype", "size",
+            "description"])
+        writer.writerows(row for row in rows if row[0] in names)
+        return out.getvalue()
+
+    monkeypatch.setattr(sys.modules[__name__], "http_get", fake_http_get)
+    monkeypatch.setenv("TAPURL", "http://tap.example")
+    content = "".join("Text\n%% GENERATED: !taptable %s\nold\n%% /GENERATED\n"%
+        name for name in ["rr.resource", "ivoa.obscore", "rr.resource"])
+
+    monkeypatch.setattr(sys.modules[__name__], "_TAPTABLE_ROWS", {})
+    batched = process_all(content)
+    assert len(queries)==1
+
+    # now without prefetching, i.e., one query per table
+    monkeypatch.setattr(sys.modules[__name__], "_TAPTABLE_ROWS", {})
+    monkeypatch.setattr(sys.modules[__name__], "prefetch_builtins",
+        lambda matches, cache=None: [])
+    single = process_all(content)
+    assert len(queries)==3
+
+    assert batched==single
+    assert "Title\\_of \\{it\\}" in batched
+
+
+def test_record_ignores_result_cache(tmp_path, monkeypatch):
+    # a warm ResultCache must not keep !taptable from being recorded
+    monkeypatch.setenv("TAPURL", "http://tap.example")
+    fetched = []
+    monkeypatch.setattr(sys.modules[__name__], "fetch_taptable_rows",
+        lambda names: fetched.extend(names) or dict((n, []) for n in names))
+    monkeypatch.setattr(sys.modules[__name__], "_TAPTABLE_ROWS", {})
+    matches = list(GENERATED_PATTERN.finditer(
+        "% GENERATED: !taptable a.t\n% /GENERATED\n"))
+
+    warm = ResultCache(str(tmp_path))
+    warm.put(warm.get_key("!taptable a.t"), "cached")
+    assert prefetch_builtins(matches, warm)==[]
+
+    recording = ResultCache(str(tmp_path), skip_http=True)
+    assert recording.get_key("!taptable a.t") is None
+    assert recording.get_key("!schemadoc x.xsd T") is not None
+    assert prefetch_builtins(matches, recording)==["a.t"]
+    assert fetched==["a.t"]
+
+
+def test_prefetch_failure_has_command(monkeypatch):
+    def fail(names):
+        raise IOError("No recorded response")
+    monkeypatch.setattr(sys.modules[__name__], "fetch_taptable_rows", fail)
+    monkeypatch.setattr(sys.modules[__name__], "_TAPTABLE_ROWS", {})
+    try:
+        prefetch_builtins(list(GENERATED_PATTERN.finditer(
+            "% GENERATED: !taptable a.t\n% /GENERATED\n")))
+    except IOError as ex:
+        assert ex.command=="!taptable a.t (prefetch)"
+    else:
+        assert False, "prefetch failure not propagated"
+
+
+def test_splice_results():
+    content = ("head\n% GENERATED: one\nold 1\n% /GENERATED\nmiddle\n"
+        "%  GENERATED:   two\nold 2\n%  /GENERATED\ntail")
+    matches = list(GENERATED_PATTERN.finditer(content))
+    assert splice_results(content, matches, [matches[0].group(), "NEW"]
+        )==("head\n% GENERATED: one\nold 1\n% /GENERATED\nmiddle\n"
+            "NEW\ntail")
+    assert splice_results(content, matches,
+        [mat.group() for mat in matches])==content
+
+
+def test_write_atomically(tmp_path):
+    dest = tmp_path/"doc.tex"
+    dest.write_text("old")
+    dest.chmod(0o640)
+    write_atomically(str(dest), b"new")
+    assert dest.read_text()=="new"
+    assert dest.stat().st_mode & 0o777==0o640
+    assert os.listdir(str(tmp_path))==["doc.tex"]
+
+
+def test_changed_only(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    doc = tmp_path/"doc.tex"
+    doc.write_text("a\n% GENERATED: echo one\n% /GENERATED\n"
+        "b\n% GENERATED: echo two\ntwo\n\n% /GENERATED\n")
+
+    def run():
+        monkeypatch.setattr(sys, "argv", ["update_generated.py",
+            "--changed-only", "--no-cache", str(doc)])
+        main()
+        return capsys.readouterr().out
+
+    # only the outdated block is reported (and changed)
+    assert "Changed: echo one\n" in run()
+    assert doc.read_text()==("a\n% GENERATED: echo one\none\n\n% /GENERATED\n"
+        "b\n% GENERATED: echo two\ntwo\n\n% /GENERATED\n")
+
+    # an up-to-date document is not written at all
+    os.utime(str(doc), (1000, 1000))
+    assert "No generated content changed" in run()
+    assert doc.stat().st_mtime==1000
+
+
+def test_escape_for_TeX_edge_cases():
+    assert escape_for_TeX(" a$b\\c ")=="a\\$b$\\backslash$c"
+    assert escape_for_TeX("\\$")=="$\\backslash$\\$"
+    assert escape_for_TeX("£5")=="£5"
+    assert escape_for_TeX('{"%#&_}')=='\\{{"}\\%\\#\\&\\_\\}'
+    assert escape_for_TeX("see http://x.org/a_b, too"
+        )=="see \\url{http://x.org/a_b}, too"
+    assert escape_for_TeX("at https://x.org/$path.")==(
+        "at \\url{https://x.org/$path}.")
+
 
-    content = content.encode("utf-8")
-    with open(args.filename, "wb") as f:
-        f.write(content)
+def test_escape_for_TeX_matches_reference():
+    # The reference turns sterling signs into dollars; we no longer do
+    # that, so there are no sterling signs here.
+    import random
+    rng = random.Random(4711)
+    atoms = list("$\\&#%_{}\"ab .,)\n\t") + [
+        "http://", "https://", "ivo://", "x.org/", "/", "$\\", "\\$"]
+    for _ in range(5000):
+        tx = "".join(rng.choice(atoms) for _ in range(rng.randint(0, 30)))
+        assert escape_for_TeX(tx)==_escape_for_TeX_reference(tx), repr(tx)
 
 
 if __name__=="__main__":
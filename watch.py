@@ -0,0 +1,382 @@
+#!/usr/bin/python3
+"""
+Rebuilds a document's PDF and HTML when its sources change.
+
+This is what make watch runs.  It polls the files in the document
+directory (plus the relevant ivoatex files) and, after a change, waits
+until things have been quiet for a moment (the debounce time).  It then
+works out which targets the changed files affect and rebuilds only
+those:
+
+* vector figures (from .svg, .tikz.tex, or role_diagram.xml),
+* the bibliography (from .bib files) -- this is make biblio,
+* the PDF, and
+* the HTML.
+
+Figures are brought up to date first; PDF and HTML are then built in
+parallel.  Since the HTML build would normally wait for the PDF, it runs
+through the html-nopdf target, with TtH reading a copy of the .aux and
+.bbl taken before the PDF build.
+Cross references in the HTML may hence lag by one rebuild.  Figures
+written by a rebuild do not count as changes for the next one.
+
+Each rebuild prints a line with the targets and their timings.  make's
+output goes to logs in .ivoatex-cache/watch and is shown for failed
+targets.
+
+Polling rather than inotify keeps this free of non-stdlib dependencies;
+for document directories, scanning is a matter of milliseconds.
+
+This is part of ivoatex, covered by the GPL.  See COPYING for details.
+"""
+
+from concurrent import futures
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+
+WATCH_DIR = ".ivoatex-cache/watch"
+
+# files from ivoatex we watch, with the targets they affect
+IVOATEX_INPUTS = {
+    "ivoatex/ivoa.cls": {"pdf", "html"},
+    "ivoatex/tthdefs.tex": {"html"},
+    "ivoatex/tth-ivoa.xslt": {"html"},
+    "ivoatex/ivoabib.bib": {"bbl", "pdf", "html"},
+    "ivoatex/docrepo.bib": {"bbl", "pdf", "html"},
+}
+
+# the order in which targets are built
+TARGET_ORDER = ["figures", "bbl", "pdf", "html"]
+
+
+class Config:
+    """the document-specific settings, mostly from the Makefile.
+
+    figures and vector_figures are the values of FIGURES and
+    VECTORFIGURES.
+    """
+    def __init__(self, docname, figures=(), vector_figures=(),
+            make="make"):
+        self.docname, self.make = docname, make
+        self.figures = set(figures)
+        self.vector_figures = set(vector_figures)
+
+        self.figure_sources = {}
+        for fig in self.vector_figures:
+            stem = fig[:-len(".pdf")]
+            self.figure_sources[stem+".svg"] = fig
+            if stem.endswith(".tikz"):
+                self.figure_sources[stem+".tex"] = fig
+        if "role_diagram.pdf" in self.vector_figures:
+            self.figure_sources["role_diagram.xml"] = "role_diagram.pdf"
+
+        # files make writes while rebuilding that we nevertheless watch,
+        # as they can also be sources
+        self.build_outputs = set(self.vector_figures)
+        if "role_diagram.pdf" in self.vector_figures:
+            self.build_outputs.add("role_diagram.svg")
+
+        self.generated = {
+            docname+".pdf", docname+".html", "ivoatexmeta.tex",
+            "gitmeta.tex"}|set(
+            fig[:-len(".pdf")]+".png" for fig in self.vector_figures)
+
+
+def get_targets(path, config):
+    """returns the set of targets affected by a change to the file path
+    (relative to the document directory).
+    """
+    path = os.path.normpath(path)
+    if path in IVOATEX_INPUTS:
+        return IVOATEX_INPUTS[path]
+    if path in config.generated:
+        return set()
+    if path in config.figure_sources:
+        return {"figures", "pdf", "html"}
+    if path in config.figures or path in config.vector_figures:
+        return {"pdf", "html"}
+    if path.endswith(".bib"):
+        return {"bbl", "pdf", "html"}
+    if path.endswith((".tex", ".sty", ".cls")) or path=="Makefile":
+        return {"pdf", "html"}
+    return set()
+
+
+def scan(config, root="."):
+    """returns a dictionary mapping the paths of the watched files to
+    (mtime, size) pairs.
+
+    We look at all files in the document directory and its
+    subdirectories (except hidden ones and ivoatex) plus IVOATEX_INPUTS.
+    Only files that get_targets says affect some target are returned.
+    """
+    state = {}
+    for path in IVOATEX_INPUTS:
+        try:
+            stat = os.stat(os.path.join(root, path))
+            state[path] = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            pass
+
+    for dir_path, dir_names, file_names in os.walk(root):
+        dir_names[:] = [d for d in dir_names
+            if d!="ivoatex" and not d.startswith(".")]
+        for name in file_names:
+            path = os.path.relpath(os.path.join(dir_path, name), root)
+            if get_targets(path, config):
+                try:
+                    stat = os.stat(os.path.join(dir_path, name))
+                except OSError:
+                    # vanished while we were looking
+                    continue
+                state[path] = (stat.st_mtime_ns, stat.st_size)
+    return state
+
+
+def get_changes(old_state, new_state):
+    """returns the set of paths that were added, removed, or changed
+    between two scan results.
+    """
+    return set(path
+        for path in set(old_state)|set(new_state)
+        if old_state.get(path)!=new_state.get(path))
+
+
+def take_outputs(state, new_state, config):
+    """returns state with the entries for config.build_outputs taken from
+    the scan result new_state.
+
+    Other changes in new_state are left for the next wait_for_changes,
+    so edits made during a rebuild are not lost.
+    """
+    state = dict((path, value) for path, value in state.items()
+        if path not in config.build_outputs)
+    state.update((path, value) for path, value in new_state.items()
+        if path in config.build_outputs)
+    return state
+
+
+def wait_for_changes(config, state, interval, debounce):
+    """blocks until files have changed relative to the scan result state
+    and then have been quiet for debounce seconds.
+
+    This returns the new scan result and the changed paths.
+    """
+    while True:
+        time.sleep(interval)
+        new_state = scan(config)
+        changed = get_changes(state, new_state)
+        if changed:
+            break
+
+    while True:
+        time.sleep(debounce)
+        newer_state = scan(config)
+        more = get_changes(new_state, newer_state)
+        if not more:
+            return new_state, changed
+        changed |= more
+        new_state = newer_state
+
+
+def run_make(config, log_name, *args):
+    """runs make with args, logging to log_name in WATCH_DIR.
+
+    This returns a pair of success and the elapsed time.
+    """
+    start_time = time.time()
+    with open(os.path.join(WATCH_DIR, log_name), "w") as log:
+        status = subprocess.call([config.make]+list(args),
+            stdout=log, stderr=subprocess.STDOUT)
+    return status==0, time.time()-start_time
+
+
+def snapshot_aux(config):
+    """copies the document's .aux and .bbl to WATCH_DIR and returns the
+    base name to pass to TtH.
+    """
+    for ext in [".aux", ".bbl"]:
+        if os.path.exists(config.docname+ext):
+            shutil.copy(config.docname+ext, WATCH_DIR)
+    return os.path.join(WATCH_DIR, config.docname)
+
+
+def rebuild(config, targets):
+    """builds targets in TARGET_ORDER, PDF and HTML in parallel.
+
+    This returns a list of (target, success, seconds) triples.  After a
+    failure, the targets depending on the failed one are not built.
+    """
+    results = []
+    if "figures" in targets and config.vector_figures:
+        # figures runs first and alone, so the parallel PDF and HTML
+        # builds below do not both remake shared figure files.
+        results.append(("figures",)+run_make(config, "figures.log",
+            "figures"))
+    if "bbl" in targets and all(r[1] for r in results):
+        results.append(("bbl",)+run_make(config, "bbl.log", "biblio"))
+    if not all(r[1] for r in results):
+        return results
+
+    jobs = {}
+    with futures.ThreadPoolExecutor(2) as pool:
+        if "html" in targets:
+            aux_name = snapshot_aux(config)
+            jobs["html"] = pool.submit(run_make, config, "html.log",
+                "html-nopdf", "TTH_AUXNAME="+aux_name)
+        if "pdf" in targets:
+            jobs["pdf"] = pool.submit(run_make, config, "pdf.log",
+                config.docname+".pdf")
+    for target in ["pdf", "html"]:
+        if target in jobs:
+            results.append((target,)+jobs[target].result())
+    return results
+
+
+def format_results(changed, results, elapsed):
+    """returns the timing line for a rebuild.
+    """
+    changed = sorted(changed)
+    if len(changed)>3:
+        changed = changed[:3]+["..."]
+    return "[%s] %s -> %s (%.1f s)"%(
+        time.strftime("%H:%M:%S"),
+        " ".join(changed),
+        ", ".join("%s %.1f s%s"%(target, seconds, "" if ok else " FAILED")
+            for target, ok, seconds in results) or "nothing to do",
+        elapsed)
+
+
+def watch(config, interval, debounce, targets_wanted):
+    """rebuilds the document when its sources change until interrupted.
+    """
+    os.makedirs(WATCH_DIR, exist_ok=True)
+    state = scan(config)
+    print("Watching %d files; interrupt to stop."%len(state))
+
+    while True:
+        state, changed = wait_for_changes(config, state, interval, debounce)
+        targets = set()
+        for path in changed:
+            targets |= get_targets(path, config)
+        targets &= targets_wanted
+        if not targets:
+            continue
+
+        start_time = time.time()
+        results = rebuild(config, targets)
+        # don't take the figures we just made for new changes
+        state = take_outputs(state, scan(config), config)
+        print(format_results(changed, results, time.time()-start_time))
+        for target, ok, _ in results:
+            if not ok:
+                with open(os.path.join(WATCH_DIR, target+".log")) as f:
+                    sys.stdout.write("".join(f.readlines()[-20:]))
+        sys.stdout.flush()
+
+
+def parse_command_line():
+    import argparse
+    parser = argparse.ArgumentParser(description="Rebuild the document"
+        " when its sources change.  This is normally run through"
+        " make watch.")
+    parser.add_argument("--docname", required=True,
+        help="The document's DOCNAME.")
+    parser.add_argument("--figures", default="",
+        help="The document's FIGURES (blank-separated).")
+    parser.add_argument("--vector-figures", default="",
+        help="The document's VECTORFIGURES (blank-separated).")
+    parser.add_argument("--make", default=os.environ.get("MAKE", "make"),
+        help="The make to use (default: %(default)s).")
+    parser.add_argument("--interval", type=float, default=0.5,
+        help="Seconds between polls (default: %(default)s).")
+    parser.add_argument("--debounce", type=float, default=0.3,
+        help="Seconds without changes before rebuilding"
+            " (default: %(default)s).")
+    parser.add_argument("--no-html", action="store_true",
+        help="Only rebuild the PDF (and what it needs).")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_command_line()
+    config = Config(args.docname, args.figures.split(),
+        args.vector_figures.split(), args.make)
+    targets_wanted = set(TARGET_ORDER)
+    if args.no_html:
+        targets_wanted.discard("html")
+
+    try:
+        watch(config, args.interval, args.debounce, targets_wanted)
+    except KeyboardInterrupt:
+        print()
+
+
+############## Tests (run with python3 -m pytest watch.py)
+
+def _make_config():
+    return Config("Doc", ["logo.png"],
+        ["role_diagram.pdf", "plot.pdf", "graph.tikz.pdf"])
+
+
+def test_targets():
+    config = _make_config()
+    for path, expected in [
+            ("Doc.tex", {"pdf", "html"}),
+            ("./sections/intro.tex", {"pdf", "html"}),
+            ("local.bib", {"bbl", "pdf", "html"}),
+            ("plot.svg", {"figures", "pdf", "html"}),
+            ("graph.tikz.tex", {"figures", "pdf", "html"}),
+            ("plot.tex", {"pdf", "html"}),
+            ("role_diagram.xml", {"figures", "pdf", "html"}),
+            ("logo.png", {"pdf", "html"}),
+            ("ivoatex/tth-ivoa.xslt", {"html"}),
+            ("Makefile", {"pdf", "html"}),
+            ("Doc.pdf", set()),
+            ("plot.png", set()),
+            ("gitmeta.tex", set()),
+            ("unrelated.png", set()),
+            ("Doc.log", set())]:
+        assert get_targets(path, config)==expected, path
+
+
+def test_scan(tmp_path):
+    config = _make_config()
+    (tmp_path/"Doc.tex").write_text("x")
+    (tmp_path/"Doc.pdf").write_text("x")
+    (tmp_path/".git").mkdir()
+    (tmp_path/".git"/"x.tex").write_text("x")
+    (tmp_path/"sect").mkdir()
+    (tmp_path/"sect"/"a.tex").write_text("x")
+    state = scan(config, str(tmp_path))
+    assert set(state)=={"Doc.tex", os.path.join("sect", "a.tex")}
+
+    (tmp_path/"sect"/"a.tex").write_text("longer")
+    (tmp_path/"Doc.pdf").write_text("longer")
+    (tmp_path/"new.bib").write_text("")
+    assert get_changes(state, scan(config, str(tmp_path)))=={
+        os.path.join("sect", "a.tex"), "new.bib"}
+
+
+def test_take_outputs():
+    config = _make_config()
+    state = {"plot.svg": (1, 1), "plot.pdf": (1, 1), "Doc.tex": (1, 1)}
+    new_state = {"plot.svg": (1, 1), "plot.pdf": (2, 2), "Doc.tex": (2, 2),
+        "role_diagram.svg": (2, 2)}
+    state = take_outputs(state, new_state, config)
+    assert get_changes(state, new_state)=={"Doc.tex"}
+
+
+def test_format():
+    assert format_results(["a.tex"], [("pdf", True, 2), ("html", False, 1)],
+        2.1).endswith("] a.tex -> pdf 2.0 s, html 1.0 s FAILED (2.1 s)")
+
+
+if __name__=="__main__":
+    main()
+
+# vim:et:sw=4:sta